@@ -10,6 +10,7 @@ import pandas as pd
 
 from klustaviewa.control.processor import Processor
 from klustaviewa.control.stack import Stack
+from klustaviewa.views.hdf5lock import HDF5_LOCK
 from kwiklib.utils import logger as log
 from kwiklib.dataio.selection import get_indices, select
 from kwiklib.dataio.tools import get_array
@@ -54,7 +55,9 @@ def call_action(processor, action, suffix=''):
     method_name, args, kwargs = action
     kwargs = kwargs.copy()
     kwargs.pop('_description', None)
-    return getattr(processor, method_name + suffix)(*args, **kwargs)
+    # The actions write to the HDF5 file, which is read by other threads.
+    with HDF5_LOCK:
+        return getattr(processor, method_name + suffix)(*args, **kwargs)
 
 
 # -----------------------------------------------------------------------------
@@ -68,9 +71,9 @@ class Controller(object):
         (method_name, args, kwargs)
     
     """
-    def __init__(self, loader):
+    def __init__(self, loader, statscache=None):
         self.loader = loader
-        self.processor = Processor(loader)
+        self.processor = Processor(loader, statscache=statscache)
         # Create the action stack.
         self.stack = Stack(maxsize=20)
     
@@ -25,8 +25,69 @@ class Processor(object):
         (method_name, args, kwargs)
 
     """
-    def __init__(self, loader):
+    def __init__(self, loader, statscache=None):
         self.loader = loader
+        self.statscache = statscache
+
+    @property
+    def cluster_index(self):
+        return getattr(self.statscache, 'cluster_index', None)
+
+    @property
+    def cluster_metadata(self):
+        return getattr(self.statscache, 'cluster_metadata', None)
+
+    def _set_cluster(self, spikes, clusters):
+        self.loader.set_cluster(spikes, clusters)
+        if self.cluster_index is not None:
+            self.cluster_index.set_cluster(spikes, clusters)
+
+    def _get_spikes(self, clusters):
+        if self.cluster_index is not None:
+            return self.cluster_index.get_spikes(clusters)
+        return self.loader.get_spikes(clusters=clusters)
+
+    def _remove_empty_clusters(self, clusters):
+        """Remove the empty clusters among the specified ones."""
+        if self.cluster_index is None:
+            clusters_empty = self.loader.remove_empty_clusters()
+            if self.cluster_metadata is not None:
+                self.cluster_metadata.remove_clusters(clusters_empty)
+            return clusters_empty
+        clusters_empty = self.cluster_index.get_empty_clusters(clusters)
+        for cluster in clusters_empty:
+            self._remove_cluster(cluster)
+        return clusters_empty
+
+    # The following methods keep the cluster metadata cache in sync with
+    # the loader.
+    def _add_cluster(self, cluster, group, color):
+        self.loader.add_cluster(cluster, group, color)
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.add_clusters([cluster], [group], [color])
+
+    def _add_clusters(self, clusters, groups):
+        self.loader.add_clusters(clusters, groups)
+        if self.cluster_metadata is not None and len(clusters) > 0:
+            # The colors of the new clusters are chosen by the loader.
+            colors = get_array(self.loader.get_cluster_colors(clusters))
+            self.cluster_metadata.add_clusters(clusters, get_array(groups),
+                                               colors)
+
+    def _remove_cluster(self, cluster):
+        self.loader.remove_cluster(cluster)
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.remove_clusters([cluster])
+
+    def _set_cluster_colors(self, clusters, colors):
+        self.loader.set_cluster_colors(clusters, colors)
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.set_colors(clusters, colors)
+
+    def _set_cluster_groups(self, clusters, groups):
+        self.loader.set_cluster_groups(clusters, groups)
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.set_groups(clusters, groups)
 
 
     # Actions.
@@ -41,12 +102,23 @@ class Processor(object):
         group = np.max(get_array(cluster_groups))
         # color_old = get_array(cluster_colors)[0]
         color_new = random_color()
-        self.loader.add_cluster(cluster_merged, group, color_new)
+        self._add_cluster(cluster_merged, group, color_new)
+        # Generations of the merged clusters, before the merge.
+        waveform_stats = getattr(self.statscache, 'waveform_stats', None)
+        if waveform_stats is not None and self.cluster_index is not None:
+            generations = [self.cluster_index.get_generation(cluster)
+                           for cluster in clusters_to_merge]
+        else:
+            generations = None
         # Set the new cluster to the corresponding spikes.
-        self.loader.set_cluster(spikes, cluster_merged)
+        self._set_cluster(spikes, cluster_merged)
+        # Combine the waveform statistics of the merged clusters.
+        if generations is not None:
+            waveform_stats.merge(clusters_to_merge, generations,
+                                 cluster_merged)
         # Remove old clusters.
         for cluster in clusters_to_merge:
-            self.loader.remove_cluster(cluster)
+            self._remove_cluster(cluster)
         self.loader.unselect()
         return dict(clusters_to_merge=clusters_to_merge,
                     cluster_merged=cluster_merged,
@@ -55,16 +127,16 @@ class Processor(object):
     def merge_clusters_undo(self, clusters_old, cluster_groups,
         cluster_colors, cluster_merged):
         # Get spikes in clusters to merge.
-        spikes = self.loader.get_spikes(clusters=cluster_merged)
+        spikes = self._get_spikes(cluster_merged)
         clusters_to_merge = get_indices(cluster_groups)
         # Add old clusters.
         for cluster, group, color in zip(
                 clusters_to_merge, cluster_groups, cluster_colors):
-            self.loader.add_cluster(cluster, group, color)
+            self._add_cluster(cluster, group, color)
         # Set the new clusters to the corresponding spikes.
-        self.loader.set_cluster(spikes, clusters_old)
+        self._set_cluster(spikes, clusters_old)
         # Remove merged cluster.
-        self.loader.remove_cluster(cluster_merged)
+        self._remove_cluster(cluster_merged)
         self.loader.unselect()
         color_old = self.loader.get_cluster_color(clusters_to_merge[0])
         color_old2 = self.loader.get_cluster_color(clusters_to_merge[1])
@@ -87,14 +159,14 @@ class Processor(object):
         groups = self.loader.get_cluster_groups(cluster_indices_old)
         # colors = self.loader.get_cluster_colors(cluster_indices_old)
         # Add clusters.
-        self.loader.add_clusters(cluster_indices_new,
+        self._add_clusters(cluster_indices_new,
             # HACK: take the group of the first cluster for all new clusters
             get_array(groups)[0]*np.ones(len(cluster_indices_new)),
             )
         # Set the new clusters to the corresponding spikes.
-        self.loader.set_cluster(spikes, clusters_new)
+        self._set_cluster(spikes, clusters_new)
         # Remove empty clusters.
-        clusters_empty = self.loader.remove_empty_clusters()
+        clusters_empty = self._remove_empty_clusters(cluster_indices_old)
         self.loader.unselect()
         clusters_to_select = sorted(set(cluster_indices_old).union(
                 set(cluster_indices_new)) - set(clusters_empty))
@@ -113,15 +185,15 @@ class Processor(object):
         # Add clusters that were removed after the split operation.
         clusters_empty = sorted(set(cluster_indices_old) -
             set(cluster_indices_new))
-        self.loader.add_clusters(
+        self._add_clusters(
             clusters_empty,
             select(cluster_groups, clusters_empty),
             # select(cluster_colors, clusters_empty),
             )
         # Set the new clusters to the corresponding spikes.
-        self.loader.set_cluster(spikes, clusters_old)
+        self._set_cluster(spikes, clusters_old)
         # Remove empty clusters.
-        clusters_empty = self.loader.remove_empty_clusters()
+        clusters_empty = self._remove_empty_clusters(cluster_indices_new)
         self.loader.unselect()
         return dict(clusters_to_split=clusters,
                     clusters_split=get_array(cluster_indices_new),
@@ -132,13 +204,13 @@ class Processor(object):
     # Change cluster color.
     def change_cluster_color(self, cluster, color_old, color_new,
             clusters_selected):
-        self.loader.set_cluster_colors(cluster, color_new)
+        self._set_cluster_colors(cluster, color_new)
         return dict(clusters=clusters_selected, cluster=cluster,
             color_old=color_old, color_new=color_new)
 
     def change_cluster_color_undo(self, cluster, color_old, color_new,
             clusters_selected):
-        self.loader.set_cluster_colors(cluster, color_old)
+        self._set_cluster_colors(cluster, color_old)
         return dict(clusters=clusters_selected, cluster=cluster,
             color_old=color_old, color_new=color_new)
 
@@ -147,14 +219,14 @@ class Processor(object):
     def move_clusters(self, clusters, groups_old, group_new):
         # Get next cluster to select.
         next_cluster = self.loader.get_next_cluster(clusters[-1])
-        self.loader.set_cluster_groups(clusters, group_new)
+        self._set_cluster_groups(clusters, group_new)
         # to_compute=[] to force refreshing the correlation matrix
         # return dict(to_select=[next_cluster], to_compute=[])
         return dict(clusters=clusters, groups_old=groups_old, group=group_new,
             next_cluster=next_cluster)
 
     def move_clusters_undo(self, clusters, groups_old, group_new):
-        self.loader.set_cluster_groups(clusters, groups_old)
+        self._set_cluster_groups(clusters, groups_old)
         # to_compute=[] to force refreshing the correlation matrix
         # return dict(to_select=clusters, to_compute=[])
         return dict(clusters=clusters, groups_old=groups_old, group=group_new)
@@ -173,24 +245,36 @@ class Processor(object):
     # Add group.
     def add_group(self, group, name, color):
         self.loader.add_group(group, name, color)
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.set_group_name(group, name)
 
     def add_group_undo(self, group, name, color):
         self.loader.remove_group(group)
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.remove_group(group)
 
 
     # Rename group.
     def rename_group(self, group, name_old, name_new):
         self.loader.set_group_names(group, name_new)
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.set_group_name(group, name_new)
 
     def rename_group_undo(self, group, name_old, name_new):
         self.loader.set_group_names(group, name_old)
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.set_group_name(group, name_old)
 
 
     # Remove group.
     def remove_group(self, group, name, color):
         self.loader.remove_group(group)
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.remove_group(group)
 
     def remove_group_undo(self, group, name, color):
         self.loader.add_group(group, name, color)
+        if self.cluster_metadata is not None:
+            self.cluster_metadata.set_group_name(group, name)
 
 
@@ -34,6 +34,7 @@ from klustaviewa import SETTINGS
 from klustaviewa import APPNAME, ABOUT, get_global_path
 from klustaviewa.gui.threads import ThreadedTasks, OpenTask
 import klustaviewa.views.viewdata as vd
+from klustaviewa.views.hdf5lock import HDF5_LOCK
 import rcicons
 
     
@@ -332,7 +333,7 @@ class KwikSkope(QtGui.QMainWindow):
             )
             
         # Connect callback functions.
-        # view.channelsSelected.connect(self.channels_selected_callback)
+        view.channelsSelected.connect(self.channels_selected_callback)
         # view.channelColorChanged.connect(self.channel_color_changed_callback)
         # view.groupColorChanged.connect(self.group_color_changed_callback)
         # view.groupRenamed.connect(self.group_renamed_callback)
@@ -404,13 +405,15 @@ class KwikSkope(QtGui.QMainWindow):
              self.update_trace_view()
             
     def update_trace_view(self):
-        data = vd.get_traceview_data(self.loader)
+        with HDF5_LOCK:
+            data = vd.get_traceview_data(self.loader)
         [view.set_data(**data) for view in self.get_views('TraceView')]
 
     def update_channel_view(self, channels=None):
         """Update the channel view using the data stored in the loader
         object."""
-        data = vd.get_channelview_data(self.loader, channels=channels)
+        with HDF5_LOCK:
+            data = vd.get_channelview_data(self.loader, channels=channels)
         self.get_view('ChannelView').set_data(**data)
         if channels is not None:
             return
@@ -566,7 +569,11 @@ class KwikSkope(QtGui.QMainWindow):
     #         self.automatic_projection_action.isChecked())
         
     def channels_selected_callback(self, channels, wizard=False):
-        self.buffer.request((channels, wizard))
+        # Only the selected channels are read and displayed in the trace
+        # view, all channels when the selection is empty.
+        if not self.is_file_open:
+            return
+        [view.set_channels(channels) for view in self.get_views('TraceView')]
     
     def channel_pair_selected_callback(self, channels):
         """Callback when the user clicks on a pair in the
@@ -738,7 +745,8 @@ class KwikSkope(QtGui.QMainWindow):
             QtGui.QMessageBox.Save)
             if reply == QtGui.QMessageBox.Save:
                 folder = SETTINGS.get('main_window.last_data_file')
-                self.loader.save()
+                with HDF5_LOCK:
+                    self.loader.save()
             elif reply == QtGui.QMessageBox.Cancel:
                 e.ignore()
                 return
@@ -752,7 +760,8 @@ class KwikSkope(QtGui.QMainWindow):
         self.join_threads()
         
         # Close the loader.
-        self.loader.close()
+        with HDF5_LOCK:
+            self.loader.close()
         
         # Close all views.
         for views in self.views.values():
@@ -29,6 +29,10 @@ from kwiklib.dataio import KlustersLoader, KwikLoader, read_clusters
 from klustaviewa.gui.buffer import Buffer
 from klustaviewa.gui.dock import ViewDockWidget, DockTitleBar
 from klustaviewa.stats.cache import StatsCache
+from klustaviewa.stats.clustermetadata import ClusterMetadata
+from klustaviewa.views.repack import open_repacked
+from klustaviewa.views.npymirror import open_mirror, get_invalid_mirrors
+from klustaviewa.views.hdf5lock import HDF5_LOCK
 from klustaviewa.stats.correlograms import NCORRBINS_DEFAULT, CORRBIN_DEFAULT
 from klustaviewa.stats.correlations import normalize
 from kwiklib.utils import logger as log
@@ -38,7 +42,8 @@ from klustaviewa import USERPREF
 from klustaviewa import SETTINGS
 from klustaviewa import APPNAME, ABOUT, get_global_path
 from klustaviewa import get_global_path
-from klustaviewa.gui.threads import ThreadedTasks, OpenTask
+from klustaviewa.gui.threads import (ThreadedTasks, OpenTask,
+    MirrorExportTask)
 from klustaviewa.gui.taskgraph import TaskGraph
 import rcicons
 
@@ -727,9 +732,12 @@ class MainWindow(QtGui.QMainWindow):
         self.open_task.dataOpened.connect(self.open_done)
         self.open_task.dataSaved.connect(self.save_done)
         self.open_task.dataOpenFailed.connect(self.open_failed)
+        self.mirror_task = inthread(MirrorExportTask)()
+        self.mirror_task.mirrorExported.connect(self.mirror_exported)
 
     def join_threads(self):
          self.open_task.join()
+         self.mirror_task.join()
          self.taskgraph.join()
 
 
@@ -777,10 +785,11 @@ class MainWindow(QtGui.QMainWindow):
         clustering_name, ok = QtGui.QInputDialog.getText(self, "Clustering name", "Copy from (you'll lose the current clustering):",
                                    QtGui.QLineEdit.Normal, 'original')
         if ok:
-            self.loader.copy_clustering(clustering_from=clustering_name,
-                                        clustering_to='main')
-            # Reload the file.
-            self.loader.close()
+            with HDF5_LOCK:
+                self.loader.copy_clustering(clustering_from=clustering_name,
+                                            clustering_to='main')
+                # Reload the file.
+                self.loader.close()
             self.open_task.open(self.loader, self._path)
         # elif reply == QtGui.QMessageBox.Cancel:
             # return
@@ -811,7 +820,12 @@ class MainWindow(QtGui.QMainWindow):
         self.clear_view('CorrelogramsView')
         self.clear_view('TraceView')
 
-        self.loader.close()
+        # The stats cache closes the repacked file, which may be read by a
+        # task.
+        with HDF5_LOCK:
+            self.loader.close()
+            if self.statscache is not None:
+                self.statscache.close()
         self.is_file_open = False
 
     def switch_callback(self, checked=None):
@@ -823,7 +837,8 @@ class MainWindow(QtGui.QMainWindow):
             1)
         if ok:
             if shank in self.loader.shanks:
-                self.loader.set_shank(shank)
+                with HDF5_LOCK:
+                    self.loader.set_shank(shank)
                 self.open_done()
             else:
                 QtGui.QMessageBox.warning(self, "Wrong shank number",
@@ -868,11 +883,37 @@ class MainWindow(QtGui.QMainWindow):
         if clusters:
             self.get_view('ClusterView').unselect()
 
-        # Create the Controller.
-        self.controller = Controller(self.loader)
         # Create the cache for the cluster statistics that need to be
         # computed in the background.
-        self.statscache = StatsCache(SETTINGS.get('correlograms.ncorrbins', NCORRBINS_DEFAULT))
+        with HDF5_LOCK:
+            if self.statscache is not None:
+                self.statscache.close()
+            spike_clusters = self.loader.get_clusters('all')
+            spikes_data = self.loader.experiment.channel_groups[
+                self.loader.shank].spikes
+            self.statscache = StatsCache(
+                SETTINGS.get('correlograms.ncorrbins', NCORRBINS_DEFAULT),
+                spike_clusters=spike_clusters,
+                cluster_metadata=ClusterMetadata.from_experiment(
+                    self.loader.experiment, channel_group=self.loader.shank),
+                repacked_spikes=open_repacked(self.loader.filename,
+                    channel_group=self.loader.shank,
+                    nspikes=len(spike_clusters)),
+                npy_mirror=open_mirror(spikes_data,
+                    self.loader.filename, channel_group=self.loader.shank),
+                cluster_cache_size=USERPREF.get('cluster_cache_size_mb', 256))
+            # The missing .npy mirrors are exported in the background, and
+            # used once the export has finished.
+            if USERPREF.get('features_npy_mirror', False):
+                names = get_invalid_mirrors(spikes_data, self.loader.filename,
+                    channel_group=self.loader.shank)
+                if names:
+                    self.mirror_task.export(spikes_data,
+                        self.loader.filename,
+                        channel_group=self.loader.shank, names=names,
+                        statscache=self.statscache)
+        # Create the Controller, which keeps the cache up to date.
+        self.controller = Controller(self.loader, statscache=self.statscache)
         # Update stats cache in IPython view.
         ipython = self.get_view('IPythonView')
         if ipython:
@@ -886,8 +927,22 @@ class MainWindow(QtGui.QMainWindow):
         # self.taskgraph.update_projection_view()
         self.taskgraph.update_cluster_view()
         self.taskgraph.compute_similarity_matrix()
+        self.taskgraph.compute_waveform_stats()
         # self.taskgraph.update_trace_view()
 
+    def mirror_exported(self, statscache):
+        # Skip if the file has been closed or another shank opened since.
+        if not self.is_file_open or statscache is not self.statscache:
+            return
+        with HDF5_LOCK:
+            spikes_data = self.loader.experiment.channel_groups[
+                self.loader.shank].spikes
+            npy_mirror = open_mirror(spikes_data, self.loader.filename,
+                channel_group=self.loader.shank)
+        # The previous mirror is not closed, as it may be used by a task.
+        if npy_mirror is not None:
+            statscache.npy_mirror = npy_mirror
+
     def open_failed(self, message):
         self.open_progress.setValue(0)
         QtGui.QMessageBox.warning(self, "Error while opening the file",
@@ -1238,7 +1293,8 @@ class MainWindow(QtGui.QMainWindow):
             QtGui.QMessageBox.Save)
             if reply == QtGui.QMessageBox.Save:
                 folder = SETTINGS.get('main_window.last_data_file')
-                self.loader.save()
+                with HDF5_LOCK:
+                    self.loader.save()
             elif reply == QtGui.QMessageBox.Cancel:
                 e.ignore()
                 return
@@ -1249,10 +1305,14 @@ class MainWindow(QtGui.QMainWindow):
         self.save_geometry()
 
         # End the threads.
+        if self.statscache is not None:
+            with HDF5_LOCK:
+                self.statscache.close()
         self.join_threads()
 
         # Close the loader.
-        self.loader.close()
+        with HDF5_LOCK:
+            self.loader.close()
 
         # Close all views.
         for views in self.views.values():
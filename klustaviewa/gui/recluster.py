@@ -13,6 +13,7 @@ import threading
 import argparse
 
 import numpy as np
+from klustaviewa.views.hdf5lock import HDF5_LOCK
 from kwiklib import (Experiment, get_params, load_probe, create_files, 
     read_raw, Probe, convert_dtype, read_clusters,
     files_exist, add_clustering, delete_files, exception)
@@ -55,13 +56,14 @@ def save_old(exp, shank, spikes, dir=None):
     chg = exp.channel_groups[shank]
             
     # Create files in the old format (FET and FMASK)
-    fet = chg.spikes.features_masks[spikes, ...]
+    with HDF5_LOCK:
+        fet = chg.spikes.features_masks[spikes, ...]
+        res = chg.spikes.time_samples[spikes]
     if fet.ndim == 3:
         masks = fet[:,:,1]  # (nsamples, nfet)
         fet = fet[:,:,0]  # (nsamples, nfet)
     else:
         masks = None
-    res = chg.spikes.time_samples[spikes]
     
     times = np.expand_dims(res, axis =1)
     masktimezeros = np.zeros_like(times)
@@ -97,7 +99,9 @@ def run_klustakwik(exp, channel_group=None, clusters=None, **kwargs):
     shank = channel_group
 
     # Find the spikes belonging to the clusters to recluster.
-    spikes = np.nonzero(np.in1d(exp.channel_groups[shank].spikes.clusters.main[:], clusters))[0]
+    with HDF5_LOCK:
+        spike_clusters = exp.channel_groups[shank].spikes.clusters.main[:]
+    spikes = np.nonzero(np.in1d(spike_clusters, clusters))[0]
     
     save_old(exp, shank, spikes, dir=tmpdir)
     
@@ -18,6 +18,8 @@ from klustaviewa import SETTINGS
 from kwiklib.utils.colors import random_color
 from klustaviewa.gui.threads import ThreadedTasks
 import klustaviewa.views.viewdata as vd
+from klustaviewa.views.hdf5lock import HDF5_LOCK
+from klustaviewa.views.readplanner import get_chunk_rows, subsample_rows
 
 
 # -----------------------------------------------------------------------------
@@ -104,10 +106,16 @@ class TaskGraph(AbstractTaskGraph):
             self.selection_done_callback)
         self.tasks.recluster_task.reclusterDone.connect(
             self.recluster_done_callback)
+        self.tasks.featureview_data_task.dataReady.connect(
+            self.feature_view_data_ready_callback)
+        self.tasks.waveformview_data_task.dataReady.connect(
+            self.waveform_view_data_ready_callback)
         self.tasks.correlograms_task.correlogramsComputed.connect(
             self.correlograms_computed_callback)
         self.tasks.similarity_matrix_task.correlationMatrixComputed.connect(
             self.similarity_matrix_computed_callback)
+        self.tasks.waveform_stats_task.statsComputed.connect(
+            self.waveform_stats_computed_callback)
 
     def join(self):
          self.tasks.join()
@@ -147,6 +155,15 @@ class TaskGraph(AbstractTaskGraph):
                             clusters=clusters,
                             spikes=spikes, clu=clu, wizard=wizard)
 
+    def feature_view_data_ready_callback(self, clusters, data):
+        self.feature_view_data_ready(clusters, data)
+
+    def waveform_view_data_ready_callback(self, clusters, data, coarse):
+        self.waveform_view_data_ready(clusters, data, coarse)
+
+    def waveform_stats_computed_callback(self, clusters):
+        self.waveform_stats_computed(clusters)
+
     def correlograms_computed_callback(self, clusters, correlograms, ncorrbins,
             corrbin, sample_rate, wizard):
         # Execute the callback function under the control of the task manager
@@ -214,6 +231,25 @@ class TaskGraph(AbstractTaskGraph):
             # self.update_correlograms_view()
             return ('_update_correlograms_view', (wizard,), {})
 
+    def _compute_waveform_stats(self, clusters=None):
+        """Compute the mean and std waveforms of the specified clusters, or
+        of all clusters, in the background."""
+        if getattr(self.statscache, 'waveform_stats', None) is None:
+            return
+        if not USERPREF.get('waveforms_stats_all_spikes', True):
+            return
+        self.tasks.waveform_stats_task.compute(self.experiment,
+            clusters=clusters,
+            channel_group=self.loader.shank,
+            statscache=self.statscache,
+            filename=self.loader.filename,
+            )
+
+    def _waveform_stats_computed(self, clusters):
+        clusters_selected = self.loader.get_clusters_selected()
+        if clusters is None or np.any(np.in1d(clusters_selected, clusters)):
+            return [('_update_waveform_view', (), dict())]
+
     def _recluster(self):
         exp = self.loader.experiment
         channel_group = self.loader.shank
@@ -229,17 +265,30 @@ class TaskGraph(AbstractTaskGraph):
         exp = self.experiment
         channel_group = self.loader.shank
         clustering = 'main'  # TODO
-        fetdim = exp.application_data.spikedetekt.n_features_per_channel
+        with HDF5_LOCK:
+            fetdim = exp.application_data.spikedetekt.n_features_per_channel
 
         clusters_data = getattr(exp.channel_groups[channel_group].clusters, clustering)
         spikes_data = exp.channel_groups[channel_group].spikes
         cluster_groups_data = getattr(exp.channel_groups[channel_group].cluster_groups, clustering)
-        clusters_all = sorted(clusters_data.keys())
-        cluster_groups = pd.Series([clusters_data[cl].cluster_group or 0
-                                   for cl in clusters_all], index=clusters_all)
-
-        spikes_selected, fm = spikes_data.load_features_masks(fraction=.1)
-        clusters = getattr(spikes_data.clusters, clustering)[:][spikes_selected]
+        cluster_metadata = self.statscache.cluster_metadata
+        clusters_all = cluster_metadata.clusters
+        cluster_groups = pd.Series(cluster_metadata.get_groups(clusters_all,
+                                   default=0), index=clusters_all)
+
+        # Take 10% of the spikes, reading whole chunks unless the features
+        # are memory-mapped.
+        nspikes = spikes_data.features_masks.shape[0]
+        npy_mirror = self.statscache.npy_mirror
+        if npy_mirror is not None and npy_mirror.has('features_masks'):
+            chunk_rows = 1
+        else:
+            chunk_rows = get_chunk_rows(spikes_data.features_masks)
+        spikes_selected = subsample_rows(np.arange(nspikes), nspikes // 10,
+                                         chunk_rows)
+        fm = vd.read_spikes(spikes_data, 'features_masks', spikes_selected,
+                            statscache=self.statscache)
+        clusters = self.statscache.cluster_index.get_clusters(spikes_selected)
 
         fm = np.atleast_3d(fm)
         features = fm[:, :, 0]
@@ -340,18 +389,22 @@ class TaskGraph(AbstractTaskGraph):
         # HACK: work around a bug with some GPU drivers and empty selections
         if len(clu)==0:
             return
-        data = vd.get_correlogramsview_data(self.experiment,
-            self.statscache.correlograms,
-            clusters=clu,
-            channel_group=self.loader.shank,
-            wizard=wizard,
-            )
+        with HDF5_LOCK:
+            data = vd.get_correlogramsview_data(self.experiment,
+                self.statscache.correlograms,
+                clusters=clu,
+                channel_group=self.loader.shank,
+                wizard=wizard,
+                statscache=self.statscache,
+                )
         [view.set_data(**data) for view in self.get_views('CorrelogramsView')]
 
     def _update_similarity_matrix_view(self):
-        data = vd.get_similaritymatrixview_data(self.experiment,
-            self.statscache.similarity_matrix_normalized,
-            channel_group=self.loader.shank,)
+        with HDF5_LOCK:
+            data = vd.get_similaritymatrixview_data(self.experiment,
+                self.statscache.similarity_matrix_normalized,
+                channel_group=self.loader.shank,
+                statscache=self.statscache)
         [view.set_data(**data)
             for view in self.get_views('SimilarityMatrixView')]
         # Show selected clusters when the matrix has been updated.
@@ -363,10 +416,20 @@ class TaskGraph(AbstractTaskGraph):
         # HACK: work around a bug with some GPU drivers and empty selections
         if len(clu)==0:
             return
-        data = vd.get_featureview_data(self.experiment,
-            clusters=clu,
+        # The data is assembled in an external thread, the view keeps
+        # showing the previous data until the new data is ready.
+        self.tasks.featureview_data_task.get_data(self.experiment,
+            np.array(clu),
             autozoom=autozoom,
-            channel_group=self.loader.shank)
+            channel_group=self.loader.shank,
+            statscache=self.statscache)
+
+    def _feature_view_data_ready(self, clusters, data):
+        # Abort if the selection has changed in the meantime.
+        if not np.array_equal(clusters, self.loader.get_clusters_selected()):
+            log.debug("Skip update feature view with clusters {0:s}.".format(
+                str(clusters)))
+            return
         [view.set_data(**data) for view in self.get_views('FeatureView')]
 
     def _update_waveform_view(self, autozoom=None, wizard=None):
@@ -374,27 +437,64 @@ class TaskGraph(AbstractTaskGraph):
         # HACK: work around a bug with some GPU drivers and empty selections
         if len(clu)==0:
             return
-        data = vd.get_waveformview_data(self.experiment,
-            clusters=clu,
+        # The mean waveforms of new clusters (after a split or an undo)
+        # are computed in the background.
+        waveform_stats = getattr(self.statscache, 'waveform_stats', None)
+        if waveform_stats is not None:
+            clusters_unique = self.statscache.cluster_index.clusters_unique
+            clusters_missing = waveform_stats.get_missing_clusters(
+                clusters_unique[np.in1d(clusters_unique, clu)])
+            if clusters_missing:
+                self.compute_waveform_stats(np.array(clusters_missing))
+        # The data is assembled in an external thread, the view keeps
+        # showing the previous data until the new data is ready. A few
+        # waveforms per cluster are loaded first, unless all of them are
+        # in the cache.
+        self.tasks.waveformview_data_task.get_data(self.experiment,
+            np.array(clu),
             autozoom=autozoom,
             wizard=wizard,
-            channel_group=self.loader.shank
+            channel_group=self.loader.shank,
+            statscache=self.statscache,
+            count=vd.get_waveforms_count_coarse(clu,
+                statscache=self.statscache),
             )
+
+    def _waveform_view_data_ready(self, clusters, data, coarse=False):
+        # Abort if the selection has changed in the meantime.
+        if not np.array_equal(clusters, self.loader.get_clusters_selected()):
+            log.debug("Skip update waveform view with clusters {0:s}.".format(
+                str(clusters)))
+            return
         [view.set_data(**data) for view in self.get_views('WaveformView')]
+        # Load all waveforms in the background, they replace the coarse
+        # subset without changing the zoom and the highlighted spikes.
+        if coarse:
+            self.tasks.waveformview_data_task.get_data(self.experiment,
+                clusters,
+                wizard=data['keep_order'],
+                channel_group=self.loader.shank,
+                statscache=self.statscache,
+                keep_view=True,
+                )
 
     def _update_trace_view(self):
-        data = vd.get_traceview_data(self.experiment,
-            channel_group=self.loader.shank)
+        with HDF5_LOCK:
+            data = vd.get_traceview_data(self.experiment,
+                channel_group=self.loader.shank)
         [view.set_data(**data) for view in self.get_views('TraceView')]
 
     def _update_cluster_view(self, clusters=None):
         """Update the cluster view using the data stored in the loader
-        object."""
-        data = vd.get_clusterview_data(self.experiment, self.statscache,
-                                       channel_group=self.loader.shank)
-        self.get_view('ClusterView').set_data(**data)
-        if clusters is not None:
-            return
+        object. Only the specified clusters and the groups are updated if
+        clusters is not None, otherwise the whole view is rebuilt."""
+        with HDF5_LOCK:
+            data = vd.get_clusterview_data(self.experiment, self.statscache,
+                                           channel_group=self.loader.shank)
+        if clusters is None:
+            self.get_view('ClusterView').set_data(**data)
+        else:
+            self.get_view('ClusterView').update_data(clusters, **data)
 
     def _show_selection_in_matrix(self, clusters):
         if clusters is not None and 1 <= len(clusters) <= 2:
@@ -646,12 +746,14 @@ def union(*clusters_list):
 
 # Merge/split actions.
 def after_merge(output):
+    clusters_to_update = union(output['clusters_to_merge'],
+                               [output['cluster_merged']])
     if output.get('wizard', False):
         r = [('_invalidate', (output['clusters_to_merge'],)),
              # We specify here that the target in the wizard must be the
              # merged cluster.
              ('_compute_similarity_matrix', (output['cluster_merged'],)),
-             ('_update_cluster_view'),
+             ('_update_cluster_view', (clusters_to_update,)),
              ('_select_in_cluster_view', (output['cluster_merged'], [], True)),
              ('_wizard_change_color', ([output['cluster_merged']],)),
              ('_wizard_show_pair', ((output['cluster_merged'],
@@ -660,7 +762,7 @@ def after_merge(output):
     else:
         r = [('_invalidate', (output['clusters_to_merge'],)),
              ('_compute_similarity_matrix',),
-             ('_update_cluster_view'),
+             ('_update_cluster_view', (clusters_to_update,)),
              ('_select_in_cluster_view', (output['cluster_merged'],)),
             ]
     return r
@@ -673,7 +775,7 @@ def after_merge_undo(output):
              # Update the wizard, but not the similarity matrix yet which
              # is being computed in an external process.
              # ('_wizard_update', (None, False)),
-             ('_update_cluster_view'),
+             ('_update_cluster_view', (clusters_to_invalidate,)),
              ('_select_in_cluster_view', (output['clusters_to_merge'], [], True)),
              ('_wizard_change_color', (output['clusters_to_merge'],)),
              ('_wizard_show_pair', ((output['clusters_to_merge'][0],
@@ -685,7 +787,7 @@ def after_merge_undo(output):
     else:
         r = [('_invalidate', (clusters_to_invalidate,)),
              ('_compute_similarity_matrix', ()),
-             ('_update_cluster_view'),
+             ('_update_cluster_view', (clusters_to_invalidate,)),
              ('_select_in_cluster_view', (output['clusters_to_merge'],)),
             ]
     return r
@@ -693,20 +795,23 @@ def after_merge_undo(output):
 def after_split(output):
     clusters_to_update = sorted(set(output['clusters_to_split']).union(set(
         output['clusters_split'])) - set(output['clusters_empty']))
+    # The empty clusters are removed from the cluster view.
+    clusters_changed = union(output['clusters_to_split'],
+                             output['clusters_split'])
     if output.get('wizard', False):
         r = [('_invalidate', (output['clusters_to_split'],)),
              ('_compute_similarity_matrix', (True,)),
              # Update the wizard, but not the similarity matrix yet which
              # is being computed in an external process.
              # ('_wizard_update', (True, False)),
-             ('_update_cluster_view'),
+             ('_update_cluster_view', (clusters_changed,)),
              ('_select_in_cluster_view', (clusters_to_update, [], True)),
              ('_wizard_change_color', (output['clusters_to_split'],)),
             ]
     else:
         r = [ ('_invalidate', (output['clusters_to_split'],)),
              ('_compute_similarity_matrix', (True,)),
-             ('_update_cluster_view'),
+             ('_update_cluster_view', (clusters_changed,)),
              ('_select_in_cluster_view', (clusters_to_update,)),
             ]
     return r
@@ -719,14 +824,14 @@ def after_split_undo(output):
              # Update the wizard, but not the similarity matrix yet which
              # is being computed in an external process.
              # ('_wizard_update', (True, False)),
-             ('_update_cluster_view'),
+             ('_update_cluster_view', (clusters_to_invalidate,)),
              ('_select_in_cluster_view', (output['clusters_to_split'], [], True)),
              ('_wizard_change_color', (output['clusters_to_split'],)),
             ]
     else:
         r = [('_invalidate', (clusters_to_invalidate,)),
              ('_compute_similarity_matrix', (True,)),
-             ('_update_cluster_view'),
+             ('_update_cluster_view', (clusters_to_invalidate,)),
              ('_select_in_cluster_view', (output['clusters_to_split'],)),
             ]
     return r
@@ -735,36 +840,40 @@ def after_split_undo(output):
 # Other actions.
 def after_cluster_color_changed(output):
     if output.get('wizard', False):
-        return [('_update_cluster_view'),
+        return [('_update_cluster_view', (union(output['clusters'],
+                    np.atleast_1d(output['cluster'])),)),
                 ('_select_in_cluster_view', (output['clusters'], [], True)),
                 ('_wizard_change_color', (output['clusters'],)),
                 ('_wizard_show_pair',),# (output['cluster'],
                                          # output['color_new'])),
                 ]
     else:
-        return [('_update_cluster_view'),
+        return [('_update_cluster_view', (union(output['clusters'],
+                    np.atleast_1d(output['cluster'])),)),
                 ('_select_in_cluster_view', (output['clusters'],)),
                 ]
 
 def after_cluster_color_changed_undo(output):
     if output.get('wizard', False):
-        return [('_update_cluster_view'),
+        return [('_update_cluster_view', (union(output['clusters'],
+                    np.atleast_1d(output['cluster'])),)),
                 ('_select_in_cluster_view', (output['clusters'], [], True)),
                 ('_wizard_change_color', (output['clusters'],)),
                 ('_wizard_show_pair',),# (output['cluster'],
                                         # output['color_old'])),
                 ]
     else:
-        return [('_update_cluster_view'),
+        return [('_update_cluster_view', (union(output['clusters'],
+                    np.atleast_1d(output['cluster'])),)),
                 ('_select_in_cluster_view', (output['clusters'],)),
                 ]
 
 def after_group_color_changed(output):
-    return [('_update_cluster_view'),
+    return [('_update_cluster_view', ([],)),
             ('_select_in_cluster_view', ([],), dict(groups=output['groups']),),]
 
 def after_clusters_moved(output):
-    r = [ ('_update_cluster_view'),
+    r = [ ('_update_cluster_view', (union(output['clusters']),)),
           ('_update_similarity_matrix_view'),
           ]
     # If the wizard is active, it will be updated later so do not update it
@@ -784,20 +893,20 @@ def after_clusters_moved_undo(output):
         clusters = [output['next_cluster']]
     else:
         clusters = output['clusters']
-    r = [('_update_cluster_view'),
+    r = [('_update_cluster_view', (union(output['clusters']),)),
          ('_update_similarity_matrix_view'),
          ('_wizard_update',),
          ('_select_in_cluster_view', (clusters,)),]
     return r
 
 def after_group_added(output):
-    return [('_update_cluster_view')]
+    return [('_update_cluster_view', ([],))]
 
 def after_group_renamed(output):
-    return [('_update_cluster_view')]
+    return [('_update_cluster_view', ([],))]
 
 def after_group_removed(output):
-    return [('_update_cluster_view')]
+    return [('_update_cluster_view', ([],))]
 
 
 # Wizard.
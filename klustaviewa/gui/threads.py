@@ -17,8 +17,14 @@ from kwiklib.dataio.tools import get_array
 from klustaviewa.wizard.wizard import Wizard
 from kwiklib.utils import logger as log
 from klustaviewa.stats import compute_correlograms, SimilarityMatrix
+from klustaviewa.stats.waveformstats import (get_waveform_stats_filename,
+    get_source_mtime)
+import klustaviewa.views.viewdata as vd
+from klustaviewa.views.hdf5lock import HDF5_LOCK
+from klustaviewa.views.npymirror import export_mirror
 from recluster import run_klustakwik
 
+
 # -----------------------------------------------------------------------------
 # Tasks
 # -----------------------------------------------------------------------------
@@ -29,17 +35,36 @@ class OpenTask(QtCore.QObject):
 
     def open(self, loader, path, shank=None):
         try:
-            loader.close()
-            loader.open(path, shank)
+            with HDF5_LOCK:
+                loader.close()
+                loader.open(path, shank)
             self.dataOpened.emit()
         except Exception as e:
             self.dataOpenFailed.emit(traceback.format_exc())
 
     def save(self, loader):
-        loader.save()
+        with HDF5_LOCK:
+            loader.save()
         self.dataSaved.emit()
 
 
+class MirrorExportTask(QtCore.QObject):
+    """Export the .npy mirrors of the features and masks of a shank."""
+    mirrorExported = QtCore.pyqtSignal(object)
+
+    def export(self, spikes_data, filename, channel_group=0, names=None,
+               statscache=None):
+        try:
+            export_mirror(spikes_data, filename, channel_group, names=names)
+        except Exception:
+            log.warn("Unable to export the .npy mirrors:\n{0:s}".format(
+                traceback.format_exc()))
+
+    def export_done(self, spikes_data, filename, channel_group=0,
+                    names=None, statscache=None, _result=None):
+        self.mirrorExported.emit(statscache)
+
+
 class SelectionTask(QtCore.QObject):
     selectionDone = QtCore.pyqtSignal(object, bool, int)
 
@@ -47,12 +72,79 @@ class SelectionTask(QtCore.QObject):
         self.loader = loader
 
     def select(self, clusters, wizard, channel_group=0):
-        self.loader.select(clusters=clusters)
+        with HDF5_LOCK:
+            self.loader.select(clusters=clusters)
 
     def select_done(self, clusters, wizard, channel_group=0, _result=None):
         self.selectionDone.emit(clusters, wizard, channel_group)
 
 
+class FeatureViewDataTask(QtCore.QObject):
+    """Assemble the feature view data outside of the GUI thread."""
+    dataReady = QtCore.pyqtSignal(np.ndarray, object)
+
+    def get_data(self, exp, clusters, **kwargs):
+        return vd.get_featureview_data(exp, clusters=clusters, **kwargs)
+
+    def get_data_done(self, exp, clusters, _result=None, **kwargs):
+        self.dataReady.emit(np.array(clusters), _result)
+
+
+class WaveformViewDataTask(QtCore.QObject):
+    """Assemble the waveform view data outside of the GUI thread."""
+    # The last argument is True if only a coarse subset of the waveforms
+    # has been loaded.
+    dataReady = QtCore.pyqtSignal(np.ndarray, object, bool)
+
+    def get_data(self, exp, clusters, **kwargs):
+        return vd.get_waveformview_data(exp, clusters=clusters, **kwargs)
+
+    def get_data_done(self, exp, clusters, _result=None, **kwargs):
+        self.dataReady.emit(np.array(clusters), _result,
+                            kwargs.get('count') is not None)
+
+
+class WaveformStatsTask(QtCore.QObject):
+    """Compute the mean and std waveforms of clusters from all spikes."""
+    statsComputed = QtCore.pyqtSignal(object)
+
+    def compute(self, exp, clusters=None, channel_group=0, statscache=None,
+                filename=None):
+        spikes_data = exp.channel_groups[channel_group].spikes
+        if spikes_data.waveforms_filtered is None:
+            return
+        with HDF5_LOCK:
+            fetdim = exp.application_data.spikedetekt.n_features_per_channel
+        nchannels = spikes_data.waveforms_filtered.shape[2]
+
+        def read(spikes):
+            # read_spikes() only holds the lock while reading a block, so
+            # that the views can be updated in the meantime.
+            waveforms = vd.read_spikes(spikes_data, 'waveforms_filtered',
+                spikes, statscache=statscache)
+            if spikes_data.masks is None:
+                return waveforms, None
+            masks = vd.read_spikes(spikes_data, 'masks', spikes,
+                statscache=statscache)
+            return waveforms, masks[:, 0:fetdim*nchannels:fetdim]
+
+        waveform_stats = statscache.waveform_stats
+        # The statistics of all clusters are saved next to the file, and
+        # only the clusters which have changed since are computed again.
+        if clusters is None and filename is not None:
+            path = get_waveform_stats_filename(filename, channel_group)
+            source_mtime = get_source_mtime(filename)
+            waveform_stats.load(path, source_mtime)
+            if waveform_stats.compute(read):
+                waveform_stats.save(path, source_mtime)
+        else:
+            waveform_stats.compute(read, clusters=clusters)
+
+    def compute_done(self, exp, clusters=None, channel_group=0,
+                     statscache=None, filename=None, _result=None):
+        self.statsComputed.emit(clusters)
+
+
 class ReclusterTask(QtCore.QObject):
     reclusterDone = QtCore.pyqtSignal(int, object, object, object, object)
 
@@ -132,6 +224,13 @@ class ThreadedTasks(QtCore.QObject):
             impatient=True)
         self.recluster_task = inthread(ReclusterTask)(
             impatient=True)
+        # One thread per view so that a pending feature request is not
+        # discarded by a waveform request (and conversely).
+        self.featureview_data_task = inthread(FeatureViewDataTask)(
+            impatient=True)
+        self.waveformview_data_task = inthread(WaveformViewDataTask)(
+            impatient=True)
+        self.waveform_stats_task = inthread(WaveformStatsTask)()
         self.correlograms_task = inprocess(CorrelogramsTask)(
             impatient=True, use_master_thread=False)
         # HACK: the similarity matrix view does not appear to update on
@@ -146,6 +245,9 @@ class ThreadedTasks(QtCore.QObject):
     def join(self):
         self.selection_task.join()
         self.recluster_task.join()
+        self.featureview_data_task.join()
+        self.waveformview_data_task.join()
+        self.waveform_stats_task.join()
         self.correlograms_task.join()
         self.similarity_matrix_task.join()
 
@@ -0,0 +1,41 @@
+"""Repack the spikes of a .kwik file so that the spikes of every cluster are
+contiguous on disk.
+
+Usage: klustaviewa-repack myexperiment.kwik [shank]
+
+"""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+import sys
+
+from kwiklib.dataio import Experiment
+from klustaviewa.views.repack import repack
+
+
+# -----------------------------------------------------------------------------
+# Main function
+# -----------------------------------------------------------------------------
+def main():
+    if len(sys.argv) <= 1:
+        print(__doc__)
+        return
+    filename = os.path.realpath(sys.argv[1])
+    dirpath, basename = os.path.split(filename)
+    name = os.path.splitext(basename)[0]
+    with Experiment(name, dir=dirpath) as exp:
+        if len(sys.argv) > 2:
+            shanks = [int(sys.argv[2])]
+        else:
+            shanks = sorted(exp.channel_groups.keys())
+        if not shanks:
+            print("No shank found in {0:s}.".format(filename))
+            return
+        for shank in shanks:
+            path = repack(exp, filename, channel_group=shank)
+            print("Shank {0:d} repacked in {1:s}.".format(shank, path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""This module implements the selection of the background spikes displayed
+in the feature view. They are chosen once per shank."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+
+# -----------------------------------------------------------------------------
+# Background spikes
+# -----------------------------------------------------------------------------
+def get_background_spikes(cluster_index, nspikes_max,
+                          nspikes_per_cluster_min=10):
+    """Return a stratified subset of at most nspikes_max spikes, sorted.
+
+    Every cluster contributes proportionally to its size, with a minimum
+    number of spikes, and the spikes of every cluster are evenly spread
+    in time.
+
+    """
+    clusters = cluster_index.clusters_unique
+    sizes = cluster_index.get_sizes(clusters)
+    nspikes = sizes.sum()
+    if nspikes <= nspikes_max:
+        return cluster_index.get_spikes(clusters)
+    counts = (sizes * float(nspikes_max) / nspikes).astype(np.int64)
+    counts = np.minimum(sizes, np.maximum(counts, nspikes_per_cluster_min))
+    # The minimum can exceed the budget: the spikes in excess are removed
+    # from the clusters above the minimum, proportionally.
+    excess = counts.sum() - nspikes_max
+    if excess > 0:
+        counts_min = np.minimum(counts, nspikes_per_cluster_min)
+        extra = counts - counts_min
+        if extra.sum() >= excess:
+            counts = counts_min + (extra * (1. - float(excess) /
+                                            extra.sum())).astype(np.int64)
+        elif nspikes_max >= len(clusters):
+            # Even the minimum does not fit.
+            counts = np.minimum(sizes, nspikes_max // len(clusters))
+        else:
+            # Not even one spike per cluster: the spikes are evenly spread
+            # in time, regardless of their clusters.
+            spikes = cluster_index.get_spikes(clusters)
+            indices = np.linspace(0, len(spikes) - 1,
+                                  nspikes_max).astype(np.int64)
+            return np.unique(spikes[indices])
+    spikes = []
+    for cluster, size, count in zip(clusters, sizes, counts):
+        # Spikes are sorted by time in every cluster.
+        indices = np.linspace(0, size - 1, count).astype(np.int64)
+        spikes.append(cluster_index.get_spikes(cluster)[indices])
+    return np.unique(np.concatenate(spikes))
+
+
+class FeatureBackground(object):
+    """Background spikes of a shank and their normalized features, stored
+    in a single float32 block (the last column being the time)."""
+    def __init__(self, spikes, features, spiketimes, feature_normalization):
+        self.spikes = spikes
+        self.feature_normalization = feature_normalization
+        self.features = np.array(features, dtype=np.float32)
+        feature_normalization.normalize(self.features, spiketimes)
+
+    def get_features(self, scale=None):
+        """Return the normalized features. If the scale of the non-extra
+        features is overriden, a rescaled copy is returned."""
+        if scale is None:
+            return self.features
+        norm = self.feature_normalization
+        n = norm.nfeatures - norm.nextrafet
+        features = self.features.copy()
+        features[:, :n] *= scale / norm.scales[0]
+        return features
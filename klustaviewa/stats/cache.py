@@ -10,6 +10,9 @@ from itertools import product
 import numpy as np
 
 from klustaviewa.stats.indexed_matrix import IndexedMatrix, CacheMatrix
+from klustaviewa.stats.clusterindex import ClusterIndex
+from klustaviewa.stats.clustercache import ClusterDataCache
+from klustaviewa.stats.waveformstats import WaveformStats
 
 
 # -----------------------------------------------------------------------------
@@ -28,10 +31,44 @@ def is_indices(item):
 # Stats cache
 # -----------------------------------------------------------------------------
 class StatsCache(object):
-    def __init__(self, ncorrbins=None):
+    def __init__(self, ncorrbins=None, spike_clusters=None,
+                 cluster_metadata=None, repacked_spikes=None,
+                 npy_mirror=None, cluster_cache_size=256):
         self.ncorrbins = ncorrbins
+        # The cluster index and metadata are kept up to date by the
+        # processor, they are not affected by reset().
+        if spike_clusters is not None:
+            self.cluster_index = ClusterIndex(spike_clusters)
+            # Mean and std waveforms of every cluster, computed in the
+            # background.
+            self.waveform_stats = WaveformStats(self.cluster_index)
+        else:
+            self.cluster_index = None
+            self.waveform_stats = None
+        self.cluster_metadata = cluster_metadata
+        # Spike arrays sorted by cluster, if the file has been repacked.
+        self.repacked_spikes = repacked_spikes
+        # Memory-mapped copies of the features and masks, if any.
+        self.npy_mirror = npy_mirror
+        # Waveforms and features of the last selected clusters, with a
+        # budget in MB.
+        self.cluster_data_cache = ClusterDataCache(cluster_cache_size)
+        # Feature view background and normalization, computed at the first
+        # update.
+        self.feature_normalization = None
+        self.feature_background = None
         self.reset()
     
+    def close(self):
+        if self.waveform_stats is not None:
+            self.waveform_stats.cancel()
+        if self.repacked_spikes is not None:
+            self.repacked_spikes.close()
+            self.repacked_spikes = None
+        if self.npy_mirror is not None:
+            self.npy_mirror.close()
+            self.npy_mirror = None
+    
     def invalidate(self, clusters):
         self.correlograms.invalidate(clusters)
         self.similarity_matrix.invalidate(clusters)
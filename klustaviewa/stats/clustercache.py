@@ -0,0 +1,126 @@
+"""This module implements a least-recently-used cache of the data loaded for
+every cluster (waveforms, masks, features), so that reselecting a cluster
+does not read the file again."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def _get_nbytes(arrays):
+    return sum(a.nbytes for a in arrays if a is not None)
+
+
+# -----------------------------------------------------------------------------
+# Cluster data cache
+# -----------------------------------------------------------------------------
+class ClusterDataCache(object):
+    """LRU cache of tuples of arrays, with a budget in megabytes.
+
+    Keys are (kind, cluster, generation), so that the data of a cluster is
+    not reused once its spikes have changed.
+
+    """
+    def __init__(self, size_mb=256):
+        self.max_bytes = int(size_mb * 1024 * 1024)
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        """Return the arrays, or None if the key is not in the cache."""
+        with self._lock:
+            arrays = self._items.pop(key, None)
+            if arrays is not None:
+                # Move the item to the most recent position.
+                self._items[key] = arrays
+            return arrays
+
+    def set(self, key, arrays):
+        arrays = tuple(arrays)
+        nbytes = _get_nbytes(arrays)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= _get_nbytes(old)
+            # Do not keep items larger than the whole budget.
+            if nbytes > self.max_bytes:
+                return
+            self._items[key] = arrays
+            self.nbytes += nbytes
+            # Remove the least recently used items.
+            while self.nbytes > self.max_bytes:
+                _, old = self._items.popitem(last=False)
+                self.nbytes -= _get_nbytes(old)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+# -----------------------------------------------------------------------------
+# Per-cluster loading
+# -----------------------------------------------------------------------------
+def _get_keys(cluster_index, kind, clusters):
+    return [(kind, cluster, cluster_index.get_generation(cluster))
+            for cluster in clusters]
+
+def is_cached(cache, cluster_index, kind, clusters):
+    """Return whether the data of all clusters is in the cache."""
+    if cache is None:
+        return False
+    return all(key in cache
+               for key in _get_keys(cluster_index, kind, clusters))
+
+def load_clusters(cache, cluster_index, kind, clusters, get_spikes, read):
+    """Return the sorted spikes of the clusters and the corresponding rows
+    of some arrays, loading only the clusters which are not in the cache.
+
+    Arguments:
+      * get_spikes(cluster): return the sorted spikes to load for a cluster.
+      * read(spikes): return a tuple of arrays with one row per spike, or
+        None for missing arrays.
+
+    """
+    keys = _get_keys(cluster_index, kind, clusters)
+    parts = [cache.get(key) if cache is not None else None for key in keys]
+
+    # Load all missing clusters in a single read.
+    missing = [i for i, part in enumerate(parts) if part is None]
+    if missing:
+        spikes_missing = [get_spikes(clusters[i]) for i in missing]
+        arrays = read(np.concatenate(spikes_missing))
+        start = 0
+        for i, spikes in zip(missing, spikes_missing):
+            end = start + len(spikes)
+            parts[i] = (spikes,) + tuple(
+                a[start:end].copy() if a is not None else None
+                for a in arrays)
+            if cache is not None:
+                cache.set(keys[i], parts[i])
+            start = end
+
+    # Assemble the clusters and sort the spikes.
+    spikes = np.concatenate([part[0] for part in parts])
+    order = np.argsort(spikes, kind='mergesort')
+    arrays = []
+    for k in range(1, len(parts[0])):
+        if parts[0][k] is None:
+            arrays.append(None)
+        else:
+            arrays.append(np.concatenate([part[k] for part in parts])[order])
+    return (spikes[order],) + tuple(arrays)
@@ -0,0 +1,174 @@
+"""This module implements an index of the spikes in every cluster, which is
+updated incrementally when spikes are assigned to new clusters."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import hashlib
+from threading import RLock
+
+import numpy as np
+
+from kwiklib.dataio.tools import get_array
+
+
+# -----------------------------------------------------------------------------
+# Cluster index
+# -----------------------------------------------------------------------------
+class ClusterIndex(object):
+    """Keep the cluster sizes and the sorted list of spikes of every cluster.
+
+    The spike lists are initially views on a single array of spikes sorted
+    by cluster (CSR layout). After a merge or a split, only the lists of the
+    clusters that have changed are replaced.
+
+    Every cluster has a generation number, which changes whenever the
+    spikes of the cluster change. Generations are keyed on the spikes of
+    the cluster, so that a cluster which gets back the same spikes (e.g.
+    after undoing a merge) also gets back its previous generation.
+
+    The lock is held while the index is updated, so that other threads can
+    read a consistent state of several clusters.
+
+    """
+    def __init__(self, spike_clusters):
+        self.spike_clusters = np.array(get_array(spike_clusters),
+                                       dtype=np.int32)
+        self.nspikes = len(self.spike_clusters)
+        self.lock = RLock()
+        self._generation = 0
+        self._generations = {}
+        # Generation of every (cluster, spikes fingerprint) seen so far.
+        self._generations_known = {}
+        self._build()
+
+    def _build(self):
+        if self.nspikes == 0:
+            self._sizes = np.zeros(0, dtype=np.int64)
+            self._spikes = {}
+            return
+        self._sizes = np.bincount(self.spike_clusters).astype(np.int64)
+        # CSR layout: spikes sorted by cluster, and offsets of every cluster.
+        spikes_sorted = np.argsort(self.spike_clusters, kind='mergesort')
+        offsets = np.zeros(len(self._sizes) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(self._sizes)
+        self._spikes = {cluster: spikes_sorted[offsets[cluster]:
+                                               offsets[cluster + 1]]
+                        for cluster in np.nonzero(self._sizes)[0]}
+
+    def _grow(self, nclusters):
+        if nclusters > len(self._sizes):
+            sizes = np.zeros(nclusters, dtype=np.int64)
+            sizes[:len(self._sizes)] = self._sizes
+            self._sizes = sizes
+
+
+    # Access methods.
+    # ---------------
+    @property
+    def clusters_unique(self):
+        """Sorted array of the non-empty clusters."""
+        return np.nonzero(self._sizes)[0]
+
+    def get_sizes(self, clusters=None):
+        """Return the number of spikes in the specified clusters."""
+        if clusters is None:
+            clusters = self.clusters_unique
+        clusters = np.atleast_1d(get_array(clusters)).astype(np.int64)
+        sizes = np.zeros(len(clusters), dtype=np.int64)
+        valid = clusters < len(self._sizes)
+        sizes[valid] = self._sizes[clusters[valid]]
+        return sizes
+
+    def get_spikes(self, clusters):
+        """Return the sorted spikes belonging to the specified clusters."""
+        clusters = np.atleast_1d(get_array(clusters))
+        spikes = [self._spikes[cluster] for cluster in clusters
+                  if cluster in self._spikes]
+        if not spikes:
+            return np.array([], dtype=np.int64)
+        elif len(spikes) == 1:
+            return spikes[0].copy()
+        else:
+            return np.sort(np.concatenate(spikes))
+
+    def get_clusters(self, spikes=None):
+        """Return the clusters of the specified spikes."""
+        if spikes is None:
+            return self.spike_clusters
+        return self.spike_clusters[get_array(spikes)]
+
+    def get_generation(self, cluster):
+        """Return the generation number of a cluster."""
+        return self._generations.get(cluster, 0)
+
+    def get_fingerprint(self, cluster):
+        """Return a hash of the spikes of a cluster."""
+        spikes = self._spikes.get(cluster, np.array([], dtype=np.int64))
+        spikes = np.ascontiguousarray(spikes, dtype=np.int64)
+        return hashlib.sha1(spikes).hexdigest()
+
+    def get_empty_clusters(self, clusters):
+        """Return the clusters among the specified ones that have no spike."""
+        clusters = np.atleast_1d(get_array(clusters))
+        return sorted(clusters[self.get_sizes(clusters) == 0])
+
+
+    # Update methods.
+    # ---------------
+    def set_cluster(self, spikes, clusters):
+        """Assign spikes to clusters, clusters being either a single
+        cluster or an array with one cluster per spike.
+
+        The cost is proportional to the number of spikes that changed, plus
+        the size of the clusters that lost only part of their spikes.
+
+        """
+        spikes = np.atleast_1d(get_array(spikes)).astype(np.int64)
+        if len(spikes) == 0:
+            return
+        clusters = get_array(clusters)
+        if np.isscalar(clusters) or np.ndim(clusters) == 0:
+            clusters = clusters * np.ones(len(spikes), dtype=np.int32)
+        clusters = np.asarray(clusters, dtype=np.int32)
+        assert len(clusters) == len(spikes)
+
+        with self.lock:
+            clusters_old = self.spike_clusters[spikes]
+            clusters_changed = np.union1d(clusters_old, clusters)
+            # Remember the generations of the clusters before they change.
+            for cluster in clusters_changed:
+                key = (cluster, self.get_fingerprint(cluster))
+                self._generations_known[key] = self.get_generation(cluster)
+
+            self.spike_clusters[spikes] = clusters
+            self._grow(clusters.max() + 1)
+
+            # Remove the spikes from their old clusters.
+            for cluster in np.unique(clusters_old):
+                removed = spikes[clusters_old == cluster]
+                self._sizes[cluster] -= len(removed)
+                if self._sizes[cluster] == 0:
+                    del self._spikes[cluster]
+                else:
+                    kept = self._spikes[cluster]
+                    self._spikes[cluster] = kept[~np.in1d(kept, removed,
+                                                          assume_unique=True)]
+
+            # Add the spikes to their new clusters.
+            for cluster in np.unique(clusters):
+                added = np.sort(spikes[clusters == cluster])
+                self._sizes[cluster] += len(added)
+                if cluster in self._spikes:
+                    self._spikes[cluster] = np.union1d(self._spikes[cluster],
+                                                       added)
+                else:
+                    self._spikes[cluster] = added
+
+            # Update the generation of the clusters that have changed: either
+            # the generation they had with the same spikes, or a new one.
+            self._generation += 1
+            for cluster in clusters_changed:
+                key = (cluster, self.get_fingerprint(cluster))
+                self._generations[cluster] = self._generations_known.get(
+                    key, self._generation)
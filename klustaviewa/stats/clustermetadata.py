@@ -0,0 +1,151 @@
+"""This module implements an in-memory copy of the cluster metadata (colors,
+groups and group names), so that the views do not need to walk the HDF5
+attribute nodes of every cluster."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+from kwiklib.dataio.tools import get_array
+from kwiklib.utils.colors import next_color
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def _read_color(cluster_data, cluster):
+    try:
+        return cluster_data.application_data.klustaviewa.color or 1
+    except AttributeError as e:
+        return next_color(cluster)
+
+def _to_array(values, n):
+    values = get_array(values)
+    if np.isscalar(values) or np.ndim(values) == 0:
+        values = [values] * n
+    return np.asarray(values)
+
+
+# -----------------------------------------------------------------------------
+# Cluster metadata
+# -----------------------------------------------------------------------------
+class ClusterMetadata(object):
+    """Colors and groups of all clusters, stored in arrays indexed by the
+    cluster number, and names of all groups.
+
+    A group equal to -1 means that the cluster has no group.
+
+    """
+    def __init__(self, clusters=[], colors=[], groups=[], group_names={}):
+        self._exists = np.zeros(0, dtype=np.bool_)
+        self._colors = np.zeros(0, dtype=np.int32)
+        self._groups = np.zeros(0, dtype=np.int32)
+        self.group_names = dict(group_names)
+        self.add_clusters(clusters, groups, colors)
+
+    @staticmethod
+    def from_experiment(exp, channel_group=0, clustering='main'):
+        """Read the metadata of all clusters once."""
+        clusters_data = getattr(exp.channel_groups[channel_group].clusters,
+                                clustering)
+        cluster_groups_data = getattr(
+            exp.channel_groups[channel_group].cluster_groups, clustering)
+        clusters = sorted(clusters_data.keys())
+        colors = [_read_color(clusters_data[cl], cl) for cl in clusters]
+        groups = [clusters_data[cl].cluster_group for cl in clusters]
+        groups = [g if g is not None else -1 for g in groups]
+        group_names = {g: cluster_groups_data[g].name or 'Group'
+                       for g in cluster_groups_data.keys()}
+        return ClusterMetadata(clusters, colors, groups, group_names)
+
+    def _grow(self, nclusters):
+        if nclusters > len(self._exists):
+            n = len(self._exists)
+            self._exists = np.concatenate((self._exists,
+                np.zeros(nclusters - n, dtype=np.bool_)))
+            self._colors = np.concatenate((self._colors,
+                np.zeros(nclusters - n, dtype=np.int32)))
+            self._groups = np.concatenate((self._groups,
+                -np.ones(nclusters - n, dtype=np.int32)))
+
+    def _exist(self, clusters):
+        clusters = np.atleast_1d(get_array(clusters)).astype(np.int64)
+        exist = np.zeros(len(clusters), dtype=np.bool_)
+        valid = clusters < len(self._exists)
+        exist[valid] = self._exists[clusters[valid]]
+        return clusters, exist
+
+
+    # Access methods.
+    # ---------------
+    @property
+    def clusters(self):
+        """Sorted array of the existing clusters."""
+        return np.nonzero(self._exists)[0]
+
+    @property
+    def groups(self):
+        """Sorted list of the existing groups."""
+        return sorted(self.group_names.keys())
+
+    def get_colors(self, clusters=None):
+        """Return the colors of the specified clusters. Unknown clusters
+        get the default color."""
+        if clusters is None:
+            clusters = self.clusters
+        clusters, exist = self._exist(clusters)
+        colors = np.zeros(len(clusters), dtype=np.int32)
+        colors[exist] = self._colors[clusters[exist]]
+        colors[~exist] = [next_color(cl) for cl in clusters[~exist]]
+        return colors
+
+    def get_groups(self, clusters=None, default=3):
+        """Return the groups of the specified clusters. Unknown clusters
+        and clusters without a group get the default group."""
+        if clusters is None:
+            clusters = self.clusters
+        clusters, exist = self._exist(clusters)
+        groups = default * np.ones(len(clusters), dtype=np.int32)
+        groups[exist] = self._groups[clusters[exist]]
+        groups[groups < 0] = default
+        return groups
+
+    def get_group_names(self, groups=None):
+        if groups is None:
+            groups = self.groups
+        return [self.group_names.get(g, 'Group') for g in groups]
+
+
+    # Update methods.
+    # ---------------
+    def add_clusters(self, clusters, groups, colors=None):
+        clusters = np.atleast_1d(get_array(clusters)).astype(np.int64)
+        if len(clusters) == 0:
+            return
+        self._grow(clusters.max() + 1)
+        self._exists[clusters] = True
+        self._groups[clusters] = _to_array(groups, len(clusters))
+        if colors is None:
+            colors = [next_color(cl) for cl in clusters]
+        self._colors[clusters] = _to_array(colors, len(clusters))
+
+    def remove_clusters(self, clusters):
+        clusters, exist = self._exist(clusters)
+        self._exists[clusters[exist]] = False
+
+    def set_colors(self, clusters, colors):
+        clusters, exist = self._exist(clusters)
+        self._colors[clusters[exist]] = _to_array(colors,
+                                                  len(clusters))[exist]
+
+    def set_groups(self, clusters, groups):
+        clusters, exist = self._exist(clusters)
+        self._groups[clusters[exist]] = _to_array(groups,
+                                                  len(clusters))[exist]
+
+    def set_group_name(self, group, name):
+        self.group_names[group] = name
+
+    def remove_group(self, group):
+        self.group_names.pop(group, None)
@@ -0,0 +1,69 @@
+"""This module implements the normalization of the features displayed in the
+feature view, with constants computed once per shank."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def _find_max(x):
+    if x.size == 0:
+        return 1.
+    m = np.max(np.abs(x))
+    if m == 0:
+        return 1.
+    return m
+
+
+# -----------------------------------------------------------------------------
+# Feature normalization
+# -----------------------------------------------------------------------------
+class FeatureNormalization(object):
+    """Normalization constants of the features of a shank.
+
+    Arguments:
+      * features: a (nspikes, nfeatures) array with a subset of the features
+        of the shank, where the last nextrafet columns are the extra
+        features, the very last one being the time.
+      * nextrafet: the number of extra features, including the time.
+      * time_first, time_last: the first and last spike time, in samples.
+      * freq: the sampling rate.
+
+    """
+    def __init__(self, features, nextrafet, time_first, time_last, freq):
+        nfeatures = features.shape[1]
+        self.nfeatures = nfeatures
+        self.nextrafet = nextrafet
+        self.freq = float(freq)
+        self.time_first = time_first
+        self.time_last = time_last
+        self.duration = time_last / self.freq
+
+        # One scale per column, the time column is treated separately.
+        self.scales = np.ones(nfeatures, dtype=np.float32)
+        self.scales[:nfeatures - nextrafet] = 1. / _find_max(
+            features[:, :nfeatures - nextrafet])
+        # Extra features except time are normalized independently.
+        for i in range(nfeatures - nextrafet, nfeatures - 1):
+            self.scales[i] = 1. / _find_max(features[:, i])
+
+    def normalize(self, features, spiketimes, scale=None):
+        """Normalize features in place and put the normalized spike times in
+        the last column. The scale of the non-extra features can be
+        overriden."""
+        if features.size == 0:
+            return features
+        scales = self.scales
+        if scale is not None:
+            scales = scales.copy()
+            scales[:self.nfeatures - self.nextrafet] = scale
+        features[:, :-1] *= scales[:-1]
+        # Time between -1 and 1.
+        features[:, -1] = spiketimes
+        features[:, -1] *= 2. / (self.duration * self.freq)
+        features[:, -1] -= 1
+        return features
@@ -0,0 +1,73 @@
+"""Unit tests for stats.background module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+from klustaviewa.stats.clusterindex import ClusterIndex
+from klustaviewa.stats.normalization import FeatureNormalization
+from klustaviewa.stats.background import (get_background_spikes,
+    FeatureBackground)
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_background_spikes():
+    # One big cluster and one small cluster at the end of the recording.
+    spike_clusters = np.zeros(10000, dtype=np.int32)
+    spike_clusters[-50:] = 1
+    index = ClusterIndex(spike_clusters)
+
+    spikes = get_background_spikes(index, 1000)
+    assert np.all(np.diff(spikes) > 0)
+    assert 990 <= len(spikes) <= 1000
+    # The small cluster is represented.
+    assert np.sum(spike_clusters[spikes] == 1) >= 10
+    # The spikes cover the whole recording.
+    assert spikes[0] == 0
+    assert spikes[-1] == 9999
+
+    # Fewer spikes than the maximum.
+    assert np.array_equal(get_background_spikes(index, 20000),
+                          np.arange(10000))
+
+def test_background_spikes_many_clusters():
+    # The minimum number of spikes per cluster exceeds the maximum.
+    spike_clusters = np.repeat(np.arange(500), 20).astype(np.int32)
+    index = ClusterIndex(spike_clusters)
+    spikes = get_background_spikes(index, 1000)
+    assert len(spikes) == 1000
+    assert np.all(np.bincount(spike_clusters[spikes]) == 2)
+
+    # A few big clusters and many small ones.
+    spike_clusters = np.concatenate((np.repeat(np.arange(100), 20),
+                                     np.repeat([100, 101], 10000)))
+    index = ClusterIndex(spike_clusters)
+    spikes = get_background_spikes(index, 1500)
+    assert 1490 <= len(spikes) <= 1500
+    assert np.all(np.bincount(spike_clusters[spikes])[:100] == 10)
+
+def test_background_spikes_more_clusters_than_spikes():
+    # More clusters than the maximum number of spikes.
+    spike_clusters = np.repeat(np.arange(2000), 5).astype(np.int32)
+    index = ClusterIndex(spike_clusters)
+    spikes = get_background_spikes(index, 1000)
+    assert len(spikes) == 1000
+    assert np.all(np.diff(spikes) > 0)
+    # The spikes cover the whole recording.
+    assert spikes[0] == 0
+    assert spikes[-1] == 9999
+
+def test_feature_background():
+    features = np.random.randn(100, 4)
+    spiketimes = np.arange(100)
+    norm = FeatureNormalization(features, 1, 0, 99, 1.)
+    background = FeatureBackground(np.arange(100), features, spiketimes,
+                                   norm)
+    assert background.features.dtype == np.float32
+    assert np.allclose(background.get_features(),
+                       norm.normalize(features.copy(), spiketimes))
+    assert np.allclose(background.get_features(scale=2.)[:, :3],
+                       2 * features[:, :3], atol=1e-5)
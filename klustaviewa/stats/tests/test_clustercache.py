@@ -0,0 +1,66 @@
+"""Unit tests for stats.clustercache module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+from klustaviewa.stats.clusterindex import ClusterIndex
+from klustaviewa.stats.clustercache import (ClusterDataCache, load_clusters,
+    is_cached)
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_cluster_data_cache():
+    # Budget of 2 arrays of 1000 float64.
+    cache = ClusterDataCache(size_mb=16000. / (1024 * 1024))
+    cache.set(1, (np.zeros(1000),))
+    cache.set(2, (np.zeros(1000), None))
+    assert len(cache) == 2
+    # 1 becomes the most recent item, so 2 is removed.
+    assert cache.get(1) is not None
+    cache.set(3, (np.zeros(1000),))
+    assert 1 in cache and 3 in cache and 2 not in cache
+    assert cache.nbytes == 16000
+    # Items larger than the budget are not kept.
+    cache.set(4, (np.zeros(3000),))
+    assert 4 not in cache
+    assert cache.get(4) is None
+
+def test_load_clusters():
+    spike_clusters = np.random.randint(size=1000, low=2, high=10)
+    features = np.random.rand(1000, 3)
+    index = ClusterIndex(spike_clusters)
+    cache = ClusterDataCache()
+    reads = []
+
+    def read(spikes):
+        reads.append(spikes)
+        return features[spikes], None
+
+    spikes, f, m = load_clusters(cache, index, 'f', [3, 5], index.get_spikes,
+                                 read)
+    assert np.array_equal(spikes, index.get_spikes([3, 5]))
+    assert np.array_equal(f, features[spikes])
+    assert m is None
+    assert len(reads) == 1
+
+    # Only the new cluster is read.
+    spikes, f, m = load_clusters(cache, index, 'f', [5, 7], index.get_spikes,
+                                 read)
+    assert np.array_equal(spikes, index.get_spikes([5, 7]))
+    assert np.array_equal(f, features[spikes])
+    assert np.array_equal(reads[-1], index.get_spikes(7))
+    assert is_cached(cache, index, 'f', [3, 5, 7])
+    assert not is_cached(cache, index, 'g', [3])
+    assert not is_cached(None, index, 'f', [3])
+
+    # The merged cluster is read again.
+    index.set_cluster(index.get_spikes([5, 7]), 10)
+    spikes, f, m = load_clusters(cache, index, 'f', [3, 10], index.get_spikes,
+                                 read)
+    assert np.array_equal(f, features[spikes])
+    assert np.array_equal(reads[-1], index.get_spikes(10))
+    assert not is_cached(cache, index, 'f', [5])
@@ -0,0 +1,65 @@
+"""Unit tests for stats.clusterindex module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+from klustaviewa.stats.clusterindex import ClusterIndex
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def check_index(index):
+    # Compare the index with a full recomputation.
+    spike_clusters = index.get_clusters()
+    clusters = np.unique(spike_clusters)
+    assert np.array_equal(index.clusters_unique, clusters)
+    assert np.array_equal(index.get_sizes(clusters),
+                          np.bincount(spike_clusters)[clusters])
+    for cluster in clusters:
+        assert np.array_equal(index.get_spikes(cluster),
+                              np.nonzero(spike_clusters == cluster)[0])
+
+def test_cluster_index_build():
+    spike_clusters = np.random.randint(size=1000, low=2, high=10)
+    index = ClusterIndex(spike_clusters)
+    check_index(index)
+    assert index.get_sizes([0, 1, 100]).sum() == 0
+    assert len(index.get_spikes([0, 100])) == 0
+    assert np.array_equal(index.get_spikes([3, 5]),
+        np.nonzero(np.in1d(spike_clusters, [3, 5]))[0])
+
+def test_cluster_index_merge():
+    spike_clusters = np.random.randint(size=1000, low=2, high=10)
+    index = ClusterIndex(spike_clusters)
+    spikes = index.get_spikes([3, 5])
+    index.set_cluster(spikes, 10)
+    check_index(index)
+    assert index.get_empty_clusters([3, 5, 10]) == [3, 5]
+    # Only the clusters that have changed get a new generation.
+    assert index.get_generation(4) == 0
+    assert index.get_generation(3) == index.get_generation(10) > 0
+    generation = index.get_generation(10)
+
+    # Undo the merge.
+    index.set_cluster(spikes, spike_clusters[spikes])
+    check_index(index)
+    assert np.array_equal(index.get_clusters(), spike_clusters)
+    # The restored clusters get back their previous generation.
+    assert index.get_generation(3) == index.get_generation(5) == 0
+
+    # Redo the merge.
+    index.set_cluster(spikes, 10)
+    check_index(index)
+    assert index.get_generation(10) == generation
+
+def test_cluster_index_split():
+    spike_clusters = np.random.randint(size=1000, low=2, high=10)
+    index = ClusterIndex(spike_clusters)
+    spikes = index.get_spikes(4)[::3]
+    index.set_cluster(spikes, 11 * np.ones(len(spikes), dtype=np.int32))
+    check_index(index)
+    assert index.get_sizes(11)[0] == len(spikes)
+    assert index.get_empty_clusters([4, 11]) == []
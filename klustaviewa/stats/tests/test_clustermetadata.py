@@ -0,0 +1,41 @@
+"""Unit tests for stats.clustermetadata module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+from klustaviewa.stats.clustermetadata import ClusterMetadata
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_cluster_metadata():
+    metadata = ClusterMetadata(clusters=[2, 3, 5], colors=[4, 5, 6],
+                               groups=[0, -1, 2],
+                               group_names={0: 'Noise', 2: 'Good'})
+
+    assert np.array_equal(metadata.clusters, [2, 3, 5])
+    assert np.array_equal(metadata.get_colors([5, 2]), [6, 4])
+    assert np.array_equal(metadata.get_groups([2, 3, 5]), [0, 3, 2])
+    assert np.array_equal(metadata.get_groups([3, 7], default=0), [0, 0])
+    assert metadata.get_group_names() == ['Noise', 'Good']
+
+    # Merge.
+    metadata.add_clusters([10], [2], [7])
+    metadata.remove_clusters([2, 5])
+    assert np.array_equal(metadata.clusters, [3, 10])
+    assert np.array_equal(metadata.get_colors(10), [7])
+
+    # Move and recolor.
+    metadata.set_groups([3, 10], 1)
+    metadata.set_colors(3, 9)
+    assert np.array_equal(metadata.get_groups(), [1, 1])
+    assert np.array_equal(metadata.get_colors(), [9, 7])
+
+    # Groups.
+    metadata.set_group_name(1, 'MUA')
+    metadata.remove_group(0)
+    assert metadata.groups == [1, 2]
+    assert metadata.get_group_names() == ['MUA', 'Good']
@@ -0,0 +1,39 @@
+"""Unit tests for stats.normalization module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+from klustaviewa.stats.normalization import FeatureNormalization
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_feature_normalization():
+    nspikes, nfeatures, nextrafet = 100, 6, 2
+    features_bg = np.random.randn(nspikes, nfeatures).astype(np.float32)
+    norm = FeatureNormalization(features_bg, nextrafet,
+                                time_first=0, time_last=20000, freq=20000.)
+    assert norm.duration == 1.
+
+    spiketimes = np.linspace(0, 20000, nspikes)
+    features = norm.normalize(features_bg.copy(), spiketimes)
+    assert np.allclose(np.abs(features[:, :4]).max(), 1)
+    assert np.allclose(np.abs(features[:, 4]).max(), 1)
+    assert np.allclose(features[[0, -1], -1], [-1, 1])
+
+    # The scales do not depend on the normalized features.
+    features = norm.normalize(features_bg[:10].copy(), spiketimes[:10])
+    assert np.allclose(features, norm.normalize(features_bg.copy(),
+                                                spiketimes)[:10])
+
+    # Override the scale of the non-extra features.
+    features = norm.normalize(features_bg.copy(), spiketimes, scale=2.)
+    assert np.allclose(features[:, :4], 2 * features_bg[:, :4])
+
+def test_feature_normalization_empty():
+    norm = FeatureNormalization(np.zeros((0, 3)), 1, 0, 100, 10.)
+    assert np.array_equal(norm.scales, np.ones(3))
+    assert norm.normalize(np.zeros((0, 3)), []).shape == (0, 3)
@@ -0,0 +1,124 @@
+"""Unit tests for stats.waveformstats module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from klustaviewa.stats.clusterindex import ClusterIndex
+from klustaviewa.stats.waveformstats import (WaveformStats,
+    get_waveform_stats_filename)
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def create_data(nspikes=1000):
+    spike_clusters = np.random.randint(size=nspikes, low=2, high=10)
+    waveforms = np.random.randn(nspikes, 20, 4)
+    masks = np.random.rand(nspikes, 4)
+    return spike_clusters, waveforms, masks
+
+def check_stats(stats, clusters, spike_clusters, waveforms, masks):
+    mean, std, masks_mean = stats.get(clusters)
+    for i, cluster in enumerate(clusters):
+        spikes = spike_clusters == cluster
+        assert np.allclose(mean[i], waveforms[spikes].mean(axis=0))
+        assert np.allclose(std[i], waveforms[spikes].std(axis=0))
+        assert np.allclose(masks_mean[i], masks[spikes].mean(axis=0))
+
+def test_waveform_stats_compute():
+    spike_clusters, waveforms, masks = create_data()
+    index = ClusterIndex(spike_clusters)
+    stats = WaveformStats(index)
+    assert stats.get([2, 3]) is None
+
+    read = lambda spikes: (waveforms[spikes], masks[spikes])
+    stats.compute(read, block_rows=300)
+    assert stats.get_missing_clusters([2, 3, 100]) == [100]
+    check_stats(stats, [3, 2, 9], spike_clusters, waveforms, masks)
+
+def test_waveform_stats_merge_split():
+    spike_clusters, waveforms, masks = create_data()
+    index = ClusterIndex(spike_clusters)
+    stats = WaveformStats(index)
+    read = lambda spikes: (waveforms[spikes], masks[spikes])
+    stats.compute(read)
+
+    # Merge: the statistics are combined without reading the waveforms.
+    generations = [index.get_generation(cluster) for cluster in [3, 5]]
+    spikes = index.get_spikes([3, 5])
+    index.set_cluster(spikes, 10)
+    stats.merge([3, 5], generations, 10)
+    spike_clusters[spikes] = 10
+    check_stats(stats, [10], spike_clusters, waveforms, masks)
+    assert stats.get([3]) is None
+
+    # Split: the new clusters are computed again.
+    spikes = index.get_spikes(4)[::2]
+    index.set_cluster(spikes, 11)
+    spike_clusters[spikes] = 11
+    assert stats.get_missing_clusters([4, 10, 11]) == [4, 11]
+    stats.compute(read, clusters=[4, 11])
+    check_stats(stats, [4, 10, 11], spike_clusters, waveforms, masks)
+
+    # Undo the split: the previous statistics are used again.
+    index.set_cluster(spikes, 4)
+    spike_clusters[spikes] = 4
+    assert stats.get_missing_clusters([4, 10]) == []
+    check_stats(stats, [4, 10], spike_clusters, waveforms, masks)
+
+def test_waveform_stats_concurrent_merge():
+    spike_clusters, waveforms, masks = create_data()
+    index = ClusterIndex(spike_clusters)
+    stats = WaveformStats(index)
+    spikes_merged = index.get_spikes([3, 5])
+
+    # The clusters are merged while their statistics are being computed.
+    def read(spikes):
+        if index.get_sizes(10)[0] == 0:
+            index.set_cluster(spikes_merged, 10)
+        return waveforms[spikes], masks[spikes]
+    stats.compute(read, clusters=[3, 5], block_rows=50)
+    assert stats.get_missing_clusters([3, 5, 10]) == [3, 5, 10]
+
+    # After an undo, the statistics of the original clusters are used.
+    index.set_cluster(spikes_merged, spike_clusters[spikes_merged])
+    assert stats.get_missing_clusters([3, 5]) == []
+    check_stats(stats, [3, 5], spike_clusters, waveforms, masks)
+
+def test_waveform_stats_save_load():
+    spike_clusters, waveforms, masks = create_data()
+    index = ClusterIndex(spike_clusters)
+    stats = WaveformStats(index)
+    read = lambda spikes: (waveforms[spikes], masks[spikes])
+    assert stats.compute(read)
+    assert not stats.compute(read)
+
+    dirpath = tempfile.mkdtemp()
+    try:
+        path = get_waveform_stats_filename(
+            os.path.join(dirpath, 'myexperiment.kwik'), 0)
+        stats.save(path, source_mtime=1.)
+
+        # A merged cluster is computed again, the others are loaded.
+        spikes = index.get_spikes([3, 5])
+        spike_clusters[spikes] = 10
+        index = ClusterIndex(spike_clusters)
+        stats = WaveformStats(index)
+        assert stats.load(path, source_mtime=2.) == 0
+        nclusters = len(index.clusters_unique)
+        assert stats.load(path, source_mtime=1.) == nclusters - 1
+        assert stats.get_missing_clusters(index.clusters_unique) == [10]
+        reads = []
+        assert stats.compute(lambda spikes: reads.append(spikes) or
+                             read(spikes))
+        assert np.array_equal(np.concatenate(reads), spikes)
+        check_stats(stats, index.clusters_unique, spike_clusters, waveforms,
+                    masks)
+    finally:
+        shutil.rmtree(dirpath)
@@ -0,0 +1,237 @@
+"""This module implements the mean and standard deviation of the waveforms
+of every cluster, computed from all spikes, and combined without reading the
+file again when clusters are merged."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+from threading import Lock
+
+import numpy as np
+
+from kwiklib.utils import logger as log
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def get_waveform_stats_filename(filename, channel_group):
+    """Return the path of the file where the waveform statistics of a shank
+    are saved."""
+    return '{0:s}.shank{1:d}.waveformstats.npz'.format(
+        os.path.splitext(filename)[0], channel_group)
+
+def get_source_mtime(filename):
+    """Return the modification time of the .kwx file with the waveforms."""
+    source = os.path.splitext(filename)[0] + '.kwx'
+    if not os.path.exists(source):
+        return 0.
+    return os.path.getmtime(source)
+
+def accumulate(spike_clusters, waveforms, masks=None):
+    """Return a dictionary cluster => (count, sums, sums of squares, sums of
+    masks) for a block of spikes."""
+    waveforms = np.asarray(waveforms, dtype=np.float64)
+    nspikes, nsamples, nchannels = waveforms.shape
+    if masks is None:
+        masks = np.ones((nspikes, nchannels))
+    masks = np.asarray(masks, dtype=np.float64)
+    if nspikes == 0:
+        return {}
+    order = np.argsort(spike_clusters, kind='mergesort')
+    clusters_sorted = spike_clusters[order]
+    clusters, starts = np.unique(clusters_sorted, return_index=True)
+    counts = np.diff(np.concatenate((starts, [nspikes])))
+    waveforms = waveforms[order]
+    masks = masks[order]
+    sums = np.add.reduceat(waveforms, starts, axis=0)
+    sums2 = np.add.reduceat(waveforms ** 2, starts, axis=0)
+    sums_masks = np.add.reduceat(masks, starts, axis=0)
+    return {cluster: (counts[i], sums[i], sums2[i], sums_masks[i])
+            for i, cluster in enumerate(clusters)}
+
+def _add(stats0, stats1):
+    if stats0 is None:
+        return stats1
+    return tuple(x0 + x1 for x0, x1 in zip(stats0, stats1))
+
+
+# -----------------------------------------------------------------------------
+# Waveform statistics
+# -----------------------------------------------------------------------------
+class WaveformStats(object):
+    """Sums and sums of squares of the waveforms of every cluster.
+
+    The statistics of a cluster are stored with the generation number of
+    the cluster in the cluster index, and are only returned while this
+    generation is current. The statistics of previous generations are
+    kept, since a cluster gets back its generation after an undo.
+
+    """
+    def __init__(self, cluster_index):
+        self.cluster_index = cluster_index
+        self._stats = {}
+        self._lock = Lock()
+        self.cancelled = False
+
+    def _get(self, cluster):
+        return self._stats.get(
+            (cluster, self.cluster_index.get_generation(cluster)))
+
+    def _set(self, cluster, generation, stats):
+        self._stats[(cluster, generation)] = stats
+
+
+    # Access methods.
+    # ---------------
+    def get_missing_clusters(self, clusters):
+        """Return the clusters among the specified ones whose statistics are
+        not available."""
+        with self._lock:
+            return [cluster for cluster in clusters
+                    if self._get(cluster) is None]
+
+    def get(self, clusters):
+        """Return the mean and std waveforms and the mean masks of the
+        clusters, or None if some statistics are not available."""
+        with self._lock:
+            stats = [self._get(cluster) for cluster in clusters]
+        if len(stats) == 0 or any(s is None for s in stats):
+            return None
+        counts = np.array([s[0] for s in stats],
+                          dtype=np.float64).reshape((-1, 1, 1))
+        counts = np.maximum(counts, 1)
+        mean = np.array([s[1] for s in stats]) / counts
+        mean2 = np.array([s[2] for s in stats]) / counts
+        std = np.sqrt(np.maximum(mean2 - mean ** 2, 0))
+        masks = np.array([s[3] for s in stats]) / counts[:, :, 0]
+        return mean, std, masks
+
+
+    # Update methods.
+    # ---------------
+    def compute(self, read, clusters=None, block_rows=1000):
+        """Compute the missing statistics of the specified clusters, or of
+        all clusters. The file is read in a single pass if no statistics are
+        available. Return True if statistics have been computed.
+
+        read(spikes) must return the waveforms and the masks (or None) of
+        the spikes.
+
+        """
+        index = self.cluster_index
+        if clusters is None:
+            clusters = index.clusters_unique
+        # The statistics may have been computed (or loaded) in the meantime.
+        clusters_missing = self.get_missing_clusters(clusters)
+        if len(clusters_missing) == 0:
+            return False
+        # Single pass over the file when all statistics are missing.
+        full = len(clusters_missing) == len(index.clusters_unique)
+        clusters = clusters_missing
+        # The clustering can change in the meantime: the generations and
+        # the spikes are taken together under the lock of the index, so
+        # that the statistics are stored with the generation of the spikes
+        # they have been computed from.
+        with index.lock:
+            generations = {cluster: index.get_generation(cluster)
+                           for cluster in clusters}
+            if full:
+                spike_clusters = index.get_clusters().copy()
+                spikes = np.arange(len(spike_clusters))
+            else:
+                spikes = index.get_spikes(clusters)
+                spike_clusters = index.get_clusters(spikes)
+
+        totals = {}
+        for i in range(0, len(spikes), block_rows):
+            if self.cancelled:
+                return False
+            waveforms, masks = read(spikes[i:i + block_rows])
+            for cluster, stats in accumulate(
+                    spike_clusters[i:i + block_rows], waveforms,
+                    masks).items():
+                totals[cluster] = _add(totals.get(cluster), stats)
+
+        with self._lock:
+            for cluster, stats in totals.items():
+                if cluster in generations:
+                    self._set(cluster, generations[cluster], stats)
+        return True
+
+    def save(self, path, source_mtime=0.):
+        """Save the current statistics of all clusters, with the hash of
+        their spikes and the modification time of the waveforms file."""
+        index = self.cluster_index
+        with index.lock, self._lock:
+            items = [(cluster, index.get_fingerprint(cluster),
+                      self._get(cluster))
+                     for cluster in index.clusters_unique]
+        items = [item for item in items if item[2] is not None]
+        if not items:
+            return
+        log.debug("Saving the waveform statistics to {0:s}.".format(path))
+        np.savez(path,
+            source_mtime=np.array(source_mtime, dtype=np.float64),
+            clusters=np.array([cluster for cluster, _, _ in items],
+                              dtype=np.int64),
+            fingerprints=np.array([fingerprint
+                                   for _, fingerprint, _ in items],
+                                  dtype='S40'),
+            counts=np.array([stats[0] for _, _, stats in items]),
+            sums=np.array([stats[1] for _, _, stats in items]),
+            sums2=np.array([stats[2] for _, _, stats in items]),
+            sums_masks=np.array([stats[3] for _, _, stats in items]),
+            )
+
+    def load(self, path, source_mtime=0.):
+        """Load the statistics saved with the same modification time of the
+        waveforms file, for the clusters whose spikes have not changed.
+        Return the number of clusters loaded."""
+        if not os.path.exists(path):
+            return 0
+        try:
+            data = np.load(path)
+            try:
+                if float(data['source_mtime']) != source_mtime:
+                    return 0
+                arrays = [data[name] for name in ('clusters',
+                    'fingerprints', 'counts', 'sums', 'sums2',
+                    'sums_masks')]
+            finally:
+                data.close()
+        except Exception as e:
+            log.warn("Unable to load {0:s}: {1:s}.".format(path, str(e)))
+            return 0
+        index = self.cluster_index
+        loaded = 0
+        with index.lock, self._lock:
+            for cluster, fingerprint, count, sums, sums2, sums_masks in (
+                    zip(*arrays)):
+                generation = index.get_generation(cluster)
+                if index.get_fingerprint(cluster) != fingerprint.decode(
+                        'ascii'):
+                    continue
+                self._set(cluster, generation,
+                          (count, sums, sums2, sums_masks))
+                loaded += 1
+        return loaded
+
+    def cancel(self):
+        """Stop the computations in progress."""
+        self.cancelled = True
+
+    def merge(self, clusters, generations, cluster_merged):
+        """Combine the statistics of merged clusters, given their generation
+        before the merge."""
+        with self._lock:
+            stats = None
+            for cluster, generation in zip(clusters, generations):
+                item = self._stats.get((cluster, generation))
+                if item is None:
+                    return
+                stats = _add(stats, item)
+            if stats is not None:
+                self._set(cluster_merged,
+                    self.cluster_index.get_generation(cluster_merged), stats)
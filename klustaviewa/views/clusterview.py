@@ -89,6 +89,8 @@ class GroupItem(TreeItem):
 # ------------
 class ClusterViewModel(TreeModel):
     headers = ['Cluster', 'Quality', 'Spikes', 'Color']
+    # Columns of the cluster table used to sort every header column.
+    sort_keys = ['clusteridx', 'quality', 'spkcount', 'color']
     clustersMoved = QtCore.pyqtSignal(np.ndarray, int)
     
     def __init__(self, **kwargs):
@@ -103,6 +105,10 @@ class ClusterViewModel(TreeModel):
         """
         super(ClusterViewModel, self).__init__(self.headers)
         self.background = {}
+        # Items indexed by cluster and group index.
+        self.cluster_items = {}
+        self.group_items = {}
+        self.sort_column, self.sort_order = -1, QtCore.Qt.AscendingOrder
         self.load(**kwargs)
         
     
@@ -125,13 +131,7 @@ class ClusterViewModel(TreeModel):
         
         # go through all clusters
         for clusteridx, color in cluster_colors.iteritems():
-            if cluster_quality is not None:
-                try:
-                    quality = get_array(select(cluster_quality, clusteridx))[0]
-                except IndexError:
-                    quality = 0.
-            else:
-                quality = 0.
+            quality = self._get_quality(cluster_quality, clusteridx)
             # add cluster
             bgcolor = background.get(clusteridx, None)
             clusteritem = self.add_cluster(
@@ -145,6 +145,168 @@ class ClusterViewModel(TreeModel):
                 # assign the group as a parent of this cluster
                 parent=self.get_group(select(cluster_groups, clusteridx)))
     
+    def update(self, clusters, cluster_colors=None, cluster_groups=None,
+        group_colors=None, group_names=None, cluster_sizes=None,
+        cluster_quality=None, background=None):
+        """Update the groups and the specified clusters only, without
+        rebuilding the tree: the clusters which do not exist anymore are
+        removed, the new ones are inserted, and the other ones are updated
+        or moved to their new group. Return the added groups."""
+        if group_names is None or cluster_colors is None:
+            return []
+        # Groups.
+        groups_added = []
+        for groupidx, groupname in group_names.iteritems():
+            color = select(group_colors, groupidx)
+            group = self.group_items.get(groupidx)
+            if group is None:
+                groups_added.append(self.add_group_node(groupidx=groupidx,
+                    name=groupname, color=color, spkcount=0))
+            elif group.name() != groupname or group.color() != color:
+                group.item_data['name'] = groupname
+                group.item_data['color'] = color
+                self._emit_row_changed(group)
+        for groupidx in list(self.group_items.keys()):
+            if (groupidx not in group_names.index and
+                    not self.get_clusters_in_group(groupidx)):
+                self.remove_node(self.group_items.pop(groupidx))
+        # Clusters.
+        for clusteridx in clusters:
+            cluster = self.cluster_items.get(clusteridx)
+            # Removed cluster.
+            if clusteridx not in cluster_colors.index:
+                if cluster is not None:
+                    self.remove_cluster(cluster)
+                continue
+            groupidx = select(cluster_groups, clusteridx)
+            item_data = dict(
+                color=select(cluster_colors, clusteridx),
+                spkcount=select(cluster_sizes, clusteridx),
+                quality=self._get_quality(cluster_quality, clusteridx))
+            group = self.group_items[groupidx]
+            # New cluster.
+            if cluster is None:
+                self.add_cluster(clusteridx=clusteridx, parent=group,
+                    row=self._get_cluster_row(group, clusteridx),
+                    bgcolor=self.background.get(clusteridx, None),
+                    **item_data)
+                continue
+            # Moved cluster.
+            if cluster.parent() != group:
+                cluster = self._move_cluster(cluster, group,
+                    row=self._get_cluster_row(group, clusteridx))
+            # Updated cluster.
+            if any(cluster.item_data[key] != value
+                   for key, value in item_data.items()):
+                cluster.item_data.update(item_data)
+                self._emit_row_changed(cluster)
+        self.update_group_sizes()
+        # The inserted and moved clusters are sorted by index.
+        if self.sort_column >= 0:
+            self.sort(self.sort_column, self.sort_order)
+        return groups_added
+    
+    def _get_quality(self, cluster_quality, clusteridx):
+        if cluster_quality is None:
+            return 0.
+        try:
+            return get_array(select(cluster_quality, clusteridx))[0]
+        except IndexError:
+            return 0.
+    
+    def _get_cluster_row(self, group, clusteridx):
+        """Return the row where a cluster is inserted in a group, so that the
+        clusters remain sorted."""
+        for row, cluster in enumerate(group.children):
+            if cluster.clusteridx() > clusteridx:
+                return row
+        return group.rowCount()
+    
+    def _emit_row_changed(self, item):
+        index = self.get_index(item)
+        parent = self.get_index(item.parent())
+        self.dataChanged.emit(index,
+            self.index(index.row(), self.columnCount() - 1, parent=parent))
+    
+    
+    # Sort and filter methods
+    # -----------------------
+    def get_cluster_table(self):
+        """Return the cluster items and their fields as arrays, in the order
+        of the tree. The group rank is the row of the cluster's group."""
+        items, ranks = [], []
+        for rank, group in enumerate(self.get_groups()):
+            clusters = [cluster for cluster in group.children
+                if type(cluster) == ClusterItem]
+            items.extend(clusters)
+            ranks.extend([rank] * len(clusters))
+        table = dict(items=np.empty(len(items), dtype=object),
+            grouprank=np.array(ranks, dtype=np.int32),
+            groupidx=np.array([item.parent().groupidx() for item in items],
+                dtype=np.int32))
+        table['items'][:] = items
+        for key in self.sort_keys:
+            table[key] = np.array([item.item_data[key] for item in items],
+                dtype=np.float64)
+        return table
+    
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        """Sort the clusters within every group, with a single permutation
+        of the cluster table."""
+        self.sort_column, self.sort_order = column, order
+        if not (0 <= column < len(self.sort_keys)):
+            return
+        table = self.get_cluster_table()
+        if len(table['items']) == 0:
+            return
+        keys = table[self.sort_keys[column]]
+        if order != QtCore.Qt.AscendingOrder:
+            keys = -keys
+        # Sort by group first, so that the groups keep their order.
+        permutation = np.lexsort((keys, table['grouprank']))
+        items = table['items'][permutation]
+        self.layoutAboutToBeChanged.emit()
+        indexes = self.persistentIndexList()
+        bounds = np.searchsorted(table['grouprank'][permutation],
+            np.arange(len(self.get_groups()) + 1))
+        for rank, group in enumerate(self.get_groups()):
+            others = [child for child in group.children
+                if type(child) != ClusterItem]
+            group.children = (list(items[bounds[rank]:bounds[rank + 1]]) +
+                              others)
+        # Move the persistent indices (selection, current item) along with
+        # their items.
+        rows = {}
+        for group in self.get_groups():
+            for row, child in enumerate(group.children):
+                rows[id(child)] = row
+        indexes_new = []
+        for index in indexes:
+            item = index.internalPointer()
+            if type(item) == ClusterItem and id(item) in rows:
+                indexes_new.append(self.createIndex(rows[id(item)],
+                    index.column(), item))
+            else:
+                indexes_new.append(index)
+        self.changePersistentIndexList(indexes, indexes_new)
+        self.layoutChanged.emit()
+    
+    def get_hidden_clusters(self, quality_min=None, quality_max=None,
+        spkcount_min=None, spkcount_max=None):
+        """Return the items of the clusters outside the specified quality and
+        size ranges."""
+        table = self.get_cluster_table()
+        keep = np.ones(len(table['items']), dtype=np.bool_)
+        if quality_min is not None:
+            keep &= table['quality'] >= quality_min
+        if quality_max is not None:
+            keep &= table['quality'] <= quality_max
+        if spkcount_min is not None:
+            keep &= table['spkcount'] >= spkcount_min
+        if spkcount_max is not None:
+            keep &= table['spkcount'] <= spkcount_max
+        return list(table['items'][~keep])
+    
     
     # Data methods
     # ------------
@@ -285,7 +447,8 @@ class ClusterViewModel(TreeModel):
         for group in self.get_groups():
             spkcount = np.sum([cluster.spkcount() 
                 for cluster in self.get_clusters_in_group(group.groupidx())])
-            self.setData(self.index(group.row(), 2), spkcount)
+            if spkcount != group.spkcount():
+                self.setData(self.index(group.row(), 2), spkcount)
     
     def set_quality(self, quality):
         """quality is a Series with cluster index and quality value."""
@@ -296,7 +459,7 @@ class ClusterViewModel(TreeModel):
                 continue
             group = self.get_group(groupidx)
             cluster = self.get_cluster(clusteridx)
-            self.setData(self.index(cluster.row(), 1, parent=group.index), value)
+            self.setData(self.index(cluster.row(), 1, parent=self.get_index(group)), value)
     
     def set_background(self, background=None):
         """Set the background of some clusters. The argument is a dictionary
@@ -321,8 +484,8 @@ class ClusterViewModel(TreeModel):
                 continue
             group = self.get_group(groupidx)
             cluster = self.get_cluster(clusteridx)
-            index = self.index(cluster.row(), 0, parent=group.index)
-            index1 = self.index(cluster.row(), 1, parent=group.index)
+            index = self.index(cluster.row(), 0, parent=self.get_index(group))
+            index1 = self.index(cluster.row(), 1, parent=self.get_index(group))
             if index.isValid():
                 item = index.internalPointer()
                 # bgcolor = True means using the same color
@@ -343,7 +506,9 @@ class ClusterViewModel(TreeModel):
         return groupitem
         
     def add_group_node(self, **kwargs):
-        return self.add_node(item_class=GroupItem, **kwargs)
+        group = self.add_node(item_class=GroupItem, **kwargs)
+        self.group_items[group.groupidx()] = group
+        return group
         
     def remove_group(self, group):
         """Remove an empty group. Raise an error if the group is not empty."""
@@ -356,14 +521,20 @@ class ClusterViewModel(TreeModel):
         if groups:
             group = groups[0]
             self.remove_node(group)
+            del self.group_items[groupidx]
         else:
             log.warn("Group %d does not exist0" % groupidx)
         
     def add_cluster(self, parent=None, **kwargs):
         cluster = self.add_node(item_class=ClusterItem, parent=parent, 
                             **kwargs)
+        self.cluster_items[cluster.clusteridx()] = cluster
         return cluster
     
+    def remove_cluster(self, cluster):
+        self.remove_node(cluster)
+        del self.cluster_items[cluster.clusteridx()]
+    
     def move_clusters(self, sources, target):
         # Get the groupidx if the target is a group,
         if type(target) == GroupItem:
@@ -382,23 +553,29 @@ class ClusterViewModel(TreeModel):
         
         self.update_group_sizes()
     
-    def _move_cluster(self, cluster, parent_target, child_target=None):
+    def _move_cluster(self, cluster, parent_target, child_target=None,
+                      row=None):
+        """Move a cluster before child_target, at the specified row, or at
+        the end of the target group, and return the new cluster item."""
+        child_target_row = row
         row = cluster.row()
         parent_source = cluster.parent()
         # Find the row where the cluster needs to be inserted.
         if child_target is not None:
             child_target_row = child_target.row()
-        else:
+        elif child_target_row is None:
             child_target_row = parent_target.rowCount()
         # Begin moving the row.
-        canmove = self.beginMoveRows(parent_source.index, row, row,
-            parent_target.index, child_target_row)
+        canmove = self.beginMoveRows(self.get_index(parent_source), row, row,
+            self.get_index(parent_target), child_target_row)
         if canmove:
             # Create a new cluster, clone of the old one.
             cluster_new = ClusterItem(parent=parent_target,
                 clusteridx=cluster.clusteridx(),
                 spkcount=cluster.spkcount(),
-                color=cluster.color())
+                color=cluster.color(),
+                quality=cluster.quality(),
+                bgcolor=cluster.bgcolor)
             # Create the index.
             cluster_new.index = self.createIndex(child_target_row, 
                 0, cluster_new)
@@ -412,6 +589,9 @@ class ClusterViewModel(TreeModel):
             else:
                 parent_source.removeChild(cluster)
             self.endMoveRows()
+            self.cluster_items[cluster_new.clusteridx()] = cluster_new
+            return cluster_new
+        return cluster
         
     
     # Drag and drop for moving clusters
@@ -440,45 +620,38 @@ class ClusterViewModel(TreeModel):
     def change_cluster_color(self, cluster, color):
         groupidx = self.get_groupidx(cluster.clusteridx())
         group = self.get_group(groupidx)
-        self.setData(self.index(cluster.row(), 2, parent=group.index), color)
+        self.setData(self.index(cluster.row(), 2, parent=self.get_index(group)), color)
         
         
     # Getter methods
     # --------------
     def get_groups(self):
-        return [group for group in self.get_descendants(self.root_item) \
+        return [group for group in self.root_item.children \
             if (type(group) == GroupItem)]
         
     def get_group(self, groupidx):
-        return [group for group in self.get_descendants(self.root_item) \
-            if (type(group) == GroupItem) and \
-                (group.groupidx() == groupidx)][0]
+        return self.group_items.get(groupidx)
         
     def get_clusters(self):
-        return [cluster for cluster in self.get_descendants(self.root_item) \
-          if (type(cluster) == ClusterItem)]
+        return [cluster for group in self.get_groups() \
+            for cluster in group.children \
+                if (type(cluster) == ClusterItem)]
             
     def get_cluster(self, clusteridx):
-        l = [cluster for cluster in self.get_descendants(self.root_item) \
-                  if (type(cluster) == ClusterItem) and \
-                        (cluster.clusteridx() == clusteridx)]
-        if l:
-            return l[0]
+        return self.cluster_items.get(clusteridx)
                 
     def get_clusters_in_group(self, groupidx):
         group = self.get_group(groupidx)
-        return [cluster for cluster in self.get_descendants(group) \
+        return [cluster for cluster in group.children \
             if (type(cluster) == ClusterItem)]
         
     def get_groupidx(self, clusteridx):
         """Return the group index currently assigned to the specifyed cluster
         index."""
-        for group in self.get_groups():
-            clusterindices = [cluster.clusteridx() \
-                            for cluster in self.get_clusters_in_group(group.groupidx())]
-            if clusteridx in clusterindices:
-                return group.groupidx()
-        return None
+        cluster = self.get_cluster(clusteridx)
+        if cluster is None:
+            return None
+        return cluster.parent().groupidx()
           
         
 # Top-level widget
@@ -536,6 +709,11 @@ class ClusterView(QtGui.QTreeView):
         # self.setRootIsDecorated(False)
         self.setItemDelegate(self.ClusterDelegate())
         
+        # Sorting is done by the model, by cluster index by default.
+        self.cluster_filter = {}
+        self.header().setSortIndicator(0, QtCore.Qt.AscendingOrder)
+        self.setSortingEnabled(True)
+        
         # Create menu.
         self.create_actions()
         self.create_context_menu()
@@ -566,8 +744,23 @@ class ClusterView(QtGui.QTreeView):
         # in this function
         self.model.clustersMoved.connect(self.move_clusters)
         
+        if self.cluster_filter:
+            self.apply_filter()
+        
+    def update_data(self, clusters, **kwargs):
+        """Update the specified clusters and the groups in the current model,
+        keeping the selection and the expanded groups."""
+        if not isinstance(getattr(self, 'model', None), ClusterViewModel):
+            return self.set_data(**kwargs)
+        groups_added = self.model.update(clusters, **kwargs)
+        for group in groups_added:
+            self.expand(self.model.get_index(group))
+        if self.cluster_filter:
+            self.apply_filter()
+        
     def clear(self):
-        self.setModel(ClusterViewModel())
+        self.model = ClusterViewModel()
+        self.setModel(self.model)
         
         
     
@@ -595,12 +788,14 @@ class ClusterView(QtGui.QTreeView):
         for groupidx in groups:
             group = self.model.get_group(groupidx)
             if group is not None:
-                selection.select(group.index, group.index)
+                index = self.model.get_index(group)
+                selection.select(index, index)
         # Select clusters.
         for clusteridx in clusters:
             cluster = self.model.get_cluster(clusteridx)
             if cluster is not None:
-                selection.select(cluster.index, cluster.index)
+                index = self.model.get_index(cluster)
+                selection.select(index, index)
         # Process selection.
         selection_model.select(selection, 
                 selection_model.Clear |
@@ -613,10 +808,10 @@ class ClusterView(QtGui.QTreeView):
             if cluster is not None:
                 # Set current index in the selection.
                 selection_model.setCurrentIndex(
-                    cluster.index,
+                    self.model.get_index(cluster),
                     QtGui.QItemSelectionModel.NoUpdate)
                 # Scroll to that cluster.
-                self.scrollTo(cluster.index)
+                self.scrollTo(self.model.get_index(cluster))
                     
     def unselect(self):
         self.selectionModel().clear()
@@ -693,6 +888,24 @@ class ClusterView(QtGui.QTreeView):
     def set_background(self, background=None):
         self.model.set_background(background)
     
+    def set_filter(self, **kwargs):
+        """Only show the clusters in the specified quality and size ranges,
+        with the keyword arguments of ClusterViewModel.get_hidden_clusters.
+        No keyword argument shows all clusters."""
+        filtered = bool(self.cluster_filter)
+        self.cluster_filter = dict((key, value)
+            for key, value in kwargs.items() if value is not None)
+        if filtered or self.cluster_filter:
+            self.apply_filter()
+    
+    def apply_filter(self):
+        hidden = set([id(cluster) for cluster in
+            self.model.get_hidden_clusters(**self.cluster_filter)])
+        for cluster in self.model.get_clusters():
+            index = self.model.get_index(cluster)
+            self.setRowHidden(index.row(), index.parent(),
+                id(cluster) in hidden)
+    
     
     # Menu methods
     # ------------
@@ -901,9 +1114,10 @@ class ClusterView(QtGui.QTreeView):
             # self.scrollTo(group_indices[-1].index)
         if len(self.clusters_selected_previous) <= 1:
             if len(clusters) == 1:
-                self.scrollTo(self.model.get_cluster(clusters[0]).index)
+                self.scrollTo(self.model.get_index(
+                    self.model.get_cluster(clusters[0])))
             elif len(group_indices) == 1:
-                self.scrollTo(group_indices[0].index)
+                self.scrollTo(self.model.get_index(group_indices[0]))
     
         self.wizard = False
         self.clusters_selected_previous = clusters
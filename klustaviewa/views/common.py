@@ -3,6 +3,7 @@ import operator
 import collections
 
 from galry import *
+from galry.glrenderer import Attribute
 
 
 __all__ = [
@@ -10,6 +11,34 @@ __all__ = [
            ]
 
 
+def set_attribute_ranges(paint_manager, visual, name, data, ranges):
+    """Upload only some ranges of rows of an attribute of a visual, when the
+    other rows are already up to date on the GPU. The whole attribute is
+    uploaded at the next paint otherwise."""
+    renderer = getattr(paint_manager, 'renderer', None)
+    visual_renderer = (renderer.visual_renderers.get(visual)
+        if renderer is not None else None)
+    variable = (visual_renderer.get_variable(name)
+        if visual_renderer is not None else None)
+    olddata = variable.get('data', None) if variable is not None else None
+    if (getattr(olddata, 'shape', None) != data.shape or
+        name in visual_renderer.data_updating or
+        variable['sliced_attribute'].location < 0):
+        paint_manager.set_data(visual=visual, **{name: data})
+        return
+    paint_manager.parent.makeCurrent()
+    variable['data'] = data
+    attribute = variable['sliced_attribute']
+    # The attribute is split in several buffers.
+    for buffer, (pos, size) in zip(attribute.buffers,
+                                   attribute.slicer.slices):
+        for start, stop in ranges:
+            start, stop = max(start, pos), min(stop, pos + size)
+            if start < stop:
+                Attribute.bind(buffer, attribute.location)
+                Attribute.update(data[start:stop, ...], start - pos)
+
+
 class HighlightManager(Manager):
     
     highlight_rectangle_color = (0.75, 0.75, 1., .25)
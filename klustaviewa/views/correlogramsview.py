@@ -35,39 +35,45 @@ VERTEX_SHADER = """
 # -----------------------------------------------------------------------------
 # Utility functions
 # -----------------------------------------------------------------------------
-def get_histogram_points(hist):
+def get_histogram_x(nsamples):
+    """Return the X coordinates of the 5*Nsamples+1 vertices of a
+    tesselated histogram, which are the same for all histograms."""
+    dx = 2. / nsamples
+    x0 = -1 + dx * np.arange(nsamples)
+    x = np.empty(5 * nsamples + 1, dtype=np.float32)
+    x[0:-1:5] = x0
+    x[1::5] = x0
+    x[2::5] = x0 + dx
+    x[3::5] = x0
+    x[4::5] = x0 + dx
+    x[-1] = 1
+    return x
+
+def get_histogram_points(hist, position=None):
     """Tesselates correlograms.
     
     Arguments:
       * hist: a N x Nsamples array, where each line contains an histogram.
+      * position: the array returned by a previous call with histograms
+        of the same shape, where only the Y coordinates are updated.
       
     Returns:
-      * X, Y: two N x (5*Nsamples+1) arrays with the coordinates of the
-        correlograms, a
+      * position: a N*(5*Nsamples+1) x 2 float32 array with the coordinates
+        of the correlograms.
       
     """
     if hist.size == 0:
-        return np.array([[]]), np.array([[]])
+        return np.zeros((0, 2), dtype=np.float32)
     n, nsamples = hist.shape
-    dx = 2. / nsamples
-    
-    x0 = -1 + dx * np.arange(nsamples)
-    
-    x = np.zeros((n, 5 * nsamples + 1))
-    # y = -np.ones((n, 5 * nsamples + 1))
-    y = np.zeros((n, 5 * nsamples + 1))
-    
-    x[:,0:-1:5] = x0
-    x[:,1::5] = x0
-    x[:,2::5] = x0 + dx
-    x[:,3::5] = x0
-    x[:,4::5] = x0 + dx
-    x[:,-1] = 1
-    
-    y[:,1::5] = hist
-    y[:,2::5] = hist
-    
-    return x, y
+    nvertices = 5 * nsamples + 1
+    if position is None:
+        position = np.zeros((n * nvertices, 2), dtype=np.float32)
+        position.reshape((n, nvertices, 2))[:, :, 0] = get_histogram_x(
+            nsamples)
+    y = position.reshape((n, nvertices, 2))[:, :, 1]
+    y[:, 1::5] = hist
+    y[:, 2::5] = hist
+    return position
 
     
 # -----------------------------------------------------------------------------
@@ -93,12 +99,14 @@ class CorrelogramsDataManager(Manager):
             # clusters_selected=clusters_selected, ncorrbins=ncorrbins)
         self.correlograms = correlograms
         
-        # Copy the original arrays for normalization.
-        self.baselines = baselines
-        self.baselines0 = baselines.copy()
+        # Keep the original arrays for normalization, the normalized arrays
+        # are written in separate buffers.
+        self.baselines0 = np.asarray(baselines, dtype=np.float64)
+        self.baselines = np.empty_like(self.baselines0)
         
-        self.correlograms_array = correlograms.to_array()
-        self.correlograms_array0 = self.correlograms_array.copy()
+        self.correlograms_array0 = correlograms.to_array()
+        self.correlograms_array = np.empty(self.correlograms_array0.shape)
+        self.position = None
         
         nclusters, nclusters, self.nbins = self.correlograms_array.shape
         self.ncorrelograms = nclusters * nclusters
@@ -156,39 +164,39 @@ class CorrelogramsDataManager(Manager):
             self.nsamples, axis=0)
         
     def normalize(self, normalization='row'):
-        self.correlograms_array = self.correlograms_array0.copy()
-        self.baselines = self.baselines0.copy()
-        if normalization == 'row':
-            # normalization
-            for i in range(self.nclusters):
-                # divide all correlograms in the row by the max of this histogram
-                correlogram_diagonal = self.correlograms_array[i, i, ...]
-                m = correlogram_diagonal.max()
-                if m > 0:
-                    self.correlograms_array[i,:,:] /= m
-                    self.baselines[i,:] /= m
-                # normalize all correlograms in the row so that they all fit in the 
-                # window
-                m = self.correlograms_array[i,:,:].max()
-                if m > 0:
-                    self.correlograms_array[i,:,:] /= m
-                    self.baselines[i,:] /= m
-        elif normalization == 'uniform':
-            M = self.correlograms_array.max(axis=2)
-            self.correlograms_array /= M.reshape(
-                (self.nclusters, self.nclusters, 1))
-            self.baselines /= M
+        """Normalize the correlograms and the baselines in a single pass, and
+        update the Y coordinates of the vertices."""
+        correlograms, baselines = (self.correlograms_array0,
+                                   self.baselines0)
+        n = self.nclusters
+        if normalization == 'row' and n > 0:
+            # Divide all correlograms in a row by the max of the
+            # autocorrelogram, then so that they all fit in the window.
+            m0 = correlograms[np.arange(n), np.arange(n), :].max(axis=1)
+            m0[m0 <= 0] = 1.
+            m1 = correlograms.reshape((n, -1)).max(axis=1) / m0
+            m1[m1 <= 0] = 1.
+            scale = 1. / (m0 * m1)
+            np.multiply(correlograms, scale.reshape((n, 1, 1)),
+                        out=self.correlograms_array)
+            np.multiply(baselines, scale.reshape((n, 1)), out=self.baselines)
+        elif normalization == 'uniform' and n > 0:
+            M = correlograms.max(axis=2)
+            M[M <= 0] = 1.
+            np.divide(correlograms, M.reshape((n, n, 1)),
+                      out=self.correlograms_array)
+            np.divide(baselines, M, out=self.baselines)
+        else:
+            self.correlograms_array[...] = correlograms
+            self.baselines[...] = baselines
     
         # get the vertex positions
-        X, Y = get_histogram_points(self.correlograms_array.reshape(
-            (self.ncorrelograms, self.nbins)))
-        n = X.size
-        self.nsamples = X.shape[1]
-        
-        # fill the data array
-        self.position = np.empty((n, 2), dtype=np.float32)
-        self.position[:,0] = X.ravel()
-        self.position[:,1] = Y.ravel()
+        self.position = get_histogram_points(self.correlograms_array.reshape(
+            (self.ncorrelograms, self.nbins)), self.position)
+        if self.ncorrelograms > 0:
+            self.nsamples = self.position.shape[0] // self.ncorrelograms
+        else:
+            self.nsamples = 0
         
      
 # -----------------------------------------------------------------------------
@@ -372,6 +380,17 @@ class CorrelogramsPaintManager(PlotPaintManager):
             visual='ticks')
             
 
+    def update_normalization(self):
+        """Only update the vertex positions and the baselines."""
+        self.set_data(position=self.data_manager.position,
+            visual='correlograms')
+        self.reinitialize_visual(
+            baselines=self.data_manager.baselines,
+            nclusters=self.data_manager.nclusters,
+            clusters=self.data_manager.clusters0,
+            visual='baselines')
+            
+
 # -----------------------------------------------------------------------------
 # Interaction
 # -----------------------------------------------------------------------------
@@ -439,7 +458,7 @@ class CorrelogramsInteractionManager(PlotInteractionManager):
                 len(self.normalization_list))
             normalization = self.normalization_list[self.normalization_index]
         self.data_manager.normalize(normalization)
-        self.paint_manager.update()
+        self.paint_manager.update_normalization()
         self.parent.updateGL()
     
         
@@ -13,11 +13,14 @@ from qtools import QtGui, QtCore, show_window
 from galry import (Manager, PlotPaintManager, PlotInteractionManager, Visual,
     GalryWidget, enforce_dtype, RectanglesVisual,
     TextVisual, PlotVisual, AxesVisual, GridVisual, NavigationEventProcessor,
-    EventProcessor, DataNormalizer)
+    EventProcessor, DataNormalizer, TextureVisual)
 
 from kwiklib.dataio.selection import get_indices, select
 from kwiklib.dataio.tools import get_array
-from klustaviewa.views.common import HighlightManager, KlustaViewaBindings, KlustaView
+from klustaviewa.views.common import (HighlightManager, KlustaViewaBindings,
+    KlustaView, set_attribute_ranges)
+from klustaviewa.views.trackedmask import TrackedMask
+from klustaviewa.views.gridindex import GridIndex
 from kwiklib.utils.colors import COLORMAP_TEXTURE, SHIFTLEN, COLORMAP
 from klustaviewa import USERPREF
 from kwiklib.utils import logger as log
@@ -87,25 +90,45 @@ FRAGMENT_SHADER_BACKGROUND = """
 # -----------------------------------------------------------------------------
 # Utility functions
 # -----------------------------------------------------------------------------
-def polygon_contains_points(polygon, points):
-    """Returns the points within a polygon.
+# Size of the density image of the background spikes.
+DENSITY_SIZE = 512
+# Color of the density image.
+DENSITY_COLOR = (.75, .75, .75)
+
+def get_density_image(points, size=DENSITY_SIZE):
+    """Bin 2D points into a log-scaled histogram.
 
     Arguments:
-      * polygon: a Nx2 array with the coordinates of the polygon vertices.
       * points: a Nx2 array with the coordinates of the points.
+      * size: the number of bins along each axis.
 
     Returns:
-      * arr: a Nx2 array of booleans with the belonging of every point to
-        the inside of the polygon.
+      * image: a (size, size) array with values in [0, 1], the first row
+        being at the top.
+      * extent: the (x0, y0, x1, y1) coordinates covered by the image.
 
     """
-    try:
-        from matplotlib.path import Path
-        p = Path(polygon)
-        return p.contains_points(points)
-    except:
-        import matplotlib.nxutils
-        return matplotlib.nxutils.points_inside_poly(points, polygon)
+    points = points[np.isfinite(points).all(axis=1)]
+    if len(points) == 0:
+        return np.zeros((size, size)), (-1., -1., 1., 1.)
+    pmin = points.min(axis=0).astype(np.float64)
+    pmax = points.max(axis=0).astype(np.float64)
+    pmax[pmax <= pmin] = pmin[pmax <= pmin] + 1.
+    bins = ((points - pmin) * (size / (pmax - pmin))).astype(np.int64)
+    np.clip(bins, 0, size - 1, out=bins)
+    counts = np.bincount((size - 1 - bins[:, 1]) * size + bins[:, 0],
+                         minlength=size * size).reshape((size, size))
+    image = np.log1p(counts)
+    image *= 1. / image.max()
+    return image, (pmin[0], pmin[1], pmax[0], pmax[1])
+
+def get_density_texture(image, color=DENSITY_COLOR, alpha=1.):
+    """Return a RGBA uint8 texture with a uniform color and an opacity
+    proportional to the density image."""
+    texture = np.empty(image.shape + (4,), dtype=np.uint8)
+    texture[..., :3] = np.array(color) * 255
+    texture[..., 3] = image * (alpha * 255)
+    return texture
 
 
 # -----------------------------------------------------------------------------
@@ -305,37 +328,40 @@ class FeatureDataManager(Manager):
         # > features_nspikes_per_cluster_max spikes ==> take a selection
         nspikes_max = USERPREF.get('features_nspikes_per_cluster_max', 1000)
         k = self.nspikes_full // nspikes_max + 1
-        # self.features = features[::k]
+        # The subset is a view on the full array, not a copy.
         subsel = slice(None, None, k)
-        self.features = select(features, subsel)
-        self.features_array = get_array(self.features)
+        self.subsel = subsel
+        self.features_array = self.features_full_array[subsel]
 
         # self.features_background contains all non-selected spikes
         self.features_background = features_background
         self.features_background_array = get_array(self.features_background)
 
         # Background spikes are those which do not belong to the selected clusters
-        self.npoints_background = self.features_background_array.shape[0]
-        self.nspikes_background = self.npoints_background
+        self.nspikes_background = self.features_background_array.shape[0]
+        # Only a subset of them is shown as points, but all of them are
+        # used in the density image.
+        nspikes_max = USERPREF.get('features_nspikes_background_max', 10000)
+        k = int(np.ceil(self.nspikes_background / float(nspikes_max))) or 1
+        self.subsel_background = slice(None, None, k)
+        self.npoints_background = len(
+            self.features_background_array[self.subsel_background])
 
         if channels is None:
             channels = range(nchannels)
 
-        self.nspikes, self.ndim = self.features.shape
+        self.nspikes, self.ndim = self.features_array.shape
         self.fetdim = fetdim
         self.nchannels = nchannels
         self.channels = channels
         self.nextrafet = nextrafet
-        self.npoints = self.features.shape[0]
+        self.npoints = self.features_array.shape[0]
 
         if masks is None:
-            masks = np.ones_like(self.features, dtype=np.float32)
-        self.masks = masks
-
+            masks = np.ones((self.nspikes_full, nchannels), dtype=np.float32)
 
         # Subselection
-        self.masks = select(self.masks, subsel)
-        self.masks_array = get_array(self.masks)
+        self.masks_array = get_array(masks)[subsel]
         if self.masks_array.ndim == 1:
             self.masks_array = self.masks_array[:, np.newaxis]
         if self.spiketimes is not None:
@@ -343,9 +369,8 @@ class FeatureDataManager(Manager):
         self.clusters = select(self.clusters, subsel)
         self.clusters_array = get_array(self.clusters)
 
-
-        self.feature_indices = get_indices(self.features)
         self.feature_full_indices = get_indices(self.features_full)
+        self.feature_indices = self.feature_full_indices[subsel]
         self.feature_indices_array = get_array(self.feature_indices)
 
         self.cluster_colors = get_array(cluster_colors, dosort=True)
@@ -369,6 +394,11 @@ class FeatureDataManager(Manager):
         self.data_full = np.empty((self.nspikes_full, 2), dtype=np.float32)
         self.data_background = np.empty((self.nspikes_background, 2),
             dtype=np.float32)
+        self.invalidate_grid_index()
+        # Feature columns of the projection, and density textures of the
+        # background spikes for every projection.
+        self.projection_columns = [None, None]
+        self.density_cache = {}
 
         # set initial projection
         self.projection_manager.set_data()
@@ -383,6 +413,37 @@ class FeatureDataManager(Manager):
         self.selection_manager.initialize()
         self.selection_manager.cancel_selection()
 
+    # Spatial index
+    # -------------
+    def invalidate_grid_index(self):
+        """Called when the projection changes: the indices are built again
+        at the next query."""
+        self.grid_index = None
+        self.grid_index_full = None
+
+    def get_grid_index(self, full=False):
+        """Return the grid index of the displayed spikes, or of all spikes
+        if full is True."""
+        if full:
+            if self.grid_index_full is None:
+                self.grid_index_full = GridIndex(self.data_full)
+            return self.grid_index_full
+        if self.grid_index is None:
+            self.grid_index = GridIndex(self.data)
+        return self.grid_index
+
+    # Background density
+    # ------------------
+    def get_background_density(self):
+        """Return the density texture of the background spikes in the
+        current projection, and its extent."""
+        key = tuple(self.projection_columns)
+        if key not in self.density_cache:
+            image, extent = get_density_image(self.data_background)
+            self.density_cache[key] = (get_density_texture(image,
+                alpha=self.alpha_background), extent)
+        return self.density_cache[key]
+
 
 # -----------------------------------------------------------------------------
 # Visuals
@@ -487,13 +548,46 @@ class FeaturePaintManager(PlotPaintManager):
     def update_points(self):
         self.set_data(position0=self.data_manager.data,
             mask=self.data_manager.masks_full, visual='features')
-
-        self.set_data(position0=self.data_manager.data_background,
-            visual='features_background')
+        self.update_background()
+
+    def update_background(self):
+        """Show the background spikes either as points, or as a density
+        image which does not depend on the number of background spikes."""
+        if self.background_density:
+            texture, extent = self.data_manager.get_background_density()
+            self.set_data(visual='features_density',
+                texture=texture,
+                points=extent,
+                visible=self.toggle_background_value == 1)
+            self.set_data(visual='features_background', visible=False)
+        else:
+            self.set_data(visual='features_background',
+                size=self.data_manager.npoints_background,
+                position0=self.data_manager.data_background[
+                    self.data_manager.subsel_background],
+                alpha=(self.toggle_background_value *
+                       self.data_manager.alpha_background),
+                visible=True)
+            self.set_data(visual='features_density', visible=False)
 
     def initialize(self):
         self.toggle_mask_value = False
         self.toggle_background_value = 1
+        self.background_density = USERPREF.get('features_background_density',
+                                               False)
+
+        # The density image is drawn first, as there is no depth test.
+        if self.background_density:
+            texture, extent = self.data_manager.get_background_density()
+        else:
+            texture = np.zeros((DENSITY_SIZE, DENSITY_SIZE, 4),
+                               dtype=np.uint8)
+            extent = (-1., -1., 1., 1.)
+        self.add_visual(TextureVisual, name='features_density',
+            texture=texture,
+            points=extent,
+            visible=self.background_density,
+            )
 
         self.add_visual(FeatureVisual, name='features',
             npoints=self.data_manager.npoints,
@@ -511,10 +605,17 @@ class FeaturePaintManager(PlotPaintManager):
         self.add_visual(AxesVisual, name='axes')
         self.add_visual(GridVisual, name='grid', visible=False)
 
+        # The background points are only uploaded in points mode.
+        if self.background_density:
+            data_background = np.zeros((0, 2), dtype=np.float32)
+        else:
+            data_background = self.data_manager.data_background[
+                self.data_manager.subsel_background]
         self.add_visual(FeatureBackgroundVisual, name='features_background',
-            npoints=self.data_manager.npoints_background,
-            position0=self.data_manager.data_background,
+            npoints=len(data_background),
+            position0=data_background,
             alpha=self.data_manager.alpha_background,
+            visible=not(self.background_density),
             )
 
         # Projections.
@@ -592,11 +693,7 @@ class FeaturePaintManager(PlotPaintManager):
             alpha=self.data_manager.alpha_selected,
             )
 
-        self.set_data(visual='features_background',
-            size=self.data_manager.npoints_background,
-            position0=self.data_manager.data_background,
-            alpha=self.toggle_background_value * self.data_manager.alpha_background,
-            )
+        self.update_background()
 
     def set_wizard_pair(self, target=None, candidate=None):
         # Display target.
@@ -633,8 +730,16 @@ class FeaturePaintManager(PlotPaintManager):
 
     def toggle_background(self):
         self.toggle_background_value = 1 - self.toggle_background_value
-        self.set_data(visual='features_background',
-            alpha=self.toggle_background_value * self.data_manager.alpha_background)
+        if self.background_density:
+            self.set_data(visual='features_density',
+                visible=self.toggle_background_value == 1)
+        else:
+            self.set_data(visual='features_background',
+                alpha=self.toggle_background_value * self.data_manager.alpha_background)
+
+    def toggle_background_density(self):
+        self.background_density = not(self.background_density)
+        self.update_background()
 
 
 # -----------------------------------------------------------------------------
@@ -645,8 +750,8 @@ class FeatureHighlightManager(HighlightManager):
         super(FeatureHighlightManager, self).initialize()
         self.feature_indices = self.data_manager.feature_indices
         self.feature_indices_array = self.data_manager.feature_indices_array
-        self.highlight_mask = np.zeros(self.data_manager.nspikes,
-            dtype=np.int32)
+        self.highlight_tracker = TrackedMask(self.data_manager.nspikes)
+        self.highlight_mask = self.highlight_tracker.mask
         self.highlighted_spikes = []
         self.is_highlighting = False
 
@@ -660,33 +765,18 @@ class FeatureHighlightManager(HighlightManager):
         xmin, xmax = min(x0, x1), max(x0, x1)
         ymin, ymax = min(y0, y1), max(y0, y1)
 
-        features = self.data_manager.data
-        masks = self.data_manager.masks_full
-
-        indices = (
-                  # (masks > 0) & \
-                  (features[:,0] >= xmin) & (features[:,0] <= xmax) & \
-                  (features[:,1] >= ymin) & (features[:,1] <= ymax))
-        spkindices = np.nonzero(indices)[0]
-        spkindices = np.unique(spkindices)
-        return spkindices
+        return self.data_manager.get_grid_index().query_box(
+            xmin, ymin, xmax, ymax)
 
     def set_highlighted_spikes(self, spikes):
         """Update spike colors to mark transiently selected spikes with
         a special color."""
-        if len(spikes) == 0:
-            # do update only if there were previously selected spikes
-            do_update = len(self.highlighted_spikes) > 0
-            self.highlight_mask[:] = 0
-        else:
-            do_update = True
-            self.highlight_mask[:] = 0
-            if len(spikes) > 0:
-                self.highlight_mask[spikes] = 1
-
-        if do_update:
-            self.paint_manager.set_data(
-                highlight=self.highlight_mask, visual='features')
+        # only upload the ranges of spikes which have changed
+        self.highlight_tracker.set(spikes)
+        ranges = self.highlight_tracker.pop_dirty_ranges()
+        if ranges:
+            set_attribute_ranges(self.paint_manager, 'features', 'highlight',
+                self.highlight_mask, ranges)
 
         self.highlighted_spikes = spikes
         self.is_highlighting = True
@@ -746,24 +836,19 @@ class FeatureSelectionManager(Manager):
                                     visible=False,
                                     name='selection_polygon')
         self.feature_indices = self.data_manager.feature_full_indices
-        self.selection_mask = np.zeros(self.data_manager.nspikes, dtype=np.int32)
+        self.selection_tracker = TrackedMask(self.data_manager.nspikes)
+        self.selection_mask = self.selection_tracker.mask
         self.selected_spikes = []
 
     def set_selected_spikes(self, spikes):
         """Update spike colors to mark transiently selected spikes with
         a special color."""
-        if len(spikes) == 0:
-            # do update only if there were previously selected spikes
-            do_update = len(self.selected_spikes) > 0
-            self.selection_mask[:] = 0
-        else:
-            do_update = True
-            self.selection_mask[:] = 0
-            self.selection_mask[spikes] = 1
-
-        if do_update:
-            self.paint_manager.set_data(
-                selection=self.selection_mask, visual='features')
+        # only upload the ranges of spikes which have changed
+        self.selection_tracker.set(spikes)
+        ranges = self.selection_tracker.pop_dirty_ranges()
+        if ranges:
+            set_attribute_ranges(self.paint_manager, 'features', 'selection',
+                self.selection_mask, ranges)
 
         self.selected_spikes = spikes
 
@@ -779,17 +864,10 @@ class FeatureSelectionManager(Manager):
         transformed coordinates)."""
         if polygon is None:
             polygon = self.polygon()
-        features = self.data_manager.data
-        features_full = self.data_manager.data_full
-
-        indices = polygon_contains_points(polygon, features)
-        spkindices = np.nonzero(indices)[0]
-        spkindices = np.unique(spkindices)
-
-        indices_full = polygon_contains_points(polygon, features_full)
-        spkindices_full = np.nonzero(indices_full)[0]
-        spkindices_full = np.unique(spkindices_full)
-
+        spkindices = self.data_manager.get_grid_index().query_polygon(
+            polygon)
+        spkindices_full = self.data_manager.get_grid_index(
+            full=True).query_polygon(polygon)
         return spkindices, spkindices_full
 
     def select_spikes(self, polygon=None):
@@ -890,10 +968,13 @@ class FeatureProjectionManager(Manager):
             i = min(self.nchannels * self.fetdim + self.nextrafet - 1,
                     channel - self.nchannels + self.nchannels * self.fetdim)
             text = 'E{0:d}'.format(channel - self.nchannels)
-        self.data_manager.data[:, coord] = self.data_manager.features_array[:, i].ravel()
-        self.data_manager.data_full[:, coord] = self.data_manager.features_full_array[:, i].ravel()
+        self.data_manager.data_full[:, coord] = self.data_manager.features_full_array[:, i]
+        self.data_manager.data[:, coord] = \
+            self.data_manager.data_full[self.data_manager.subsel, coord]
         self.data_manager.data_background[:, coord] = \
-            self.data_manager.features_background_array[:, i].ravel()
+            self.data_manager.features_background_array[:, i]
+        self.data_manager.projection_columns[coord] = i
+        self.data_manager.invalidate_grid_index()
 
         if do_update:
             self.projection[coord] = (channel, feature)
@@ -922,8 +1003,8 @@ class FeatureProjectionManager(Manager):
             self.set_projection(1, self.projection[1][0], self.projection[1][1])
 
     def auto_projection(self, target):
-        fet = get_array(select(self.data_manager.features,
-            self.data_manager.clusters == target))
+        fet = self.data_manager.features_array[
+            self.data_manager.clusters_array == target]
         n = fet.shape[1]
         fet = np.abs(fet[:,0:n-self.nextrafet:self.fetdim]).mean(axis=0)
         channels_best = np.argsort(fet)[::-1]
@@ -990,9 +1071,9 @@ class FeatureProjectionManager(Manager):
 class FeatureInfoManager(Manager):
     def show_closest_cluster(self, xd, yd, zx=1, zy=1):
         # find closest spike
-        dist = (np.abs(self.data_manager.data[:, 0] - xd) * zx +
-                np.abs(self.data_manager.data[:, 1] - yd) * zy)
-        ispk = dist.argmin()
+        ispk = self.data_manager.get_grid_index().nearest(xd, yd, zx, zy)
+        if ispk is None:
+            return
         cluster = self.data_manager.clusters_rel[ispk]
 
         # Absolute spike index.
@@ -1029,6 +1110,8 @@ class FeatureInteractionManager(PlotInteractionManager):
         self.register('SelectProjection', self.select_projection)
         self.register('ToggleMask', self.toggle_mask)
         self.register('ToggleBackground', self.toggle_background)
+        self.register('ToggleBackgroundDensity',
+            self.toggle_background_density)
         self.register('SelectNeighborChannel', self.select_neighbor_channel)
         self.register('SelectNeighborProjection', self.select_neighbor_projection)
         self.register('SelectFeature', self.select_feature)
@@ -1150,6 +1233,9 @@ class FeatureInteractionManager(PlotInteractionManager):
     def toggle_background(self, parameter=None):
         self.paint_manager.toggle_background()
 
+    def toggle_background_density(self, parameter=None):
+        self.paint_manager.toggle_background_density()
+
     def show_closest_cluster(self, parameter):
 
         self.cursor = None
@@ -1203,6 +1289,9 @@ class FeatureBindings(KlustaViewaBindings):
         self.set('KeyPress',
                  'ToggleBackground',
                  key='B')
+        self.set('KeyPress',
+                 'ToggleBackgroundDensity',
+                 key='B', key_modifier='Shift')
 
     def set_neighbor_channel(self):
         # select previous/next channel for coordinate 0
@@ -0,0 +1,135 @@
+"""Uniform grid over 2D points, used to find the points in a box, in a
+polygon, or closest to a position without scanning all points."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+
+# Average number of points per cell.
+GRID_POINTS_PER_CELL = 16
+# Maximum number of cells along each axis.
+GRID_NCELLS_MAX = 1024
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def polygon_contains_points(polygon, points):
+    """Returns the points within a polygon.
+
+    Arguments:
+      * polygon: a Nx2 array with the coordinates of the polygon vertices.
+      * points: a Nx2 array with the coordinates of the points.
+
+    Returns:
+      * arr: a Nx2 array of booleans with the belonging of every point to
+        the inside of the polygon.
+
+    """
+    try:
+        from matplotlib.path import Path
+        p = Path(polygon)
+        return p.contains_points(points)
+    except:
+        import matplotlib.nxutils
+        return matplotlib.nxutils.points_inside_poly(points, polygon)
+
+
+# -----------------------------------------------------------------------------
+# Grid index
+# -----------------------------------------------------------------------------
+class GridIndex(object):
+    """Points sorted by cell of a uniform grid, with the position of the
+    first point of every cell."""
+    def __init__(self, points, points_per_cell=GRID_POINTS_PER_CELL):
+        self.points = points
+        npoints = len(points)
+        self.ncells = int(np.clip(np.sqrt(npoints / float(points_per_cell)),
+                                  1, GRID_NCELLS_MAX))
+        finite = np.isfinite(points).all(axis=1)
+        if finite.any():
+            self.pmin = points[finite].min(axis=0).astype(np.float64)
+            self.pmax = points[finite].max(axis=0).astype(np.float64)
+        else:
+            self.pmin = self.pmax = np.zeros(2)
+        self.cell_size = np.maximum((self.pmax - self.pmin) / self.ncells,
+                                    1e-12)
+        cx = self._get_cells(points[:, 0], 0)
+        cy = self._get_cells(points[:, 1], 1)
+        cells = cy * self.ncells + cx
+        self.order = np.argsort(cells, kind='mergesort')
+        self.starts = np.searchsorted(cells[self.order],
+                                      np.arange(self.ncells ** 2 + 1))
+
+    def _get_cells(self, values, axis):
+        cells = np.floor((values - self.pmin[axis]) / self.cell_size[axis])
+        cells[~np.isfinite(cells)] = 0
+        return np.clip(cells, 0, self.ncells - 1).astype(np.int64)
+
+    def _get_candidates(self, cx0, cx1, cy0, cy1):
+        """Return the points in the cells between (cx0, cy0) and (cx1, cy1)
+        included."""
+        n = self.ncells
+        cx0, cx1 = max(cx0, 0), min(cx1, n - 1)
+        cy0, cy1 = max(cy0, 0), min(cy1, n - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.zeros(0, dtype=np.int64)
+        # The cells of a row of the box are contiguous.
+        return np.concatenate([
+            self.order[self.starts[cy * n + cx0]:self.starts[cy * n + cx1 + 1]]
+            for cy in range(cy0, cy1 + 1)])
+
+    def _get_box_candidates(self, xmin, ymin, xmax, ymax):
+        cx0, cx1 = self._get_cells(np.array([xmin, xmax], dtype=np.float64), 0)
+        cy0, cy1 = self._get_cells(np.array([ymin, ymax], dtype=np.float64), 1)
+        return self._get_candidates(cx0, cx1, cy0, cy1)
+
+
+    # Queries.
+    # --------
+    def query_box(self, xmin, ymin, xmax, ymax):
+        """Return the sorted indices of the points in a box, borders
+        included."""
+        candidates = self._get_box_candidates(xmin, ymin, xmax, ymax)
+        points = self.points[candidates]
+        inside = ((points[:, 0] >= xmin) & (points[:, 0] <= xmax) &
+                  (points[:, 1] >= ymin) & (points[:, 1] <= ymax))
+        return np.sort(candidates[inside])
+
+    def query_polygon(self, polygon):
+        """Return the sorted indices of the points in a polygon. Only the
+        points in the bounding box of the polygon are tested."""
+        polygon = np.asarray(polygon)
+        (xmin, ymin), (xmax, ymax) = polygon.min(axis=0), polygon.max(axis=0)
+        candidates = self._get_box_candidates(xmin, ymin, xmax, ymax)
+        if len(candidates) == 0:
+            return candidates
+        inside = polygon_contains_points(polygon, self.points[candidates])
+        return np.sort(candidates[inside])
+
+    def nearest(self, x, y, zx=1, zy=1):
+        """Return the index of the closest point for the distance
+        |dx| * zx + |dy| * zy, or None if there is no point."""
+        if len(self.points) == 0:
+            return None
+        cx = self._get_cells(np.array([x], dtype=np.float64), 0)[0]
+        cy = self._get_cells(np.array([y], dtype=np.float64), 1)[0]
+        # A point outside the cells at distance r from the cell of the
+        # position is at least r cells away along one axis.
+        cell_dist = min(self.cell_size[0] * zx, self.cell_size[1] * zy)
+        r = 0
+        while True:
+            candidates = self._get_candidates(cx - r, cx + r, cy - r, cy + r)
+            if len(candidates) > 0:
+                points = self.points[candidates]
+                dist = (np.abs(points[:, 0] - x) * zx +
+                        np.abs(points[:, 1] - y) * zy)
+                i = np.nanargmin(dist) if np.isfinite(dist).any() else 0
+                if dist[i] <= r * cell_dist:
+                    return candidates[i]
+            if (cx - r <= 0 and cy - r <= 0 and
+                cx + r >= self.ncells - 1 and cy + r >= self.ncells - 1):
+                return candidates[i]
+            r = max(2 * r, 1)
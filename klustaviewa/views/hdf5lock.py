@@ -0,0 +1,19 @@
+"""Lock shared by all threads which access the HDF5 files.
+
+Neither PyTables nor the HDF5 library are thread-safe, even across different
+files: the GUI thread, the view data tasks, the trace view and the pyramid
+builder must hold this lock whenever they read from or write to the .kwik,
+.kwx or .raw.kwd files."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+from threading import RLock
+
+
+# -----------------------------------------------------------------------------
+# Lock
+# -----------------------------------------------------------------------------
+# Reentrant, so that functions holding the lock can call other functions
+# which take it too.
+HDF5_LOCK = RLock()
@@ -0,0 +1,151 @@
+"""Mirror the features and masks of a shank in raw .npy files, which are
+memory-mapped so that random subsets of spikes are read with NumPy fancy
+indexing instead of going through the HDF5 chunks."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+
+import numpy as np
+from numpy.lib import format as npyformat
+
+from kwiklib.utils import logger as log
+from klustaviewa.views.hdf5lock import HDF5_LOCK
+
+
+# Arrays of the spikes node that are mirrored.
+MIRROR_ARRAYS = ('features_masks', 'masks')
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def get_mirror_filename(filename, channel_group, name):
+    """Return the path of the .npy mirror of an array of a .kwik file."""
+    return '{0:s}.shank{1:d}.{2:s}.npy'.format(os.path.splitext(filename)[0],
+                                               channel_group, name)
+
+def _get_source_mtime(filename):
+    source = os.path.splitext(filename)[0] + '.kwx'
+    if not os.path.exists(source):
+        return 0.
+    return os.path.getmtime(source)
+
+def check_npy(path, shape, dtype, source_mtime=0.):
+    """Check the shape, dtype, file size and mtime of a .npy file."""
+    if not os.path.exists(path) or os.path.getmtime(path) < source_mtime:
+        return False
+    with open(path, 'rb') as f:
+        try:
+            version = npyformat.read_magic(f)
+            if version != (1, 0):
+                return False
+            shape_npy, fortran_order, dtype_npy = (
+                npyformat.read_array_header_1_0(f))
+        except ValueError:
+            return False
+        offset = f.tell()
+    nbytes = int(np.prod(shape_npy)) * dtype_npy.itemsize
+    return (not fortran_order and
+            tuple(shape_npy) == tuple(shape) and
+            dtype_npy == np.dtype(dtype) and
+            os.path.getsize(path) == offset + nbytes)
+
+def _is_valid(path, source, source_mtime):
+    return check_npy(path, source.shape, source.dtype, source_mtime)
+
+def get_invalid_mirrors(spikes_data, filename, channel_group=0):
+    """Return the names of the arrays of a shank whose .npy mirror is
+    missing or out of date."""
+    source_mtime = _get_source_mtime(filename)
+    names = []
+    for name in MIRROR_ARRAYS:
+        source = getattr(spikes_data, name, None)
+        if source is None:
+            continue
+        path = get_mirror_filename(filename, channel_group, name)
+        if not _is_valid(path, source, source_mtime):
+            names.append(name)
+    return names
+
+
+# -----------------------------------------------------------------------------
+# Export
+# -----------------------------------------------------------------------------
+def export_mirror(spikes_data, filename, channel_group=0,
+                  names=MIRROR_ARRAYS, block_rows=100000):
+    """Copy the features and masks of a shank in .npy files, reading the
+    HDF5 arrays sequentially.
+
+    The HDF5 lock is only held while reading a block, so that the export
+    can run in the background. The arrays are written in temporary files
+    which are renamed once they are complete.
+
+    """
+    for name in names:
+        source = getattr(spikes_data, name, None)
+        if source is None:
+            continue
+        path = get_mirror_filename(filename, channel_group, name)
+        path_tmp = path + '.part'
+        log.info("Exporting {0:s} to {1:s}.".format(name, path))
+        with HDF5_LOCK:
+            dtype, shape = np.dtype(source.dtype), tuple(source.shape)
+        target = npyformat.open_memmap(path_tmp, mode='w+',
+            dtype=dtype, shape=shape)
+        try:
+            for i in range(0, shape[0], block_rows):
+                with HDF5_LOCK:
+                    block = source[i:i + block_rows, ...]
+                target[i:i + block_rows, ...] = block
+            target.flush()
+        except:
+            del target
+            os.remove(path_tmp)
+            raise
+        del target
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path_tmp, path)
+
+
+# -----------------------------------------------------------------------------
+# Mirror
+# -----------------------------------------------------------------------------
+class NpyMirror(object):
+    """Memory-mapped copies of spike arrays."""
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def has(self, name):
+        return name in self.arrays
+
+    def read(self, name, spikes):
+        return self.arrays[name][np.asarray(spikes, dtype=np.int64)]
+
+    def close(self):
+        self.arrays = {}
+
+def open_mirror(spikes_data, filename, channel_group=0, export=False):
+    """Open the valid .npy mirrors of a shank, exporting them first if
+    export is True. Return None if there is no valid mirror."""
+    source_mtime = _get_source_mtime(filename)
+    arrays = {}
+    for name in MIRROR_ARRAYS:
+        source = getattr(spikes_data, name, None)
+        if source is None:
+            continue
+        path = get_mirror_filename(filename, channel_group, name)
+        if not _is_valid(path, source, source_mtime):
+            if not export:
+                continue
+            export_mirror(spikes_data, filename, channel_group,
+                          names=[name])
+            if not _is_valid(path, source, source_mtime):
+                log.warn("Unable to export {0:s}.".format(path))
+                continue
+        arrays[name] = np.load(path, mmap_mode='r')
+    if not arrays:
+        return None
+    return NpyMirror(arrays)
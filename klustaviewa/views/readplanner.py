@@ -0,0 +1,136 @@
+"""Read scattered spike rows from chunked HDF5 arrays with as few reads as
+possible."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+from klustaviewa.views.hdf5lock import HDF5_LOCK
+
+
+# Number of rows per read for arrays that are not chunked.
+DEFAULT_CHUNK_ROWS = 1024
+# Maximum number of consecutive chunks merged in a single read, so that
+# sparse rows spread over the whole array are not read all at once.
+READ_CHUNKS_MAX = 16
+
+
+# -----------------------------------------------------------------------------
+# Read planner
+# -----------------------------------------------------------------------------
+def get_chunk_rows(array):
+    """Return the number of rows in a chunk of an HDF5 array."""
+    chunkshape = getattr(array, 'chunkshape', None)
+    if chunkshape:
+        return chunkshape[0]
+    return DEFAULT_CHUNK_ROWS
+
+def plan_reads(rows, chunk_rows, chunks_max=READ_CHUNKS_MAX):
+    """Group sorted rows by chunk, and merge reads of at most chunks_max
+    consecutive chunks.
+
+    Returns a list of (row_start, row_end, i0, i1) where rows[i0:i1] are in
+    the block [row_start, row_end).
+
+    """
+    if len(rows) == 0:
+        return []
+    chunks = rows // chunk_rows
+    # Runs of consecutive chunks, split every chunks_max chunks.
+    runs = np.concatenate(([0], np.cumsum(np.diff(chunks) > 1)))
+    run_starts = np.concatenate(([0], np.nonzero(np.diff(runs))[0] + 1))
+    blocks = (chunks - chunks[run_starts][runs]) // chunks_max
+    # Positions where a new read starts.
+    starts = np.nonzero((np.diff(runs) != 0) | (np.diff(blocks) != 0))[0] + 1
+    starts = np.concatenate(([0], starts))
+    ends = np.concatenate((starts[1:], [len(rows)]))
+    return [(chunks[i0] * chunk_rows, rows[i1 - 1] + 1, i0, i1)
+            for i0, i1 in zip(starts, ends)]
+
+def read_rows(array, rows, chunk_rows=None):
+    """Read array[rows] with one read per group of consecutive chunks,
+    with at most READ_CHUNKS_MAX chunks per read.
+
+    The rows can be in any order, the result is in the same order. The
+    HDF5 lock is only held while reading a block.
+
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if isinstance(array, np.ndarray):
+        return array[rows]
+    if chunk_rows is None:
+        chunk_rows = get_chunk_rows(array)
+    out = np.empty((len(rows),) + tuple(array.shape[1:]), dtype=array.dtype)
+    order = np.argsort(rows, kind='mergesort')
+    rows_sorted = rows[order]
+    for row_start, row_end, i0, i1 in plan_reads(rows_sorted, chunk_rows):
+        with HDF5_LOCK:
+            block = array[row_start:row_end, ...]
+        out[order[i0:i1]] = block[rows_sorted[i0:i1] - row_start]
+    return out
+
+def subsample_rows(rows, count, chunk_rows):
+    """Choose count rows among the sorted rows, touching as few chunks
+    as possible.
+
+    Whole chunks are taken, evenly spread among the chunks containing the
+    requested rows, so that the subset still covers the whole recording.
+
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if count is None or len(rows) <= count:
+        return rows
+    if count <= 0:
+        return rows[:0]
+    chunks = rows // chunk_rows
+    chunks_unique, chunk_starts = np.unique(chunks, return_index=True)
+    chunk_ends = np.concatenate((chunk_starts[1:], [len(rows)]))
+    # Number of chunks needed on average.
+    nchunks = len(chunks_unique)
+    nchunks_kept = int(np.ceil(count * float(nchunks) / len(rows)))
+    nchunks_kept = max(1, min(nchunks, nchunks_kept))
+    kept = np.unique(np.linspace(0, nchunks - 1, nchunks_kept).astype(
+        np.int64))
+    selected = np.concatenate([rows[chunk_starts[k]:chunk_ends[k]]
+                               for k in kept])
+    # Add chunks if the kept ones do not contain enough rows.
+    if len(selected) < count:
+        others = np.setdiff1d(np.arange(nchunks), kept)
+        extra = np.concatenate([rows[chunk_starts[k]:chunk_ends[k]]
+                                for k in others])
+        selected = np.union1d(selected,
+            extra[np.linspace(0, len(extra) - 1,
+                              count - len(selected)).astype(np.int64)])
+    # Remove the excess rows evenly.
+    if len(selected) > count:
+        selected = selected[np.linspace(0, len(selected) - 1,
+                                        count).astype(np.int64)]
+    return selected
+
+def spread_rows(rows, count, chunk_rows):
+    """Choose count rows among the sorted rows, at most one per chunk.
+
+    The chunks are evenly spread among the chunks containing the requested
+    rows, so that a small subset covers the whole recording with about count
+    reads.
+
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if count is None or len(rows) <= count:
+        return rows
+    if count <= 0:
+        return rows[:0]
+    chunks = rows // chunk_rows
+    _, chunk_starts = np.unique(chunks, return_index=True)
+    nchunks = len(chunk_starts)
+    kept = np.unique(np.linspace(0, nchunks - 1, min(count, nchunks)).astype(
+        np.int64))
+    selected = rows[chunk_starts[kept]]
+    # Add rows if there are fewer chunks than requested rows.
+    if len(selected) < count:
+        extra = np.setdiff1d(rows, selected)
+        selected = np.union1d(selected,
+            extra[np.linspace(0, len(extra) - 1,
+                              count - len(selected)).astype(np.int64)])
+    return selected
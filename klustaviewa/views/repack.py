@@ -0,0 +1,134 @@
+"""Repack the spikes of a shank in a sidecar file where they are sorted by
+cluster, so that the spikes of a cluster can be read in a few chunks."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+
+import numpy as np
+import tables as tb
+
+from kwiklib.utils import logger as log
+from klustaviewa.views.readplanner import read_rows
+
+
+# Number of spikes per chunk in the repacked arrays.
+REPACK_CHUNK_ROWS = 256
+# Arrays of the spikes node that are repacked.
+REPACK_ARRAYS = ('features_masks', 'masks', 'waveforms_filtered')
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def get_repacked_filename(filename):
+    """Return the path of the sidecar file of a .kwik file."""
+    return os.path.splitext(filename)[0] + '.repacked.kwx'
+
+def _get_source_filename(filename):
+    return os.path.splitext(filename)[0] + '.kwx'
+
+def _get_source_mtime(filename):
+    source = _get_source_filename(filename)
+    if not os.path.exists(source):
+        return 0.
+    return os.path.getmtime(source)
+
+def _get_group_name(channel_group):
+    return 'channel_group_{0:d}'.format(channel_group)
+
+
+# -----------------------------------------------------------------------------
+# Repack
+# -----------------------------------------------------------------------------
+def repack(exp, filename, channel_group=0, clustering='main',
+           chunk_rows=None, block_rows=100000):
+    """Write the spikes of a shank to the sidecar file, sorted by cluster.
+
+    The sidecar file contains, for every channel group, the permutation
+    of the spikes and the permuted arrays.
+
+    """
+    chunk_rows = chunk_rows or REPACK_CHUNK_ROWS
+    spikes_data = exp.channel_groups[channel_group].spikes
+    spike_clusters = getattr(spikes_data.clusters, clustering)[:]
+    nspikes = len(spike_clusters)
+    permutation = np.argsort(spike_clusters, kind='mergesort')
+
+    path = get_repacked_filename(filename)
+    name = _get_group_name(channel_group)
+    with tb.open_file(path, mode='a') as f:
+        if '/' + name in f:
+            f.remove_node('/', name, recursive=True)
+        group = f.create_group('/', name)
+        f.create_array(group, 'spikes', permutation)
+        for array_name in REPACK_ARRAYS:
+            source = getattr(spikes_data, array_name, None)
+            if source is None:
+                continue
+            log.info("Repacking {0:s} of channel group {1:d}.".format(
+                array_name, channel_group))
+            target = f.create_carray(group, array_name,
+                atom=tb.Atom.from_dtype(np.dtype(source.dtype)),
+                shape=source.shape,
+                chunkshape=(min(chunk_rows, max(nspikes, 1)),) +
+                    tuple(source.shape[1:]))
+            for i in range(0, nspikes, block_rows):
+                rows = permutation[i:i + block_rows]
+                target[i:i + len(rows), ...] = read_rows(source, rows)
+        group._v_attrs.nspikes = nspikes
+        group._v_attrs.source_mtime = _get_source_mtime(filename)
+    return path
+
+
+# -----------------------------------------------------------------------------
+# Repacked spikes
+# -----------------------------------------------------------------------------
+class RepackedSpikes(object):
+    """Read spike arrays from the sidecar file.
+
+    The mapping between spikes and rows does not depend on the clustering:
+    after a merge or a split, the spikes of every cluster still come from
+    a few runs of rows, so the sidecar file remains valid.
+
+    """
+    def __init__(self, f, group):
+        self.file = f
+        self.group = group
+        permutation = group.spikes[:]
+        self.nspikes = len(permutation)
+        # Row of every spike in the repacked arrays.
+        self.rows = np.empty(self.nspikes, dtype=np.int64)
+        self.rows[permutation] = np.arange(self.nspikes)
+
+    def has(self, name):
+        return name in self.group
+
+    def read(self, name, spikes):
+        return read_rows(getattr(self.group, name),
+                         self.rows[np.asarray(spikes, dtype=np.int64)])
+
+    def close(self):
+        self.file.close()
+
+def open_repacked(filename, channel_group=0, nspikes=None):
+    """Open the sidecar file of a .kwik file if it exists and if it is up to
+    date, return None otherwise."""
+    path = get_repacked_filename(filename)
+    if not os.path.exists(path):
+        return None
+    f = tb.open_file(path, mode='r')
+    name = '/' + _get_group_name(channel_group)
+    if name not in f:
+        f.close()
+        return None
+    group = f.get_node(name)
+    attrs = group._v_attrs
+    if ((nspikes is not None and attrs.nspikes != nspikes) or
+        attrs.source_mtime < _get_source_mtime(filename)):
+        log.warn("The repacked file {0:s} is out of date.".format(path))
+        f.close()
+        return None
+    log.info("Using the repacked file {0:s}.".format(path))
+    return RepackedSpikes(f, group)
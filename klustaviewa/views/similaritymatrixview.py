@@ -18,9 +18,43 @@ from kwiklib.utils import logger as log
 from klustaviewa.views.common import HighlightManager, KlustaViewaBindings, KlustaView
 
 
+# Number of colors between col0 and col1 in the lookup table.
+COLORMAP_NLEVELS = 256
+# Similarity value above which the color col1 is used.
+COLORMAP_MAX = .1
+
+
 # -----------------------------------------------------------------------------
 # Utility functions
 # -----------------------------------------------------------------------------
+def get_colormap_lut(col0=None, col1=None, nlevels=COLORMAP_NLEVELS):
+    """Return a (nlevels + 1) x 3 uint8 RGB lookup table, with a gradient
+    from the color col0 (H, S, V) to col1, and black as the last color."""
+    if col0 is None:
+        col0 = (.67, .91, .65)
+    if col1 is None:
+        col1 = (0., 1., 1.)
+    col0 = np.array(col0, dtype=np.float64).reshape((1, 1, -1))
+    col1 = np.array(col1, dtype=np.float64).reshape((1, 1, -1))
+    x = np.linspace(0., 1., nlevels).reshape((1, -1, 1))
+    lut = np.zeros((nlevels + 1, 3), dtype=np.uint8)
+    lut[:-1] = np.round(255 * hsv_to_rgb(col0 + (col1 - col0) * x)[0])
+    return lut
+
+def get_levels(x, nlevels=COLORMAP_NLEVELS):
+    """Return the index in the lookup table of every value of a 2D
+    grayscale array: NaN values have the color col0, values of -1 and the
+    diagonal are black."""
+    levels = np.clip(x * ((nlevels - 1) / COLORMAP_MAX), 0., nlevels - 1)
+    levels[np.isnan(levels)] = 0.
+    levels = np.round(levels).astype(np.uint16)
+    # value of -1 = black
+    levels[x == -1] = nlevels
+    # Remove diagonal.
+    n = min(levels.shape)
+    levels[xrange(n), xrange(n)] = nlevels
+    return levels
+
 def colormap(x, col0=None, col1=None):
     """Colorize a 2D grayscale array.
     
@@ -31,53 +65,18 @@ def colormap(x, col0=None, col1=None):
       * col1=None: a tuple (H, S, V) corresponding to color 1.
     
     Returns:
-      * y: an NxMx3 array with a rainbow color palette.
+      * y: an NxMx3 uint8 array with a rainbow color palette.
     
     """
-    # record values to be removed
-    removed = x == -1
-    
-    x[np.isnan(x)] = 0.
-    # x -= x.min()
-    # x *= (1. / x.max())
-    # Set the maximum values above which the max color should be used.
-    max = .1
-    
-    x = np.clip(x / max, 0., 1.)
-    
-    # Gamma correction. Doesn't look very good.
-    # x = x ** .2
-
-    shape = x.shape
-    
-    if col0 is None:
-        col0 = (.67, .91, .65)
-    if col1 is None:
-        col1 = (0., 1., 1.)
-    
-    col0 = np.array(col0).reshape((1, 1, -1))
-    col1 = np.array(col1).reshape((1, 1, -1))
-    
-    col0 = np.tile(col0, x.shape + (1,))
-    col1 = np.tile(col1, x.shape + (1,))
-    
-    x = np.tile(x.reshape(shape + (1,)), (1, 1, 3))
-    
-    y = hsv_to_rgb(col0 + (col1 - col0) * x)
-    
-    # value of -1 = black
-    y[removed,:] = 0
-    # Remove diagonal.
-    n = y.shape[0]
-    y[xrange(n), xrange(n), :] = 0
-    
-    return y
+    return np.take(get_colormap_lut(col0, col1), get_levels(x), axis=0)
     
 
 # -----------------------------------------------------------------------------
 # Data manager
 # -----------------------------------------------------------------------------
 class SimilarityMatrixDataManager(Manager):
+    lut = get_colormap_lut()
+    
     def set_data(self, similarity_matrix=None,
         cluster_colors_full=None,
         clusters_hidden=[],  # WARNING: relative indexing
@@ -90,15 +89,14 @@ class SimilarityMatrixDataManager(Manager):
             similarity_matrix = -np.ones((2, 2))
         elif similarity_matrix.shape[0] == 1:
             similarity_matrix = -np.ones((2, 2))
-           
-        self.similarity_matrix = similarity_matrix
-        n = similarity_matrix.shape[0]
         
-        self.texture = colormap(self.similarity_matrix.copy())
-        # similarity_matrix axes are originally (x, y) from the lower left corner
-        # but when displayed, they are (i, j) from the upper left corner
-        # so we need to transpose
-        self.texture = np.swapaxes(self.texture, 0, 1)
+        # The levels are only computed again when the matrix changes, and
+        # not when clusters are hidden.
+        levels_previous = getattr(self, 'levels', None)
+        if (similarity_matrix is not getattr(self, 'similarity_matrix', None)
+                or levels_previous is None):
+            self.levels = get_levels(similarity_matrix)
+        self.similarity_matrix = similarity_matrix
         
         self.clusters_unique = get_indices(cluster_colors_full)
         
@@ -108,19 +106,38 @@ class SimilarityMatrixDataManager(Manager):
         # Remove hidden clusters.
         indices = np.array(sorted(set(range(self.nclusters)) - set(clusters_hidden)),
                                 dtype=np.int32)
-        self.indices = indices
-        
         if len(indices) >= 2:
-            tex0 = self.texture.copy()
-            self.texture = tex0[[[_] for _ in (indices)],indices,:]
+            texture_indices = indices
         else:
-            indices = range(self.nclusters)
+            indices = np.arange(self.nclusters, dtype=np.int32)
+            texture_indices = np.arange(self.levels.shape[0], dtype=np.int32)
+        self.indices = indices
+        indices_previous = getattr(self, 'texture_indices', None)
+        self.texture_indices = texture_indices
         
         self.clusters_displayed = self.clusters_unique[indices]
         self.nclusters_displayed = len(indices)
         
-        self.texture = self.texture[::-1,:,:]
-        
+        self.texture_changed = self.update_texture(levels_previous,
+                                                   indices_previous)
+    
+    def update_texture(self, levels_previous=None, indices_previous=None):
+        """Update the texture from the levels of the displayed clusters with
+        a single lookup, unless neither the levels nor the displayed
+        clusters have changed. Return whether the texture has changed."""
+        levels = self.levels
+        indices = self.texture_indices
+        if (levels is levels_previous and indices_previous is not None and
+                np.array_equal(indices, indices_previous)):
+            return False
+        # similarity_matrix axes are originally (x, y) from the lower left
+        # corner but when displayed, they are (i, j) from the upper left
+        # corner: texture[i, j] is the color of matrix[indices[j],
+        # indices[n - 1 - i]].
+        self.texture = np.take(self.lut,
+            levels[indices[np.newaxis, :], indices[::-1, np.newaxis]], axis=0)
+        return True
+    
     
 # -----------------------------------------------------------------------------
 # Visuals
@@ -143,6 +160,8 @@ class SimilarityMatrixPaintManager(PlotPaintManager):
             visible=False)
             
     def update(self):
+        if not self.data_manager.texture_changed:
+            return
         self.set_data(
             texture=self.data_manager.texture, visual='similarity_matrix')
         
@@ -177,13 +196,13 @@ class SimilarityMatrixInfoManager(Manager):
         
         ind = self.data_manager.indices
         matrix = self.data_manager.similarity_matrix
-        matrix = matrix[ind,:][:,ind]
         
-        if ((cx_rel >= matrix.shape[0]) or
-            (cy_rel >= matrix.shape[1])):
+        if ((cx_rel >= len(ind)) or (cy_rel >= len(ind)) or
+            (ind[cx_rel] >= matrix.shape[0]) or
+            (ind[cy_rel] >= matrix.shape[1])):
             return
             
-        val = matrix[cx_rel, cy_rel]
+        val = matrix[ind[cx_rel], ind[cy_rel]]
         
         text = "%d/%d:%.3f" % (cx, cy, val)
         
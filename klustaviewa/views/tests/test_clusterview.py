@@ -9,6 +9,7 @@ import time
 import numpy as np
 import numpy.random as rnd
 import pandas as pd
+from qtools import QtCore
 
 from klustaviewa.views.tests.mock_data import (setup, teardown,
     create_similarity_matrix,
@@ -18,12 +19,79 @@ from kwiklib.dataio.selection import select, get_indices
 from kwiklib.dataio.tools import check_dtype, check_shape
 from klustaviewa import USERPREF
 from klustaviewa.views import ClusterView
+from klustaviewa.views.clusterview import ClusterViewModel
 from klustaviewa.views.tests.utils import show_view, get_data, assert_fun
 
 
 # -----------------------------------------------------------------------------
 # Tests
 # -----------------------------------------------------------------------------
+def _get_model_data(clusters, groups, sizes, colors):
+    return dict(
+        cluster_colors=pd.Series(colors, index=clusters),
+        cluster_groups=pd.Series(groups, index=clusters),
+        group_colors=pd.Series([1, 2, 3, 4], index=[0, 1, 2, 3]),
+        group_names=pd.Series(['Noise', 'MUA', 'Good', 'Unsorted'],
+                              index=[0, 1, 2, 3]),
+        cluster_sizes=pd.Series(sizes, index=clusters))
+
+def _get_model_state(model):
+    return [(group.groupidx(), group.spkcount(),
+             [(cluster.clusteridx(), cluster.spkcount(), cluster.color())
+                for cluster in group.children])
+                    for group in model.get_groups()]
+
+def test_clusterview_update():
+    model = ClusterViewModel(**_get_model_data(
+        [2, 3, 4, 5], [3, 3, 3, 1], [10, 20, 30, 40], [1, 2, 3, 4]))
+    
+    # Merge 2 and 4 into 6.
+    data = _get_model_data([3, 5, 6], [3, 1, 3], [20, 40, 40], [2, 4, 5])
+    model.update([2, 4, 6], **data)
+    assert _get_model_state(model) == _get_model_state(
+        ClusterViewModel(**data))
+    
+    # Move 3 to another group and change the color of 5.
+    data = _get_model_data([3, 5, 6], [2, 1, 3], [20, 40, 40], [2, 7, 5])
+    model.update([3, 5], **data)
+    assert _get_model_state(model) == _get_model_state(
+        ClusterViewModel(**data))
+    assert model.get_groupidx(3) == 2
+    
+    # Split 6 into 1, 6 and 7.
+    data = _get_model_data([1, 3, 5, 6, 7], [3, 2, 1, 3, 3],
+                           [5, 20, 40, 25, 10], [9, 2, 7, 5, 8])
+    model.update([1, 6, 7], **data)
+    assert _get_model_state(model) == _get_model_state(
+        ClusterViewModel(**data))
+    assert model.get_cluster(4) is None
+    
+def test_clusterview_sort():
+    clusters = [1, 2, 3, 4, 5, 6]
+    model = ClusterViewModel(cluster_quality=pd.Series(
+        [.5, .9, .1, .3, .7, .2], index=clusters), **_get_model_data(
+        clusters, [3, 3, 1, 3, 3, 1], [50, 10, 30, 40, 10, 5],
+        [1, 2, 3, 4, 5, 6]))
+    
+    def get_clusters(groupidx):
+        return [cluster.clusteridx()
+            for cluster in model.get_clusters_in_group(groupidx)]
+    
+    # Sort by decreasing size, within every group.
+    model.sort(2, QtCore.Qt.DescendingOrder)
+    assert get_clusters(3) == [1, 4, 2, 5]
+    assert get_clusters(1) == [3, 6]
+    
+    # Sort by quality, then by cluster index.
+    model.sort(1, QtCore.Qt.AscendingOrder)
+    assert get_clusters(3) == [4, 1, 5, 2]
+    model.sort(0, QtCore.Qt.AscendingOrder)
+    assert get_clusters(3) == [1, 2, 4, 5]
+    
+    # Filter.
+    hidden = model.get_hidden_clusters(quality_min=.4, spkcount_min=10)
+    assert sorted([cluster.clusteridx() for cluster in hidden]) == [3, 4, 6]
+    
 def test_clusterview():
     keys = ('cluster_groups,group_colors,group_names,'
             'cluster_sizes').split(',')
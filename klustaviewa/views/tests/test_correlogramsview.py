@@ -16,7 +16,10 @@ from kwiklib.dataio import KlustersLoader
 from kwiklib.dataio.selection import select
 from kwiklib.dataio.tools import check_dtype, check_shape
 from klustaviewa import USERPREF
+from klustaviewa.stats.cache import IndexedMatrix
 from klustaviewa.views import CorrelogramsView
+from klustaviewa.views.correlogramsview import (CorrelogramsDataManager,
+    get_histogram_points)
 from klustaviewa.views.tests.utils import show_view, get_data
 
 
@@ -45,4 +48,53 @@ def test_correlogramsview():
     # Show the view.
     show_view(CorrelogramsView, **kwargs)
     
-    
\ No newline at end of file
+def test_histogram_points():
+    hist = np.array([[1., 3.], [0., 2.]])
+    position = get_histogram_points(hist)
+    assert position.shape == (2 * 11, 2)
+    assert position.dtype == np.float32
+    x = position.reshape((2, 11, 2))[:, :, 0].copy()
+    assert np.array_equal(x[0], x[1])
+    assert np.allclose(x[0], [-1, -1, 0, -1, 0, 0, 0, 1, 0, 1, 1])
+    y = position.reshape((2, 11, 2))[:, :, 1].copy()
+    assert np.array_equal(y[1], [0, 0, 0, 0, 0, 0, 2, 2, 0, 0, 0])
+    
+    # Only the Y coordinates are updated.
+    position2 = get_histogram_points(2 * hist, position)
+    assert position2 is position
+    assert np.array_equal(position[:, 0].reshape((2, 11)), x)
+    assert np.array_equal(position[:, 1].reshape((2, 11)), 2 * y)
+    
+    assert get_histogram_points(np.zeros((0, 0))).shape == (0, 2)
+    
+def test_normalization():
+    n, nbins = 3, 5
+    correlograms = np.random.rand(n, n, nbins) + .1
+    correlograms[1, 1, :] = 0
+    baselines = np.random.rand(n, n)
+    dm = CorrelogramsDataManager()
+    dm.set_data(correlograms=IndexedMatrix(indices=np.arange(n),
+        data=correlograms.copy()), baselines=baselines,
+        cluster_colors=pd.Series(np.zeros(n, dtype=np.int32)),
+        clusters_selected=np.arange(n), ncorrbins=nbins, corrbin=.001)
+    
+    # Row normalization: the max of every row is 1.
+    dm.normalize('row')
+    assert np.allclose(dm.correlograms_array.reshape((n, -1)).max(axis=1), 1)
+    m = correlograms[0, 0].max()
+    m *= (correlograms[0] / m).max()
+    assert np.allclose(dm.correlograms_array[0], correlograms[0] / m)
+    assert np.allclose(dm.baselines[0], baselines[0] / m)
+    
+    # Uniform normalization: the max of every correlogram is 1, except for
+    # the null correlogram.
+    dm.normalize('uniform')
+    M = dm.correlograms_array.max(axis=2)
+    assert np.allclose(M[M > 0], 1)
+    assert np.allclose(dm.baselines, baselines / 
+        np.where(correlograms.max(axis=2) > 0, correlograms.max(axis=2), 1))
+    y = dm.position[:, 1].reshape((n * n, -1))
+    assert np.allclose(y[:, 1::5], dm.correlograms_array.reshape((n * n, -1)))
+    
+    # The original arrays are left untouched.
+    assert np.array_equal(dm.correlograms_array0, correlograms)
@@ -16,6 +16,8 @@ from kwiklib.dataio.selection import select
 from kwiklib.dataio.tools import check_dtype, check_shape
 from klustaviewa import USERPREF
 from klustaviewa.views import FeatureView
+from klustaviewa.views.featureview import (get_density_image,
+    get_density_texture)
 from klustaviewa.views.tests.utils import show_view, get_data
 
 
@@ -44,4 +46,22 @@ def test_featureview():
     # Show the view.
     show_view(FeatureView, **kwargs)
     
-    
\ No newline at end of file
+def test_density_image():
+    points = np.array([[0., 0.], [0., 0.], [1., 2.], [np.nan, 1.]])
+    image, extent = get_density_image(points, size=4)
+    assert extent == (0., 0., 1., 2.)
+    assert image.shape == (4, 4)
+    # The first row is at the top.
+    assert image[3, 0] == 1.
+    assert np.allclose(image[0, 3], np.log(2) / np.log(3))
+    assert np.count_nonzero(image) == 2
+    
+    texture = get_density_texture(image, alpha=.25)
+    assert texture.dtype == np.uint8
+    assert texture.shape == (4, 4, 4)
+    assert np.array_equal(texture[..., 3] > 0, image > 0)
+    assert texture[..., 3].max() == int(.25 * 255)
+    
+    # No point.
+    image, extent = get_density_image(np.zeros((0, 2)), size=4)
+    assert not np.any(image)
@@ -0,0 +1,39 @@
+"""Unit tests for the gridindex module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+import numpy.random as rnd
+
+from klustaviewa.views.gridindex import GridIndex, polygon_contains_points
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_gridindex_box():
+    points = rnd.randn(10000, 2).astype(np.float32)
+    index = GridIndex(points)
+    for xmin, ymin, xmax, ymax in [(-.5, -.2, .3, .8), (-10, -10, 10, 10),
+                                   (5, 5, 6, 6), (.1, .1, .1, .1)]:
+        expected = np.nonzero(
+            (points[:, 0] >= xmin) & (points[:, 0] <= xmax) &
+            (points[:, 1] >= ymin) & (points[:, 1] <= ymax))[0]
+        assert np.array_equal(index.query_box(xmin, ymin, xmax, ymax),
+                              expected)
+
+def test_gridindex_polygon():
+    points = rnd.randn(10000, 2).astype(np.float32)
+    index = GridIndex(points)
+    polygon = np.array([[-1, -1], [1, -.5], [.5, 1], [-.8, .2], [-1, -1]])
+    expected = np.nonzero(polygon_contains_points(polygon, points))[0]
+    assert np.array_equal(index.query_polygon(polygon), expected)
+
+def test_gridindex_nearest():
+    points = rnd.randn(10000, 2).astype(np.float32)
+    index = GridIndex(points)
+    for x, y, zx, zy in [(0, 0, 1, 1), (.3, -.7, 2, .5), (10, -20, 1, 1)]:
+        dist = np.abs(points[:, 0] - x) * zx + np.abs(points[:, 1] - y) * zy
+        assert dist[index.nearest(x, y, zx, zy)] == dist.min()
+    assert GridIndex(np.zeros((0, 2))).nearest(0, 0) is None
@@ -0,0 +1,67 @@
+"""Unit tests for the npymirror module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from klustaviewa.views.npymirror import (open_mirror, get_mirror_filename,
+    get_invalid_mirrors)
+
+
+# -----------------------------------------------------------------------------
+# Fixtures
+# -----------------------------------------------------------------------------
+class Node(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_npymirror():
+    dirpath = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirpath, 'myexperiment.kwik')
+        spikes_data = Node(
+            features_masks=np.random.rand(1000, 12, 2).astype(np.float32),
+            masks=np.random.rand(1000, 12).astype(np.float32),
+            )
+
+        # No mirror yet.
+        assert open_mirror(spikes_data, filename) is None
+        assert get_invalid_mirrors(spikes_data, filename) == [
+            'features_masks', 'masks']
+
+        mirror = open_mirror(spikes_data, filename, export=True)
+        assert get_invalid_mirrors(spikes_data, filename) == []
+        assert not any(f.endswith('.part') for f in os.listdir(dirpath))
+        spikes = np.array([999, 3, 500, 4, 0])
+        for name in ('features_masks', 'masks'):
+            assert mirror.has(name)
+            assert np.array_equal(mirror.read(name, spikes),
+                                  getattr(spikes_data, name)[spikes])
+        assert not mirror.has('waveforms_filtered')
+        mirror.close()
+
+        # The mirror is reused.
+        mirror = open_mirror(spikes_data, filename)
+        assert mirror.has('features_masks')
+        mirror.close()
+
+        # A truncated mirror is invalid.
+        path = get_mirror_filename(filename, 0, 'masks')
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 4)
+        mirror = open_mirror(spikes_data, filename)
+        assert mirror.has('features_masks')
+        assert not mirror.has('masks')
+        assert get_invalid_mirrors(spikes_data, filename) == ['masks']
+        mirror.close()
+    finally:
+        shutil.rmtree(dirpath)
@@ -0,0 +1,97 @@
+"""Unit tests for the readplanner module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+from klustaviewa.views.readplanner import (plan_reads, read_rows,
+    subsample_rows, spread_rows)
+
+
+# -----------------------------------------------------------------------------
+# Fixtures
+# -----------------------------------------------------------------------------
+class ChunkedArray(object):
+    """Mock HDF5 array which records the reads."""
+    def __init__(self, array, chunk_rows):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.chunkshape = (chunk_rows,) + array.shape[1:]
+        self.reads = []
+
+    def __getitem__(self, item):
+        self.reads.append(item)
+        return self.array[item]
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_plan_reads():
+    rows = np.array([1, 3, 12, 25, 27, 48])
+    # Chunks 0, 0, 1, 2, 2, 4: the first three chunks are merged.
+    assert plan_reads(rows, 10) == [(0, 28, 0, 5), (40, 49, 5, 6)]
+    assert plan_reads(rows[:0], 10) == []
+    # At most two consecutive chunks per read.
+    assert plan_reads(rows, 10, chunks_max=2) == [(0, 13, 0, 3),
+        (20, 28, 3, 5), (40, 49, 5, 6)]
+
+def test_plan_reads_sparse():
+    # Sparse rows spread over the whole array: the reads are bounded.
+    rows = np.arange(0, 1000000, 100)
+    reads = plan_reads(rows, 1024)
+    assert max(row_end - row_start
+               for row_start, row_end, _, _ in reads) <= 16 * 1024
+    assert reads[0][2] == 0 and reads[-1][3] == len(rows)
+    assert all(reads[k][3] == reads[k + 1][2] for k in range(len(reads) - 1))
+
+def test_read_rows():
+    array = ChunkedArray(np.random.rand(100, 3, 2), 10)
+    rows = np.array([57, 3, 12, 98, 5, 11])
+    out = read_rows(array, rows)
+    assert np.array_equal(out, array.array[rows])
+    # Chunks 0-1, 5, and 9.
+    assert len(array.reads) == 3
+
+    # A sparse selection is read in bounded blocks.
+    array = ChunkedArray(np.random.rand(100000, 2), 100)
+    rows = np.arange(0, 100000, 50)
+    out = read_rows(array, rows)
+    assert np.array_equal(out, array.array[rows])
+    assert len(array.reads) == 63
+    assert max(item[0].stop - item[0].start for item in array.reads) <= 1600
+
+def test_subsample_rows():
+    rows = np.arange(0, 10000, 3)
+    selected = subsample_rows(rows, 300, 100)
+    assert len(selected) == 300
+    assert np.all(np.in1d(selected, rows))
+    assert np.all(np.diff(selected) > 0)
+    # Few chunks are touched, spread over the recording.
+    chunks = np.unique(selected // 100)
+    assert len(chunks) <= 12
+    assert chunks[0] == 0 and chunks[-1] == 99
+
+    assert np.array_equal(subsample_rows(rows, 10000, 100), rows)
+
+def test_spread_rows():
+    rows = np.arange(0, 10000, 3)
+    selected = spread_rows(rows, 32, 100)
+    assert len(selected) == 32
+    assert np.all(np.in1d(selected, rows))
+    assert np.all(np.diff(selected) > 0)
+    # One row per chunk, spread over the recording.
+    chunks = selected // 100
+    assert len(np.unique(chunks)) == 32
+    assert chunks[0] == 0 and chunks[-1] == 99
+
+    # Fewer chunks than requested rows.
+    selected = spread_rows(rows, 150, 100)
+    assert len(selected) == 150
+    assert np.all(np.in1d(selected, rows))
+    assert len(np.unique(selected // 100)) == 100
+
+    assert np.array_equal(spread_rows(rows, 10000, 100), rows)
+    assert len(spread_rows(rows, 0, 100)) == 0
@@ -0,0 +1,63 @@
+"""Unit tests for the repack module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from klustaviewa.views.repack import (repack, open_repacked,
+    get_repacked_filename)
+
+
+# -----------------------------------------------------------------------------
+# Fixtures
+# -----------------------------------------------------------------------------
+class Node(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+def create_experiment(nspikes, nclusters):
+    spike_clusters = np.random.randint(low=0, high=nclusters, size=nspikes)
+    spikes = Node(
+        clusters=Node(main=spike_clusters),
+        features_masks=np.random.rand(nspikes, 12, 2).astype(np.float32),
+        masks=np.random.rand(nspikes, 12).astype(np.float32),
+        waveforms_filtered=np.random.randint(low=-100, high=100,
+            size=(nspikes, 20, 4)).astype(np.int16),
+        )
+    return Node(channel_groups={0: Node(spikes=spikes)})
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_repack():
+    dirpath = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirpath, 'myexperiment.kwik')
+        exp = create_experiment(1000, 10)
+        spikes_data = exp.channel_groups[0].spikes
+        path = repack(exp, filename, chunk_rows=16, block_rows=300)
+        assert path == get_repacked_filename(filename)
+
+        repacked = open_repacked(filename, nspikes=1000)
+        # The file is sorted by cluster.
+        clusters = spikes_data.clusters.main[repacked.group.spikes[:]]
+        assert np.all(np.diff(clusters) >= 0)
+        # The rows are read back in the requested order.
+        spikes = np.array([999, 3, 500, 4, 0])
+        for name in ('features_masks', 'masks', 'waveforms_filtered'):
+            assert repacked.has(name)
+            assert np.array_equal(repacked.read(name, spikes),
+                                  getattr(spikes_data, name)[spikes])
+        repacked.close()
+
+        # The repacked file does not match the number of spikes.
+        assert open_repacked(filename, nspikes=999) is None
+        assert open_repacked(filename, channel_group=1) is None
+    finally:
+        shutil.rmtree(dirpath)
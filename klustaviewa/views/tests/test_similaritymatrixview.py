@@ -16,12 +16,34 @@ from kwiklib.dataio.selection import select
 from kwiklib.dataio.tools import check_dtype, check_shape
 from klustaviewa import USERPREF
 from klustaviewa.views import SimilarityMatrixView
+from klustaviewa.views.similaritymatrixview import (colormap, get_levels,
+    get_colormap_lut, COLORMAP_NLEVELS)
 from klustaviewa.views.tests.utils import show_view, get_data
 
 
 # -----------------------------------------------------------------------------
 # Tests
 # -----------------------------------------------------------------------------
+def test_colormap():
+    lut = get_colormap_lut()
+    assert lut.shape == (COLORMAP_NLEVELS + 1, 3)
+    assert lut.dtype == np.uint8
+    assert np.array_equal(lut[-1], [0, 0, 0])
+    
+    x = np.array([[.05, 1., -1.], [np.nan, .2, 0.], [.05, .0, .3]])
+    levels = get_levels(x)
+    # Diagonal and -1 values are black.
+    assert np.all(levels[[0, 1, 2, 0], [0, 1, 2, 2]] == COLORMAP_NLEVELS)
+    # NaN values and values above the maximum.
+    assert levels[1, 0] == 0
+    assert levels[0, 1] == COLORMAP_NLEVELS - 1
+    assert levels[2, 0] == (COLORMAP_NLEVELS - 1) // 2 + 1
+    
+    y = colormap(x)
+    assert y.shape == (3, 3, 3)
+    assert y.dtype == np.uint8
+    assert np.array_equal(y, lut[levels])
+    
 def test_similaritymatrixview():
     data = get_data()
     
@@ -0,0 +1,64 @@
+"""Unit tests for the tracepyramid module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from klustaviewa.views.tracepyramid import (build_pyramid, open_pyramid,
+    decimate, get_bin_sizes)
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_decimate():
+    samples = np.array([[1, 5], [3, -2], [0, 4], [7, 1], [2, 2]])
+    out = decimate(samples, 2)
+    assert out.shape == (3, 2, 2)
+    assert np.array_equal(out[:, 0], [[1, -2], [0, 1], [2, 2]])
+    assert np.array_equal(out[:, 1], [[3, 5], [7, 4], [2, 2]])
+
+def test_tracepyramid():
+    dirpath = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirpath, 'myexperiment.raw.kwd')
+        open(filename, 'w').close()
+        trace = np.random.randint(-1000, 1000,
+                                  size=(600000, 3)).astype(np.int16)
+
+        # No pyramid yet.
+        assert open_pyramid(trace, filename) is None
+
+        build_pyramid(trace, filename, block_bins=100)
+        pyramid = open_pyramid(trace, filename)
+        assert pyramid is not None
+        assert pyramid.bin_sizes == get_bin_sizes(trace.shape[0])
+        assert len(pyramid.bin_sizes) > 1
+        for bin_size in pyramid.bin_sizes:
+            assert np.array_equal(pyramid.levels[bin_size],
+                                  decimate(trace, bin_size))
+
+        # Bin sizes.
+        assert pyramid.get_bin_size(1) is None
+        assert pyramid.get_bin_size(64) == 64
+        assert pyramid.get_bin_size(65) == 256
+        assert pyramid.get_bin_size(10 ** 9) == pyramid.bin_sizes[-1]
+
+        # Interleaved min and max.
+        samples, x0, dx = pyramid.read(1000, 2000, 64)
+        assert x0 == 960
+        assert dx == 32
+        assert samples.shape == (2 * 17, 3)
+        assert np.array_equal(samples[0], trace[960:1024].min(axis=0))
+        assert np.array_equal(samples[1], trace[960:1024].max(axis=0))
+
+        # Subset of channels.
+        samples_channels, _, _ = pyramid.read(1000, 2000, 64, channels=[0, 2])
+        assert np.array_equal(samples_channels, samples[:, [0, 2]])
+    finally:
+        shutil.rmtree(dirpath)
@@ -14,12 +14,60 @@ from klustaviewa.views.tests.mock_data import (setup, teardown,
     ncorrbins, create_trace, freq)
 from klustaviewa import USERPREF
 from klustaviewa.views import TraceView
+from klustaviewa.views.traceview import (paint_spikes, TraceTiles,
+    get_channel_runs)
 from klustaviewa.views.tests.utils import show_view, get_data
 import tables
 
 # -----------------------------------------------------------------------------
 # Tests
 # -----------------------------------------------------------------------------
+def test_paint_spikes():
+    nsamples_slice, nchannels_slice, nspikes_slice = 500, 8, 100
+    nds = np.sort(rnd.randint(0, nsamples_slice + 20, nspikes_slice))
+    masks = rnd.rand(nspikes_slice, nchannels_slice) < .5
+    colors = rnd.randint(0, 30, nspikes_slice)
+    
+    expected = np.full((nchannels_slice, nsamples_slice), 99)
+    for x in range(nspikes_slice):
+        expected[masks[x], max(nds[x] - 5, 0):
+                 min(nds[x] + 10, nsamples_slice)] = colors[x]
+    
+    painted = paint_spikes(np.full((nchannels_slice, nsamples_slice), 99),
+        nds, masks, colors, 5, 10)
+    assert np.array_equal(painted, expected)
+    
+def test_tracetiles():
+    trace = rnd.randint(-1000, 1000, size=(10000, 4)).astype(np.int16)
+    tiles = TraceTiles(trace, tile_nsamples=100)
+    
+    # Tiles of 300 samples with a step of 3.
+    samples, x0, dx = tiles.read(slice(1234, 5678, 3))
+    assert x0 == 1200
+    assert dx == 3
+    assert np.array_equal(samples, trace[1200:5700:3])
+    assert len(tiles.cache) == 15
+    
+    # The tiles are reused, and the next one is prefetched.
+    tiles.read(slice(1500, 5000, 3))
+    assert len(tiles.cache) == 15
+    tiles.prefetch(slice(1234, 5678, 3), 1)
+    assert len(tiles.cache) == 16
+    samples, x0, dx = tiles.read(slice(5700, 6000, 3))
+    assert np.array_equal(samples, trace[5700:6000:3])
+    assert len(tiles.cache) == 16
+    
+def test_channel_runs():
+    assert get_channel_runs([]) == []
+    assert get_channel_runs([3]) == [(3, 4)]
+    assert get_channel_runs([0, 1, 2, 5, 6, 9]) == [(0, 3), (5, 7), (9, 10)]
+    
+    trace = rnd.randint(-1000, 1000, size=(10000, 8)).astype(np.int16)
+    tiles = TraceTiles(trace, tile_nsamples=100)
+    channels = np.array([1, 2, 3, 6])
+    samples, x0, dx = tiles.read(slice(0, 1000, 2), channels)
+    assert np.array_equal(samples, trace[0:1000:2, channels])
+    
 def test_traceview():
     
     trace = create_trace(int(freq * 60), nchannels)
@@ -0,0 +1,41 @@
+"""Unit tests for the trackedmask module."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+from klustaviewa.views.trackedmask import TrackedMask, get_ranges
+
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+def test_get_ranges():
+    assert get_ranges([]) == []
+    assert get_ranges([3, 4, 5, 9, 20], gap=4) == [(3, 10), (20, 21)]
+    assert get_ranges([3, 4, 5, 9, 20], gap=1) == [(3, 6), (9, 10), (20, 21)]
+    assert get_ranges([3, 4, 5, 9, 20], gap=1, nranges_max=2) == [(3, 21)]
+
+def test_trackedmask():
+    mask = TrackedMask(10000)
+    assert mask.pop_dirty_ranges() == []
+
+    assert mask.set([10, 11, 12]) == 3
+    assert np.array_equal(np.nonzero(mask.mask)[0], [10, 11, 12])
+    assert mask.pop_dirty_ranges() == [(10, 13)]
+
+    # Same points: nothing to upload.
+    assert mask.set([12, 11, 10]) == 0
+    assert mask.pop_dirty_ranges() == []
+
+    # Only the changed points are dirty.
+    mask.set([11, 12, 5000])
+    assert np.array_equal(np.nonzero(mask.mask)[0], [11, 12, 5000])
+    assert mask.pop_dirty_ranges() == [(10, 11), (5000, 5001)]
+
+    # The changes are accumulated until the next upload.
+    mask.set([11, 12])
+    mask.clear()
+    assert mask.mask.sum() == 0
+    assert mask.pop_dirty_ranges() == [(11, 13), (5000, 5001)]
@@ -92,6 +92,17 @@ def test_viewdata_waveformview_1():
         chgrp = exp.channel_groups[0]
         data = get_waveformview_data(exp, clusters=[0, 1])
         show_view(WaveformView, **data)
+
+def test_viewdata_waveformview_coarse():
+    with Experiment('myexperiment', dir=DIRPATH) as exp:
+        # At most 5 waveforms per cluster.
+        data = get_waveformview_data(exp, clusters=[0, 1], count=5)
+        assert 0 < len(data['waveforms']) <= 10
+        assert not data['keep_view']
+        data_full = get_waveformview_data(exp, clusters=[0, 1],
+                                          keep_view=True)
+        assert len(data_full['waveforms']) > len(data['waveforms'])
+        assert data_full['keep_view']
     
 def test_viewdata_featureview_1():
     with Experiment('myexperiment', dir=DIRPATH) as exp:
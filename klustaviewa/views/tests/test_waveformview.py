@@ -16,12 +16,63 @@ from kwiklib.dataio.selection import select
 from kwiklib.dataio.tools import check_dtype, check_shape
 from klustaviewa import USERPREF
 from klustaviewa.views import WaveformView
+from klustaviewa.views.waveformview import (find_enclosed_waveforms,
+    get_waveform_positions, get_vertex_attribute)
 from klustaviewa.views.tests.utils import show_view, get_data
 
 
 # -----------------------------------------------------------------------------
 # Tests
 # -----------------------------------------------------------------------------
+def test_find_enclosed_waveforms():
+    nspikes_, nsamples_, nchannels_, nboxes = 200, 20, 8, 3
+    waveforms = rnd.randn(nspikes_, nsamples_, nchannels_).astype(np.float32)
+    Tx = .3 * rnd.randn(nchannels_, nboxes)
+    Ty = .3 * rnd.randn(nchannels_, nboxes)
+    w, h = .4, .2
+    spike_boxes = rnd.randint(0, nboxes, nspikes_)
+    channels = np.array([1, 4, 5])
+    xmin, ymin, xmax, ymax = -.3, -.2, .4, .1
+    
+    # Brute force with Nspikes x Nsamples x Nchannels arrays.
+    u = Tx[channels][:, spike_boxes].T[:, np.newaxis, :]
+    v = Ty[channels][:, spike_boxes].T[:, np.newaxis, :]
+    Wx = np.linspace(-1., 1., nsamples_).reshape((1, -1, 1))
+    Wy = waveforms[:, :, channels]
+    ind = ((Wx >= (xmin - u) / (w / 2)) & (Wx <= (xmax - u) / (w / 2)) &
+           (Wy >= (ymin - v) / (h / 2)) & (Wy <= (ymax - v) / (h / 2)))
+    expected = np.nonzero(ind.max(axis=1).max(axis=1))[0]
+    
+    spikes = find_enclosed_waveforms(waveforms, Tx, Ty, (w, h), spike_boxes,
+        channels, (xmin, ymin, xmax, ymax))
+    assert len(expected) > 0
+    assert np.array_equal(spikes, expected)
+    
+def test_waveform_vertices():
+    nspikes_, nsamples_, nchannels_ = 10, 5, 3
+    waveforms = rnd.randn(nspikes_, nsamples_, nchannels_).astype(np.float32)
+    masks = rnd.rand(nspikes_, nchannels_).astype(np.float32)
+    clusters = rnd.randint(0, 4, nspikes_).astype(np.int32)
+    
+    data = get_waveform_positions(waveforms)
+    assert data.dtype == np.float32
+    assert data.shape == (nchannels_ * nspikes_ * nsamples_, 2)
+    X = np.tile(np.linspace(-1., 1., nsamples_), (nchannels_ * nspikes_, 1))
+    assert np.allclose(data[:, 0], X.ravel())
+    assert np.array_equal(data[:, 1], waveforms.transpose((2, 0, 1)).ravel())
+    
+    shape = (nchannels_, nspikes_, nsamples_)
+    masks_full = get_vertex_attribute(masks.T[:, :, np.newaxis], *shape)
+    assert masks_full.dtype == np.float32
+    assert np.array_equal(masks_full, np.repeat(masks.T.ravel(), nsamples_))
+    clusters_full = get_vertex_attribute(clusters[:, np.newaxis], *shape)
+    assert np.array_equal(clusters_full,
+        np.tile(np.repeat(clusters, nsamples_), nchannels_))
+    channels_full = get_vertex_attribute(
+        np.arange(nchannels_)[:, np.newaxis, np.newaxis], *shape)
+    assert np.array_equal(channels_full,
+        np.repeat(np.arange(nchannels_), nspikes_ * nsamples_))
+    
 def test_waveformview():
     
     keys = ('waveforms,clusters,cluster_colors,clusters_selected,masks,'
@@ -0,0 +1,163 @@
+"""Multi-level min/max envelope of the raw data, stored in .npy files next to
+the raw data file, so that the trace view reads a few bins instead of a
+strided selection of the whole recording when it is zoomed out."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import os
+
+import numpy as np
+from numpy.lib import format as npyformat
+
+from kwiklib.utils import logger as log
+from klustaviewa.views.npymirror import check_npy
+from klustaviewa.views.hdf5lock import HDF5_LOCK
+
+
+# Number of samples per bin in the first level.
+PYRAMID_BASE = 64
+# Ratio between the bin sizes of successive levels.
+PYRAMID_FACTOR = 4
+# Minimum number of bins in the last level.
+PYRAMID_NBINS_MIN = 2000
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def get_raw_filename(trace):
+    """Return the path of the file containing an HDF5 array, or None."""
+    f = getattr(trace, '_v_file', None)
+    return getattr(f, 'filename', None)
+
+def get_pyramid_filename(filename, bin_size):
+    return '{0:s}.pyramid{1:d}.npy'.format(os.path.splitext(filename)[0],
+                                           bin_size)
+
+def get_bin_sizes(nsamples, base=PYRAMID_BASE, factor=PYRAMID_FACTOR,
+                  nbins_min=PYRAMID_NBINS_MIN):
+    sizes = [base]
+    while nsamples // (sizes[-1] * factor) >= nbins_min:
+        sizes.append(sizes[-1] * factor)
+    return sizes
+
+def _get_nbins(nsamples, bin_size):
+    return (nsamples + bin_size - 1) // bin_size
+
+def decimate(samples, bin_size, out=None):
+    """Return the min and max of consecutive bins of samples, in an array
+    of shape (nbins, 2, nchannels)."""
+    n = samples.shape[0]
+    starts = np.arange(0, n, bin_size)
+    if out is None:
+        out = np.empty((len(starts), 2) + samples.shape[1:],
+                       dtype=samples.dtype)
+    if n > 0:
+        out[:, 0, ...] = np.minimum.reduceat(samples, starts, axis=0)
+        out[:, 1, ...] = np.maximum.reduceat(samples, starts, axis=0)
+    return out
+
+
+# -----------------------------------------------------------------------------
+# Build
+# -----------------------------------------------------------------------------
+def build_pyramid(trace, filename=None, block_bins=4096):
+    """Build the missing levels of the pyramid of the raw data, in a single
+    sequential pass over the raw data."""
+    filename = filename or get_raw_filename(trace)
+    nsamples, nchannels = trace.shape
+    dtype = np.dtype(trace.dtype)
+    source_mtime = os.path.getmtime(filename)
+    previous, previous_size = None, None
+    for bin_size in get_bin_sizes(nsamples):
+        path = get_pyramid_filename(filename, bin_size)
+        nbins = _get_nbins(nsamples, bin_size)
+        if not check_npy(path, (nbins, 2, nchannels), dtype, source_mtime):
+            log.info("Building the trace pyramid level {0:s}.".format(path))
+            # Write to a temporary file, so that a partial file is never
+            # used.
+            path_tmp = path + '.tmp'
+            target = npyformat.open_memmap(path_tmp, mode='w+', dtype=dtype,
+                                           shape=(nbins, 2, nchannels))
+            if previous is None:
+                # First level: from the raw data.
+                block = block_bins * bin_size
+                for i in range(0, nsamples, block):
+                    with HDF5_LOCK:
+                        samples = trace[i:i + block, :]
+                    k = i // bin_size
+                    decimate(samples, bin_size,
+                        out=target[k:k + _get_nbins(len(samples), bin_size)])
+            else:
+                # Next levels: from the previous level.
+                ratio = bin_size // previous_size
+                block = block_bins * ratio
+                for i in range(0, previous.shape[0], block):
+                    bins = previous[i:i + block]
+                    starts = np.arange(0, len(bins), ratio)
+                    k = i // ratio
+                    target[k:k + len(starts), 0] = np.minimum.reduceat(
+                        bins[:, 0], starts, axis=0)
+                    target[k:k + len(starts), 1] = np.maximum.reduceat(
+                        bins[:, 1], starts, axis=0)
+            target.flush()
+            del target
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(path_tmp, path)
+        previous = np.load(path, mmap_mode='r')
+        previous_size = bin_size
+
+
+# -----------------------------------------------------------------------------
+# Pyramid
+# -----------------------------------------------------------------------------
+class TracePyramid(object):
+    """Memory-mapped levels of the pyramid."""
+    def __init__(self, levels):
+        # Dictionary bin_size => (nbins, 2, nchannels) array.
+        self.levels = levels
+        self.bin_sizes = sorted(levels.keys())
+
+    def get_bin_size(self, step):
+        """Return the smallest bin size larger than the step between two
+        displayed samples, or None if the raw data should be used."""
+        # Every bin gives two values, the min and the max.
+        if step < self.bin_sizes[0] // 2:
+            return None
+        for bin_size in self.bin_sizes:
+            if bin_size >= step:
+                return bin_size
+        return self.bin_sizes[-1]
+
+    def read(self, i0, i1, bin_size, channels=None):
+        """Return the min and max of the bins between samples i0 and i1,
+        interleaved, along with the position of the first value and the
+        distance between two values, in samples."""
+        level = self.levels[bin_size]
+        b0 = i0 // bin_size
+        b1 = min(_get_nbins(i1, bin_size), level.shape[0])
+        if channels is None:
+            samples = np.array(level[b0:b1])
+        else:
+            samples = level[b0:b1, :, np.asarray(channels)]
+        samples = samples.reshape((-1, samples.shape[2]))
+        return samples, b0 * bin_size, bin_size / 2.
+
+def open_pyramid(trace, filename=None):
+    """Open the pyramid of the raw data if it is complete and up to date,
+    return None otherwise."""
+    filename = filename or get_raw_filename(trace)
+    if filename is None or not os.path.exists(filename):
+        return None
+    nsamples, nchannels = trace.shape
+    source_mtime = os.path.getmtime(filename)
+    levels = {}
+    for bin_size in get_bin_sizes(nsamples):
+        path = get_pyramid_filename(filename, bin_size)
+        if not check_npy(path, (_get_nbins(nsamples, bin_size), 2, nchannels),
+                         trace.dtype, source_mtime):
+            return None
+        levels[bin_size] = np.load(path, mmap_mode='r')
+    return TracePyramid(levels)
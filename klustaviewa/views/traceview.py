@@ -12,6 +12,11 @@ from galry import (Manager, PlotPaintManager, EventProcessor, PlotInteractionMan
     QtGui, QtCore, NavigationEventProcessor, PlotVisual, GridVisual, TextVisual, DataNormalizer, 
     process_coordinates)
 from klustaviewa.views.common import KlustaViewaBindings, KlustaView
+from klustaviewa.views.tracepyramid import (build_pyramid, open_pyramid,
+    get_raw_filename)
+from klustaviewa.views.hdf5lock import HDF5_LOCK
+from klustaviewa.stats.clustercache import ClusterDataCache
+from klustaviewa import USERPREF
 from kwiklib.utils import logger as log
 from kwiklib.dataio import get_array
 from qtools import inthread
@@ -19,6 +24,9 @@ from kwiklib.utils.colors import COLORS_COUNT, generate_colors, COLORMAP
 
 __all__ = ['TraceView']
 
+# Number of displayed samples per tile of the trace cache.
+TILE_NSAMPLES = 1000
+
 # -----------------------------------------------------------------------------
 # Data manager
 # -----------------------------------------------------------------------------
@@ -28,7 +36,8 @@ class TraceManager(Manager):
     
     # initialization
     def set_data(self, trace=None, freq=None, channel_height=None, channel_names=None, ignored_channels=None, channel_colors=None, spiketimes=None,
-        spikemasks=None, cluster_colors=None, spikeclusters=None, s_before=16, s_after=16):
+        spikemasks=None, cluster_colors=None, spikeclusters=None, s_before=16, s_after=16,
+        channels=None):
 
         # TODO: fix bug where view cannot be opened before file
         # if hasattr(self, 'paintinitialized'):
@@ -73,16 +82,15 @@ class TraceManager(Manager):
             
         # load initial variables
         self.trace = trace
-        self.channel_colors = channel_colors
+        self.channel_colors_full = channel_colors
         self.ignored_channels = ignored_channels
         self.spiketimes = spiketimes
-        self.spikemasks = spikemasks.astype(bool)
+        self.spikemasks_full = spikemasks.astype(bool)
         self.spikeclusters = spikeclusters
         self.cluster_colors = cluster_colors
         self.freq = freq
         self.totalduration = (self.trace.shape[0] - 1) / self.freq
-        self.totalsamples, self.nchannels = self.trace.shape
-        self.channels = np.arange(self.nchannels)
+        self.totalsamples, self.nchannels_full = self.trace.shape
         self.s_before = s_before
         self.s_after = s_after
                 
@@ -93,13 +101,10 @@ class TraceManager(Manager):
         self.channel_height = channel_height
         
         if channel_names is None:
-            channel_names = pd.Series(['ch{0:d}'.format(i) for i in xrange(self.nchannels)])
-        self.channel_names = channel_names
-
-        x = np.tile(np.linspace(0., self.totalduration, 2), (self.nchannels, 1))
-        y = np.zeros_like(x)+ np.linspace(-1, 1, self.nchannels).reshape((-1, 1))
+            channel_names = pd.Series(['ch{0:d}'.format(i) for i in xrange(self.nchannels_full)])
+        self.channel_names_full = channel_names
         
-        self.position, self.shape = process_coordinates(x=x, y=y)
+        self.set_channels(channels)
         
         # activate the grid
         if self.real_data == True:
@@ -110,6 +115,52 @@ class TraceManager(Manager):
         self.slice_retriever = inthread(SliceRetriever)(impatient=True)
         self.slice_retriever.sliceLoaded.connect(self.slice_loaded)
         
+        # min/max pyramid of the raw data, built in the background if needed
+        self.pyramid = None
+        if self.real_data:
+            self.pyramid = open_pyramid(trace)
+            if (self.pyramid is None and
+                USERPREF.get('trace_pyramid', True) and
+                get_raw_filename(trace) is not None):
+                self.pyramid_builder = inthread(TracePyramidBuilder)()
+                self.pyramid_builder.pyramidBuilt.connect(self.pyramid_built)
+                self.pyramid_builder.build(trace)
+        self.tiles = TraceTiles(trace, self.pyramid,
+            size_mb=USERPREF.get('trace_cache_size_mb', 128))
+        
+    def set_channels(self, channels=None):
+        """Set the channels to display, all channels if None. Only these
+        channels are read from the raw data."""
+        if channels is None or len(channels) == 0:
+            channels = np.arange(self.nchannels_full)
+        self.channels = np.unique(np.asarray(channels, dtype=np.int64))
+        self.nchannels = len(self.channels)
+        # None when all channels are displayed.
+        self.channels_read = (None if self.nchannels == self.nchannels_full
+                              else self.channels)
+        
+        self.channel_colors = pd.Series(get_array(self.channel_colors_full)[self.channels])
+        self.channel_names = pd.Series(get_array(self.channel_names_full)[self.channels])
+        if self.spikemasks_full.shape[1] == self.nchannels_full:
+            self.spikemasks = self.spikemasks_full[:, self.channels]
+        else:
+            self.spikemasks = self.spikemasks_full
+        
+        x = np.tile(np.linspace(0., self.totalduration, 2), (self.nchannels, 1))
+        y = np.zeros_like(x)+ np.linspace(-1, 1, self.nchannels).reshape((-1, 1))
+        
+        self.position, self.shape = process_coordinates(x=x, y=y)
+        self.size = 1
+        
+    def pyramid_built(self, trace):
+        if trace is not self.trace:
+            return
+        self.pyramid = open_pyramid(trace)
+        if self.pyramid is not None:
+            self.tiles = TraceTiles(trace, self.pyramid,
+                size_mb=USERPREF.get('trace_cache_size_mb', 128))
+            self.load_correct_slices(force=True)
+        
     def load_correct_slices(self, force=False):
         # dirty hack to make sure that we don't redraw the window until it's been drawn once, otherwise Galry automatically rescales
         if not self.paintinitialized:
@@ -122,6 +173,11 @@ class TraceManager(Manager):
         i = (index, zoom_index)
         
         if (i != self.slice_ref) or force==True: # we need to load a new slice
+            # direction of the panning, to prefetch the next tile
+            if zoom_index == self.slice_ref[1]:
+                direction = int(np.sign(index - self.slice_ref[0]))
+            else:
+                direction = 0
             self.slice_ref = i
             # Find needed slice(s) of data
         
@@ -131,7 +187,8 @@ class TraceManager(Manager):
             # this executes in a new thread, and calls slice_loaded when done
             self.slice_retriever.load_new_slice(self.trace, slice, xlim_ext, self.totalduration, self.duration_initial,
                 self.spiketimes, self.channel_colors, self.spikes_visible, self.cluster_colors,
-                self.spikemasks, self.spikeclusters, self.s_before, self.s_after)
+                self.spikemasks, self.spikeclusters, self.s_before, self.s_after,
+                self.tiles, direction, self.channels_read)
             
     def get_buffered_viewlimits(self, xlim):
         d = self.xlim[1] - self.xlim[0]
@@ -158,7 +215,8 @@ class TraceManager(Manager):
         """
         total_size = self.trace.shape[0]
         
-        samples = self.trace[slice, :]
+        with HDF5_LOCK:
+            samples = self.trace[slice, :]
         
         # Convert the data into floating points.
         samples = np.array(samples, dtype=np.float32)
@@ -182,7 +240,14 @@ class TraceManager(Manager):
         size = self.bounds[-1]
         return M, self.bounds, size
         
-    def slice_loaded(self, samples, bounds, size, slice, color_index, color_index_spikes):
+    def slice_loaded(self, samples, bounds, size, slice, color_index, color_index_spikes,
+        channels=None):
+        # skip the slices loaded before a change of the displayed channels
+        # (channels is None when all channels have been read)
+        if channels is None:
+            channels = np.arange(self.nchannels_full)
+        if not np.array_equal(channels, self.channels):
+            return
         
         self.color_index = color_index
         self.color_index_spikes = color_index_spikes
@@ -190,7 +255,7 @@ class TraceManager(Manager):
         self.bounds = bounds
         self.size = size
         
-        self.channel_index = np.repeat(self.channels, self.samples.shape[0] / self.nchannels)
+        self.channel_index = np.repeat(np.arange(self.nchannels), self.samples.shape[0] / self.nchannels)
         
         self.position = self.samples
 
@@ -198,17 +263,146 @@ class TraceManager(Manager):
         self.paint_manager.updateGL()
 
         
+def get_channel_runs(channels):
+    """Return the (start, stop) pairs of the runs of contiguous channels in
+    a sorted list of channels."""
+    channels = np.asarray(channels)
+    if len(channels) == 0:
+        return []
+    breaks = np.nonzero(np.diff(channels) != 1)[0] + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [len(channels)]))
+    return [(int(channels[i]), int(channels[j - 1]) + 1)
+            for i, j in zip(starts, stops)]
+        
+def read_trace(trace, slice, pyramid=None, channels=None):
+    """Return the samples to display in a slice, along with the position of
+    the first sample and the distance between two samples.
+    
+    When the slice is undersampled, the min and max of every bin are read
+    from the pyramid instead of a strided selection of the raw data. When
+    channels is specified, only these channels are read, one run of
+    contiguous channels at a time.
+    """
+    bin_size = pyramid.get_bin_size(slice.step) if pyramid is not None else None
+    if bin_size is not None:
+        return pyramid.read(slice.start, slice.stop, bin_size, channels=channels)
+    with HDF5_LOCK:
+        if channels is None:
+            samples = trace[slice, :]
+        else:
+            samples = np.hstack([trace[slice, c0:c1]
+                for c0, c1 in get_channel_runs(channels)])
+    return samples, slice.start, slice.step
+        
+class TraceTiles(object):
+    """LRU cache of tiles of the displayed samples, at every zoom level.
+    
+    A tile contains TILE_NSAMPLES displayed samples, read from the raw data
+    with a given step or from a level of the pyramid.
+    """
+    def __init__(self, trace, pyramid=None, size_mb=128,
+                 tile_nsamples=TILE_NSAMPLES):
+        self.trace = trace
+        self.pyramid = pyramid
+        self.tile_nsamples = tile_nsamples
+        self.cache = ClusterDataCache(size_mb=size_mb)
+        
+    def _get_level(self, step):
+        """Return the bin size of the pyramid (None for the raw data) and the
+        number of raw samples per tile for a given step."""
+        bin_size = (self.pyramid.get_bin_size(step)
+                    if self.pyramid is not None else None)
+        unit = step if bin_size is None else bin_size
+        return bin_size, unit * self.tile_nsamples
+        
+    def _read_tile(self, step, k, channels=None):
+        bin_size, tile_size = self._get_level(step)
+        # With the pyramid, the tiles of all steps using a given bin size
+        # are the same.
+        key = ((bin_size, k) if bin_size is not None
+               else (None, step, k))
+        if channels is not None:
+            key = (tuple(channels),) + key
+        tile = self.cache.get(key)
+        if tile is None:
+            i0 = k * tile_size
+            i1 = min(i0 + tile_size, self.trace.shape[0])
+            tile = read_trace(self.trace, slice(i0, i1, step), self.pyramid,
+                              channels=channels)
+            tile = (tile[0],)
+            self.cache.set(key, tile)
+        return tile[0]
+        
+    def read(self, slice, channels=None):
+        """Same as read_trace, but return whole tiles covering the slice."""
+        bin_size, tile_size = self._get_level(slice.step)
+        k0 = slice.start // tile_size
+        k1 = max((slice.stop - 1) // tile_size, k0)
+        samples = np.concatenate([self._read_tile(slice.step, k, channels)
+                                  for k in range(k0, k1 + 1)])
+        dx = slice.step if bin_size is None else bin_size / 2.
+        return samples, k0 * tile_size, dx
+        
+    def prefetch(self, slice, direction, channels=None):
+        """Load the tile following the slice in the specified direction."""
+        if direction == 0:
+            return
+        bin_size, tile_size = self._get_level(slice.step)
+        if direction > 0:
+            k = (slice.stop - 1) // tile_size + 1
+        else:
+            k = slice.start // tile_size - 1
+        if 0 <= k and k * tile_size < self.trace.shape[0]:
+            self._read_tile(slice.step, k, channels)
+        
+def paint_spikes(color_index_spikes, nds, spikemasks, colors, s_before, s_after):
+    """Paint the color of every spike between nds-s_before and nds+s_after,
+    on the channels where the spike is unmasked. nds must be sorted.
+    
+    Where the spikes overlap, the last spike wins.
+    """
+    nchannels, nsamples = color_index_spikes.shape
+    starts = np.maximum(nds - s_before, 0)
+    ends = np.minimum(nds + s_after, nsamples)
+    spikes = np.nonzero(starts < ends)[0]
+    # Index of the last spike starting at or before every sample, on every
+    # channel. As the starts and the ends are both sorted, this spike is the
+    # only one which may cover the sample.
+    last = np.full((nchannels, nsamples), -1, dtype=np.int64)
+    spikes_masked, channels = np.nonzero(spikemasks[spikes])
+    spikes_masked = spikes[spikes_masked]
+    np.maximum.at(last, (channels, starts[spikes_masked]), spikes_masked)
+    last = np.maximum.accumulate(last, axis=1)
+    covered = (last >= 0)
+    covered[covered] = ends[last[covered]] > np.nonzero(covered)[1]
+    color_index_spikes[covered] = colors[last[covered]]
+    return color_index_spikes
+        
+class TracePyramidBuilder(QtCore.QObject):
+    pyramidBuilt = QtCore.pyqtSignal(object)
+    
+    def build(self, trace):
+        build_pyramid(trace)
+        
+    def build_done(self, trace, _result=None):
+        self.pyramidBuilt.emit(trace)
+        
 class SliceRetriever(QtCore.QObject):
-    sliceLoaded = QtCore.pyqtSignal(object, object, long, object, object, object)
+    sliceLoaded = QtCore.pyqtSignal(object, object, long, object, object, object, object)
 
     def __init__(self, parent=None):
         super(SliceRetriever, self).__init__(parent)
         
     def load_new_slice(self, trace, slice, xlim, totalduration, duration_initial, spiketimes, channel_colors, spikes_visible,
-        cluster_colors, spikemasks, spikeclusters, s_before, s_after):
+        cluster_colors, spikemasks, spikeclusters, s_before, s_after, tiles=None,
+        direction=0, channels=None):
         
         total_size = trace.shape[0]
-        samples = trace[slice, :]
+        if tiles is not None:
+            samples, x0, dx = tiles.read(slice, channels)
+        else:
+            samples, x0, dx = read_trace(trace, slice, channels=channels)
        
         # Convert the data into floating points.
         samples = np.array(samples, dtype=np.float32)
@@ -223,7 +417,7 @@ class SliceRetriever(QtCore.QObject):
         samples = samples.T
         M[:, 1] = samples.ravel()
         # Generate the x coordinates.
-        x = np.arange(slice.start, slice.stop, slice.step) / float(total_size - 1)
+        x = (x0 + dx * np.arange(nsamples)) / float(total_size - 1)
 
         x = x * 2 * totalduration/ duration_initial - 1
         M[:, 0] = np.tile(x, nchannels)
@@ -235,24 +429,31 @@ class SliceRetriever(QtCore.QObject):
 
         color_index_spikes = np.full((nchannels, M.shape[0]/nchannels), COLORS_COUNT+1)
 
-        spikestart = bisect.bisect_left(spiketimes, slice.start)
-        spikestop = bisect.bisect_right(spiketimes, slice.stop, lo=spikestart) + 1
+        spikestart = bisect.bisect_left(spiketimes, x0)
+        spikestop = bisect.bisect_right(spiketimes, x0 + dx * nsamples, lo=spikestart) + 1
 
         spikeclusters = spikeclusters[spikestart:spikestop]
         spikemasks = spikemasks[spikestart:spikestop]
         spiketimes = spiketimes[spikestart:spikestop]
-        nds = ((spiketimes - slice.start)/slice.step).astype(int) # nearest displayed sample, rounded to integer
+        nds = ((spiketimes - x0)/dx).astype(int) # nearest displayed sample, rounded to integer
 
-        s_before = max(int(s_before / slice.step), 2)
-        s_after = max(int(s_after / slice.step), 2)
+        s_before = max(int(s_before / dx), 2)
+        s_after = max(int(s_after / dx), 2)
     
-        for x in range(0, nds.shape[0]-1):
-                color_index_spikes[spikemasks[x], max(nds[x]-s_before, 0):\
-                min(nds[x]+s_after, color_index_spikes.shape[1])] = cluster_colors[spikeclusters[x]]
+        if len(spikeclusters) > 0:
+            clusters, spike_cluster_indices = np.unique(spikeclusters, return_inverse=True)
+            colors = np.array([cluster_colors[cluster] for cluster in clusters])
+            paint_spikes(color_index_spikes, nds, spikemasks, colors[spike_cluster_indices],
+                s_before, s_after)
 
         color_index_spikes = np.ravel(color_index_spikes)
 
-        self.sliceLoaded.emit(M, bounds, size, slice, color_index, color_index_spikes)
+        self.sliceLoaded.emit(M, bounds, size, slice, color_index, color_index_spikes,
+            channels)
+        
+        # read the next tile while the slice is displayed
+        if tiles is not None:
+            tiles.prefetch(slice, direction, channels)
             
 # -----------------------------------------------------------------------------
 # Visuals
@@ -356,7 +557,7 @@ class MultiChannelVisual(Visual):
         
         self.add_vertex_main("""
         vec2 position = position0;
-        position.y = channel_height * position.y - .9 * (2 * channel_index - (nchannels - 1)) / (nchannels - 1);
+        position.y = channel_height * position.y - .9 * (2 * channel_index - (nchannels - 1)) / max(nchannels - 1., 1.);
         vindex = color_index;
         """)
         
@@ -465,6 +666,8 @@ class GridEventProcessor(EventProcessor):
         
         ticksx, nfracx = self.get_ticks(x0, x1)
         ticksy = np.linspace(-0.9, 0.9, self.parent.data_manager.nchannels)
+        if len(ticksy) == 1:
+            ticksy[:] = 0
         
         n = len(ticksx)
         text = [self.format_number(x, nfracx) for x in ticksx]
@@ -606,6 +809,15 @@ class TraceView(KlustaView):
             self.data_manager.load_correct_slices()
             self.updateGL()
     
+    def set_channels(self, channels=None):
+        """Display only the specified channels, or all channels if None."""
+        self.data_manager.set_channels(channels)
+        if self.initialized:
+            self.paint_manager.update()
+            self.interaction_manager.get_processor('grid').update_axes(None)
+            self.data_manager.load_correct_slices(force=True)
+            self.updateGL()
+    
     # Save and restore geometry
     # -------------------------
     def save_geometry(self):
@@ -0,0 +1,65 @@
+"""Binary mask of the points of a visual, which keeps track of the ranges of
+points changed since the last upload to the GPU."""
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+import numpy as np
+
+
+# Changed points closer than this are uploaded in the same range.
+RANGE_GAP = 256
+# Above this number of ranges, a single range is uploaded.
+RANGES_MAX = 128
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def get_ranges(indices, gap=RANGE_GAP, nranges_max=RANGES_MAX):
+    """Return (start, stop) ranges covering sorted indices, merging the
+    ranges separated by less than gap indices."""
+    indices = np.asarray(indices)
+    if len(indices) == 0:
+        return []
+    breaks = np.nonzero(np.diff(indices) > gap)[0] + 1
+    if len(breaks) + 1 > nranges_max:
+        return [(int(indices[0]), int(indices[-1]) + 1)]
+    starts = indices[np.concatenate(([0], breaks))]
+    stops = indices[np.concatenate((breaks - 1, [len(indices) - 1]))] + 1
+    return [(int(start), int(stop)) for start, stop in zip(starts, stops)]
+
+
+# -----------------------------------------------------------------------------
+# Tracked mask
+# -----------------------------------------------------------------------------
+class TrackedMask(object):
+    """Mask with 1 for the specified points and 0 elsewhere."""
+    def __init__(self, npoints):
+        self.mask = np.zeros(npoints, dtype=np.int32)
+        self.indices = np.zeros(0, dtype=np.int64)
+        self._changed = []
+
+    def set(self, indices):
+        """Set the points with a value of 1, and return the number of
+        changed points."""
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        changed = np.setxor1d(self.indices, indices, assume_unique=True)
+        if len(changed) == 0:
+            return 0
+        self.mask[self.indices] = 0
+        self.mask[indices] = 1
+        self.indices = indices
+        self._changed.append(changed)
+        return len(changed)
+
+    def clear(self):
+        return self.set([])
+
+    def pop_dirty_ranges(self):
+        """Return the ranges of points changed since the last call."""
+        if not self._changed:
+            return []
+        changed = np.unique(np.concatenate(self._changed))
+        self._changed = []
+        return get_ranges(changed)
@@ -55,8 +55,10 @@ class TreeModel(QtCore.QAbstractItemModel):
         self.root_item = TreeItem()
         self.headers = headers
         
-    def add_node(self, item_class=None, item=None, parent=None, **kwargs):
-        """Add a node in the tree.
+    def add_node(self, item_class=None, item=None, parent=None, row=None,
+                 **kwargs):
+        """Add a node in the tree, at the end of the parent's children or
+        at the specified row.
         
         
         """
@@ -67,21 +69,22 @@ class TreeModel(QtCore.QAbstractItemModel):
                 item_class = TreeItem
             item = item_class(parent=parent, **kwargs)
         
-        row = parent.rowCount()
+        if row is None:
+            row = parent.rowCount()
         item.index = self.createIndex(row, 0, item)
         
-        self.beginInsertRows(parent.index, row-1, row-1)
-        parent.appendChild(item)
+        self.beginInsertRows(self.get_index(parent), row, row)
+        parent.insertChild(item, row)
         self.endInsertRows()
         
         return item
         
     def remove_node(self, child, parent=None):
         if parent is None:
-            parent = self.root_item
+            parent = child.parent() or self.root_item
             
         row = child.row()
-        self.beginRemoveRows(parent.index, row, row)
+        self.beginRemoveRows(self.get_index(parent), row, row)
         parent.removeChild(child)
         self.endRemoveRows()
         
@@ -119,6 +122,14 @@ class TreeModel(QtCore.QAbstractItemModel):
             
             # self.endMoveRows()
     
+    def get_index(self, item):
+        """Return an up-to-date index of an item, the rows of the items
+        change when other items are inserted or removed."""
+        if item is None or item == self.root_item:
+            return QtCore.QModelIndex()
+        item.index = self.createIndex(item.row(), 0, item)
+        return item.index
+        
     def get_descendants(self, parents):
         if type(parents) != list:
             parents = [parents]
@@ -6,9 +6,6 @@
 import numpy as np
 import pandas as pd
 
-from qtools import inthread, inprocess
-from qtools import QtGui, QtCore
-
 from kwiklib.dataio import *
 from kwiklib.utils import logger as log
 from kwiklib.dataio import (get_some_spikes_in_clusters, get_indices,
@@ -17,9 +14,17 @@ from kwiklib.utils.colors import random_color, next_color
 
 from klustaviewa.stats.correlations import normalize
 from klustaviewa.stats.correlograms import get_baselines, NCORRBINS_DEFAULT, CORRBIN_DEFAULT
+from klustaviewa.stats.clusterindex import ClusterIndex
+from klustaviewa.stats.clustermetadata import ClusterMetadata
+from klustaviewa.stats.normalization import FeatureNormalization
+from klustaviewa.stats.background import (get_background_spikes,
+    FeatureBackground)
+from klustaviewa.stats.clustercache import load_clusters, is_cached
+from klustaviewa.views.readplanner import (get_chunk_rows, read_rows,
+    subsample_rows, spread_rows)
+from klustaviewa.views.hdf5lock import HDF5_LOCK
 from klustaviewa import USERPREF
 from klustaviewa import SETTINGS
-from klustaviewa.gui.threads import ThreadedTasks
 
 
 # -----------------------------------------------------------------------------
@@ -37,23 +42,183 @@ def _get_color(clusters_data, cl):
         return next_color(cl)
 
 
-def get_waveformview_data(exp, clusters=[], channel_group=0, clustering='main',
-                          autozoom=None, wizard=None):
-    clusters = np.array(clusters)
-    fetdim = exp.application_data.spikedetekt.n_features_per_channel
+def _get_cluster_colors(clusters_data, clusters, statscache=None):
+    cluster_metadata = getattr(statscache, 'cluster_metadata', None)
+    if cluster_metadata is not None:
+        return pd.Series(cluster_metadata.get_colors(clusters),
+                         index=clusters)
+    return pd.Series([_get_color(clusters_data, cl)
+                      for cl in clusters], index=clusters)
+
+
+def _get_spike_clusters(spikes_data, clustering, statscache=None):
+    cluster_index = getattr(statscache, 'cluster_index', None)
+    if cluster_index is not None:
+        return cluster_index.get_clusters()
+    return getattr(spikes_data.clusters, clustering)[:]
+
+
+def read_spikes(spikes_data, name, spikes, statscache=None):
+    """Read the rows of a spike array, from the .npy mirror or from the
+    repacked file if there is one."""
+    npy_mirror = getattr(statscache, 'npy_mirror', None)
+    if npy_mirror is not None and npy_mirror.has(name):
+        return npy_mirror.read(name, spikes)
+    repacked_spikes = getattr(statscache, 'repacked_spikes', None)
+    if repacked_spikes is not None and repacked_spikes.has(name):
+        return repacked_spikes.read(name, spikes)
+    return read_rows(getattr(spikes_data, name), spikes)
+
+def _load_waveforms(spikes_data, clusters, count, statscache=None):
+    """Load at most count waveforms per cluster, and their masks.
+
+    Whole chunks are read, except for the coarse subset which takes about
+    one waveform per chunk across the cluster.
+
+    """
+    cluster_index = getattr(statscache, 'cluster_index', None)
+    if cluster_index is None:
+        with HDF5_LOCK:
+            spikes, waveforms = spikes_data.load_waveforms(clusters=clusters,
+                                                           count=count)
+        if spikes_data.masks is not None and len(spikes) > 0:
+            masks = read_rows(spikes_data.masks, spikes)
+        else:
+            masks = None
+        return spikes, waveforms, masks
+    repacked_spikes = getattr(statscache, 'repacked_spikes', None)
+    if (repacked_spikes is not None and
+        repacked_spikes.has('waveforms_filtered')):
+        # The spikes of a cluster are contiguous in the repacked file:
+        # spread them evenly.
+        chunk_rows = 1
+    else:
+        chunk_rows = get_chunk_rows(spikes_data.waveforms_filtered)
+    if count is not None and count <= USERPREF.get('waveforms_nspikes_coarse',
+                                                   32):
+        subsample = spread_rows
+    else:
+        subsample = subsample_rows
 
-    clusters_data = getattr(exp.channel_groups[channel_group].clusters, clustering)
-    spikes_data = exp.channel_groups[channel_group].spikes
-    channels_data = exp.channel_groups[channel_group].channels
-    channels = exp.channel_groups[channel_group].channel_order
+    def get_spikes(cluster):
+        return subsample(cluster_index.get_spikes(cluster), count, chunk_rows)
+
+    def read(spikes):
+        waveforms = read_spikes(spikes_data, 'waveforms_filtered', spikes,
+                                statscache=statscache)
+        if spikes_data.masks is not None:
+            masks = read_spikes(spikes_data, 'masks', spikes,
+                                statscache=statscache)
+        else:
+            masks = None
+        return waveforms, masks
+
+    cache = getattr(statscache, 'cluster_data_cache', None)
+    return load_clusters(cache, cluster_index, ('waveforms', count),
+                         clusters, get_spikes, read)
+
+def get_waveforms_count_coarse(clusters, statscache=None):
+    """Return the number of waveforms per cluster to show while all of them
+    are being loaded, or None if they can be shown at once because they are
+    in the cache."""
+    count = USERPREF['waveforms_nspikes_max_expected']
+    count_coarse = USERPREF.get('waveforms_nspikes_coarse', 32)
+    if count_coarse >= count:
+        return None
+    cluster_index = getattr(statscache, 'cluster_index', None)
+    cache = getattr(statscache, 'cluster_data_cache', None)
+    if (cluster_index is not None and
+        is_cached(cache, cluster_index, ('waveforms', count), clusters)):
+        return None
+    return count_coarse
+
+def _load_features_masks(spikes_data, clusters, statscache=None):
+    """Load the features and masks of all spikes in the clusters."""
+    cluster_index = getattr(statscache, 'cluster_index', None)
+    if cluster_index is None:
+        with HDF5_LOCK:
+            return spikes_data.load_features_masks(clusters=clusters)
+
+    def read(spikes):
+        return (read_spikes(spikes_data, 'features_masks', spikes,
+                            statscache=statscache),)
+
+    cache = getattr(statscache, 'cluster_data_cache', None)
+    return load_clusters(cache, cluster_index, 'features_masks', clusters,
+                         cluster_index.get_spikes, read)
+
+
+def _get_feature_background(spikes_data, spike_clusters, freq, nchannels,
+                            fetdim, nspikes_bg=None, statscache=None):
+    """Choose the background spikes, load their features, and compute the
+    normalization constants of the shank."""
+    cluster_index = getattr(statscache, 'cluster_index', None)
+    if cluster_index is None:
+        cluster_index = ClusterIndex(spike_clusters)
+    # The density image of the background does not depend on the number of
+    # spikes, so that many more spikes are loaded in density mode (the view
+    # only shows features_nspikes_background_max of them as points).
+    if not nspikes_bg:
+        if USERPREF.get('features_background_density', False):
+            nspikes_bg = USERPREF.get('features_nspikes_background_density',
+                                      100000)
+        else:
+            nspikes_bg = USERPREF.get('features_nspikes_background_max',
+                                      10000)
+    spikes_bg = get_background_spikes(cluster_index, nspikes_bg)
+
+    fm = np.atleast_3d(read_spikes(spikes_data, 'features_masks',
+                                    spikes_bg, statscache=statscache))
+    features_bg = fm[:, :, 0].astype(np.float32)
+    # Add extra feature for time is necessary.
+    if features_bg.shape[1] == nchannels * fetdim:
+        features_bg = np.hstack((features_bg,
+            np.ones((features_bg.shape[0], 1), dtype=np.float32)))
+    nextrafet = features_bg.shape[1] - nchannels * fetdim
+
+    spiketimes = spikes_data.concatenated_time_samples
+    spiketimes_bg = spiketimes[spikes_bg]
+    # The shank may have no spike.
+    if len(spiketimes) > 0:
+        time_first, time_last = spiketimes[0], spiketimes[len(spiketimes) - 1]
+    else:
+        time_first, time_last = 0, 0
+    feature_normalization = FeatureNormalization(features_bg, nextrafet,
+        time_first=time_first, time_last=time_last, freq=freq)
+    feature_background = FeatureBackground(spikes_bg, features_bg,
+        spiketimes_bg, feature_normalization)
+    if statscache is not None:
+        statscache.feature_normalization = feature_normalization
+        statscache.feature_background = feature_background
+    return feature_background
 
-    spike_clusters = getattr(spikes_data.clusters, clustering)[:]
-    # spikes_selected = get_some_spikes_in_clusters(clusters, spike_clusters)
 
-    # cluster_colors = clusters_data.color[clusters]
-    # get colors from application data:
-    cluster_colors = pd.Series([_get_color(clusters_data, cl)
-                                for cl in clusters], index=clusters)
+def get_waveformview_data(exp, clusters=[], channel_group=0, clustering='main',
+                          autozoom=None, wizard=None, statscache=None,
+                          count=None, keep_view=False):
+    """Return the data of the waveform view, with at most count waveforms
+    per cluster (by default, waveforms_nspikes_max_expected). keep_view
+    means that the view keeps its zoom and highlighted spikes, when the
+    same clusters are shown with more waveforms."""
+    clusters = np.array(clusters)
+    if count is None:
+        count = USERPREF['waveforms_nspikes_max_expected']
+    # The waveforms are read further down, one block at a time: the lock is
+    # only held here for the metadata.
+    with HDF5_LOCK:
+        fetdim = exp.application_data.spikedetekt.n_features_per_channel
+
+        clusters_data = getattr(exp.channel_groups[channel_group].clusters, clustering)
+        spikes_data = exp.channel_groups[channel_group].spikes
+        channels_data = exp.channel_groups[channel_group].channels
+        channels = exp.channel_groups[channel_group].channel_order
+
+        spike_clusters = _get_spike_clusters(spikes_data, clustering, statscache)
+        # spikes_selected = get_some_spikes_in_clusters(clusters, spike_clusters)
+
+        # cluster_colors = clusters_data.color[clusters]
+        # get colors from application data:
+        cluster_colors = _get_cluster_colors(clusters_data, clusters, statscache)
     # cluster_colors = pd.Series([
     #     next_color(cl)
     #         if cl in clusters_data else 1
@@ -71,6 +236,7 @@ def get_waveformview_data(exp, clusters=[], channel_group=0, clustering='main',
             geometrical_positions=None,
             autozoom=autozoom,
             keep_order=wizard,
+            keep_view=keep_view,
         )
 
         return data
@@ -79,18 +245,16 @@ def get_waveformview_data(exp, clusters=[], channel_group=0, clustering='main',
 
     # Find spikes to display and load the waveforms.
     if len(clusters) > 0:
-        spikes_selected, waveforms = spikes_data.load_waveforms(clusters=clusters,
-            count=USERPREF['waveforms_nspikes_max_expected'])
+        spikes_selected, waveforms, masks = _load_waveforms(spikes_data,
+            clusters, count, statscache=statscache)
     else:
         spikes_selected = []
 
     # Bake the waveform data.
     if len(spikes_selected) > 0:
         waveforms = convert_dtype(waveforms, np.float32)
-        if spikes_data.masks is not None:
-            masks = spikes_data.masks[spikes_selected, 0:fetdim*nchannels:fetdim]
-        else:
-            masks = None
+        if masks is not None:
+            masks = masks[:, 0:fetdim*nchannels:fetdim]
     else:
         waveforms = np.zeros((0, nsamples, nchannels), dtype=np.float32)
         masks = np.ones((0, nchannels), dtype=np.float32)
@@ -98,12 +262,27 @@ def get_waveformview_data(exp, clusters=[], channel_group=0, clustering='main',
     if masks is None:
         masks = np.ones((len(spikes_selected), nchannels), dtype=np.float32)
 
+    # Mean and std waveforms computed from all spikes, if available.
+    waveforms_avg = waveforms_std = masks_avg = None
+    waveform_stats = getattr(statscache, 'waveform_stats', None)
+    if waveform_stats is not None and len(clusters) > 0:
+        stats = waveform_stats.get(sorted(clusters))
+        if stats is not None:
+            # Same scaling as the displayed waveforms.
+            factor = convert_dtype(np.ones((1, 1, 1),
+                dtype=spikes_data.waveforms_filtered.dtype),
+                np.float32)[0, 0, 0]
+            waveforms_avg = (stats[0] * factor).astype(np.float32)
+            waveforms_std = (stats[1] * factor).astype(np.float32)
+            masks_avg = stats[2].astype(np.float32)
+
     spike_clusters = spike_clusters[spikes_selected]
-    channel_positions = np.array([channels_data[ch].position
-                                  if channels_data[ch].position is not None
-                                  else (0., ch)
-                                  for ch in channels],
-                                 dtype=np.float32)
+    with HDF5_LOCK:
+        channel_positions = np.array([channels_data[ch].position
+                                      if channels_data[ch].position is not None
+                                      else (0., ch)
+                                      for ch in channels],
+                                     dtype=np.float32)
 
     # Pandaize
     waveforms = pandaize(waveforms, spikes_selected)
@@ -121,6 +300,10 @@ def get_waveformview_data(exp, clusters=[], channel_group=0, clustering='main',
         geometrical_positions=channel_positions,
         autozoom=autozoom,
         keep_order=wizard,
+        waveforms_avg=waveforms_avg,
+        waveforms_std=waveforms_std,
+        masks_avg=masks_avg,
+        keep_view=keep_view,
     )
 
     return data
@@ -129,24 +312,26 @@ def get_featureview_data(exp, clusters=[], channel_group=0, clustering='main',
                          nspikes_bg=None, autozoom=None,
                          alpha_selected=.75, alpha_background=.25,
                          normalization=None,
-                         time_unit='second'):
+                         time_unit='second', statscache=None):
     clusters = np.array(clusters)
     # TODO: add spikes=None and spikes_bg=None
-    fetdim = exp.application_data.spikedetekt.n_features_per_channel
-
-
-    channels = exp.channel_groups[channel_group].channel_order
-
-    clusters_data = getattr(exp.channel_groups[channel_group].clusters, clustering)
-    spikes_data = exp.channel_groups[channel_group].spikes
-    channels_data = exp.channel_groups[channel_group].channels
-    nchannels = len(channels_data)
-
-    spike_clusters = getattr(spikes_data.clusters, clustering)[:]
-    # cluster_colors = clusters_data.color[clusters]
-    # get colors from application data:
-    cluster_colors = pd.Series([_get_color(clusters_data, cl)
-                                for cl in clusters], index=clusters)
+    # The features are read further down, one block at a time: the lock is
+    # only held here for the metadata.
+    with HDF5_LOCK:
+        fetdim = exp.application_data.spikedetekt.n_features_per_channel
+        freq = exp.application_data.spikedetekt.sample_rate
+
+        channels = exp.channel_groups[channel_group].channel_order
+
+        clusters_data = getattr(exp.channel_groups[channel_group].clusters, clustering)
+        spikes_data = exp.channel_groups[channel_group].spikes
+        channels_data = exp.channel_groups[channel_group].channels
+        nchannels = len(channels_data)
+
+        spike_clusters = _get_spike_clusters(spikes_data, clustering, statscache)
+        # cluster_colors = clusters_data.color[clusters]
+        # get colors from application data:
+        cluster_colors = _get_cluster_colors(clusters_data, clusters, statscache)
     # cluster_colors = pd.Series([
     #     next_color(cl)
     #         if cl in clusters_data else 1
@@ -154,7 +339,8 @@ def get_featureview_data(exp, clusters=[], channel_group=0, clustering='main',
 
     if len(clusters) > 0:
         # TODO: put fraction in user parameters
-        spikes_selected, fm = spikes_data.load_features_masks(clusters=clusters)
+        spikes_selected, fm = _load_features_masks(spikes_data, clusters,
+                                                   statscache=statscache)
     else:
         spikes_selected = []
         fm = np.zeros((0, spikes_data.features_masks.shape[1], 2),
@@ -162,68 +348,50 @@ def get_featureview_data(exp, clusters=[], channel_group=0, clustering='main',
 
     fm = np.atleast_3d(fm)
 
-    features = fm[:, :, 0]
-    nextrafet = features.shape[1] - nchannels * fetdim
+    nspikes, nfeatures = fm.shape[:2]
+    nextrafet = nfeatures - nchannels * fetdim
+    # Add extra feature for time is necessary: the features are copied
+    # once in a float32 buffer, where the time column is written in place.
+    if nextrafet == 0:
+        nextrafet = 1
+    features = np.empty((nspikes, nchannels * fetdim + nextrafet),
+                        dtype=np.float32)
+    features[:, :nfeatures] = fm[:, :, 0]
 
     if fm.shape[2] > 1:
         masks = fm[:, ::fetdim, 1]
     else:
         masks = None
 
-    nspikes = features.shape[0]
-    spiketimes_all = spikes_data.concatenated_time_samples[:]
+    spiketimes_all = spikes_data.concatenated_time_samples
     spiketimes = spiketimes_all[spikes_selected]
-    spike_clusters = spike_clusters[spikes_selected]
-    freq = exp.application_data.spikedetekt.sample_rate
-    duration = spikes_data.concatenated_time_samples[len(spikes_data.concatenated_time_samples)-1]*1./freq
-
-    spikes_bg, features_bg = spikes_data.load_features_masks_bg()
-
-    features_bg = np.atleast_3d(features_bg)
 
-    features_bg = features_bg[:,:,0].copy()
-    spiketimes_bg = spiketimes_all[spikes_bg]
+    # The background spikes, their features and the normalization constants
+    # are computed once per shank, so that the scaling does not depend on
+    # the current selection.
+    feature_background = getattr(statscache, 'feature_background', None)
+    if feature_background is None:
+        feature_background = _get_feature_background(spikes_data,
+            spike_clusters, freq, nchannels, fetdim, nspikes_bg=nspikes_bg,
+            statscache=statscache)
+    feature_normalization = feature_background.feature_normalization
+    duration = feature_normalization.duration
+    spikes_bg = feature_background.spikes
+    features_bg = feature_background.get_features(scale=normalization)
+
+    # Normalize features and time.
+    feature_normalization.normalize(features, spiketimes,
+                                    scale=normalization)
 
-    # Add extra feature for time is necessary.
-    if nextrafet == 0:
-        features = np.hstack((features, np.ones((features.shape[0], 1))))
-        features_bg = np.hstack((features_bg, np.ones((features_bg.shape[0], 1))))
-        nextrafet = 1
-
-    # Normalize features.
-    def _find_max(x):
-        if x.size == 0:
-            return 1.
-        return np.max(np.abs(x))
-
-    c = (normalization or (1. / _find_max(features_bg[:,:-nextrafet]))) if nspikes > 0 else 1.
-    features[:,:-nextrafet] *= c
-    features_bg[:,:-nextrafet] *= c
-
-    # Normalize extra features except time.
-    for i in range(features_bg.shape[1]-nextrafet-1, features_bg.shape[1]-1):
-        c = (1. / _find_max(features_bg[:,i])) if nspikes > 0 else 1.
-        features[:,i] *= c
-        features_bg[:,i] *= c
-
-    # Normalize time.
     if features.size > 0:
-        features[:,-1] = spiketimes
-        features[:,-1] *= (1. / (duration * freq))
-        features[:,-1] = 2 * features[:,-1] - 1
-
-        features_bg[:,-1] = spiketimes_bg
-        features_bg[:,-1] *= (1. / (duration * freq))
-        features_bg[:,-1] = 2 * features_bg[:,-1] - 1
-
-        # Pandaize
+        # Pandaize. The background features are passed as they are, they
+        # are shared with the cache.
         features = pandaize(features, spikes_selected)
-        features_bg = pandaize(features_bg, spikes_bg)
         if masks is not None:
             masks = pandaize(masks, spikes_selected)
 
     spiketimes = pandaize(spiketimes, spikes_selected)
-    spike_clusters = pandaize(spike_clusters, spikes_selected)
+    spike_clusters = pandaize(spike_clusters[spikes_selected], spikes_selected)
     cluster_colors = pandaize(cluster_colors, clusters)
 
     # nextrafet = features.shape[1] - fetdim * nchannels
@@ -259,10 +427,17 @@ def get_clusterview_data(exp, statscache=None, channel_group=0,
     # Get the list of all existing clusters.
     # clusters = sorted(clusters_data.keys())
 
-    spike_clusters = getattr(exp.channel_groups[channel_group].spikes.clusters,
-                             clustering)[:]
-    clusters = np.unique(spike_clusters)
-    groups = cluster_groups_data.keys()
+    cluster_index = getattr(statscache, 'cluster_index', None)
+    if cluster_index is None:
+        spike_clusters = getattr(exp.channel_groups[channel_group].spikes.clusters,
+                                 clustering)[:]
+        cluster_index = ClusterIndex(spike_clusters)
+    clusters = cluster_index.clusters_unique
+    cluster_metadata = getattr(statscache, 'cluster_metadata', None)
+    if cluster_metadata is None:
+        cluster_metadata = ClusterMetadata.from_experiment(exp,
+            channel_group=channel_group, clustering=clustering)
+    groups = cluster_metadata.groups
 
     # cluster_groups = pd.Series([clusters_data[cl].cluster_group or 0
     #                            for cl in clusters], index=clusters)
@@ -270,30 +445,23 @@ def get_clusterview_data(exp, statscache=None, channel_group=0,
     # to be added in the HDF5 file.
 
     # get colors from application data:
-    cluster_colors = pd.Series([_get_color(clusters_data, cl)
-                                for cl in clusters], index=clusters)
+    cluster_colors = pd.Series(cluster_metadata.get_colors(clusters),
+                               index=clusters)
 
     # cluster_colors = pd.Series([
     #     next_color(cl)
     #         if cl in clusters_data else 1
     #                        for cl in clusters], index=clusters)
 
-    cluster_groups = pd.Series([
-        (clusters_data[cl].cluster_group
-                                if clusters_data[cl].cluster_group is not None else 3)
-            if cl in clusters_data else 3
-                               for cl in clusters], index=clusters)
+    cluster_groups = pd.Series(cluster_metadata.get_groups(clusters,
+                               default=3), index=clusters)
 
-    group_colors = pd.Series([next_color(cl)
+    group_colors = pd.Series([next_color(g)
                              for g in groups], index=groups)
-    group_names = pd.Series([cluster_groups_data[g].name or 'Group'
-                            for g in groups], index=groups)
-    # TODO: cache the cluster size instead of recomputing every time here
-    # (in experiment class?)
-    spike_clusters = getattr(exp.channel_groups[channel_group].spikes.clusters,
-                             clustering)[:]
-    sizes = np.bincount(spike_clusters)
-    cluster_sizes = pd.Series(sizes[clusters], index=clusters)
+    group_names = pd.Series(cluster_metadata.get_group_names(groups),
+                            index=groups)
+    cluster_sizes = pd.Series(cluster_index.get_sizes(clusters),
+                              index=clusters)
 
 
     data = dict(
@@ -311,7 +479,8 @@ def get_clusterview_data(exp, statscache=None, channel_group=0,
 
 def get_correlogramsview_data(exp, correlograms, clusters=[],
                               channel_group=0, clustering='main', wizard=None,
-                              nclusters_max=None, ncorrbins=50, corrbin=.001):
+                              nclusters_max=None, ncorrbins=50, corrbin=.001,
+                              statscache=None):
 
     clusters = np.array(clusters, dtype=np.int32)
     clusters_data = getattr(exp.channel_groups[channel_group].clusters, clustering)
@@ -322,19 +491,21 @@ def get_correlogramsview_data(exp, correlograms, clusters=[],
     # cluster_colors = pandaize(cluster_colors, clusters)
 
     # get colors from application data:
-    cluster_colors = pd.Series([_get_color(clusters_data, cl)
-                                for cl in clusters], index=clusters)
+    cluster_colors = _get_cluster_colors(clusters_data, clusters, statscache)
 
     # cluster_colors = pd.Series([
     #     next_color(cl)
     #         if cl in clusters_data else 1
     #                        for cl in clusters], index=clusters)
 
-    # TODO: cache and optimize this
-    spike_clusters = getattr(exp.channel_groups[channel_group].spikes.clusters,
-                             clustering)[:]
-    sizes = np.bincount(spike_clusters)
-    cluster_sizes = sizes[clusters]
+    cluster_index = getattr(statscache, 'cluster_index', None)
+    if cluster_index is not None:
+        cluster_sizes = cluster_index.get_sizes(clusters)
+    else:
+        spike_clusters = getattr(exp.channel_groups[channel_group].spikes.clusters,
+                                 clustering)[:]
+        sizes = np.bincount(spike_clusters)
+        cluster_sizes = sizes[clusters]
 
     clusters_selected0 = clusters
     nclusters_max = nclusters_max or USERPREF['correlograms_max_nclusters']
@@ -351,8 +522,14 @@ def get_correlogramsview_data(exp, correlograms, clusters=[],
     # Compute the baselines.
     # corrbin = SETTINGS.get('correlograms.corrbin', CORRBIN_DEFAULT)
     # ncorrbins = SETTINGS.get('correlograms.ncorrbins', NCORRBINS_DEFAULT)
-    duration = exp.channel_groups[channel_group].spikes.concatenated_time_samples[:][-1] - exp.channel_groups[channel_group].spikes.concatenated_time_samples[:][0]
-    duration /= freq
+    feature_normalization = getattr(statscache, 'feature_normalization', None)
+    if feature_normalization is not None:
+        duration = (feature_normalization.time_last -
+                    feature_normalization.time_first)
+    else:
+        spiketimes = exp.channel_groups[channel_group].spikes.concatenated_time_samples
+        duration = spiketimes[len(spiketimes) - 1] - spiketimes[0]
+    duration = duration * 1. / freq
     if duration == 0:
         duration = 1.
     baselines = get_baselines(cluster_sizes, duration, corrbin)
@@ -371,22 +548,29 @@ def get_correlogramsview_data(exp, correlograms, clusters=[],
     return data
 
 def get_similaritymatrixview_data(exp, matrix=None,
-        channel_group=0, clustering='main',):
+        channel_group=0, clustering='main', statscache=None):
     if matrix is None:
         return {}
     clusters_data = getattr(exp.channel_groups[channel_group].clusters, clustering)
     cluster_groups_data = getattr(exp.channel_groups[channel_group].cluster_groups, clustering)
-    clusters = sorted(clusters_data.keys())
+    cluster_metadata = getattr(statscache, 'cluster_metadata', None)
+    if cluster_metadata is not None:
+        clusters = cluster_metadata.clusters
+    else:
+        clusters = sorted(clusters_data.keys())
 
     # get colors from application data:
-    cluster_colors = pd.Series([_get_color(clusters_data, cl)
-                                for cl in clusters], index=clusters)
+    cluster_colors = _get_cluster_colors(clusters_data, clusters, statscache)
 
     # cluster_colors = pd.Series([next_color(cl)
     #                        for cl in clusters], index=clusters)
 
-    cluster_groups = pd.Series([clusters_data[cl].cluster_group or 0
-                               for cl in clusters], index=clusters)
+    if cluster_metadata is not None:
+        cluster_groups = pd.Series(cluster_metadata.get_groups(clusters,
+                                   default=0), index=clusters)
+    else:
+        cluster_groups = pd.Series([clusters_data[cl].cluster_group or 0
+                                   for cl in clusters], index=clusters)
 
 
     # Clusters in groups 0 or 1 to hide.
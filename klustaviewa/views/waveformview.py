@@ -5,7 +5,6 @@
 # -----------------------------------------------------------------------------
 import numpy as np
 import numpy.random as rdn
-from numpy.lib.stride_tricks import as_strided
 import operator
 import time
 
@@ -15,7 +14,9 @@ from galry import (Manager, PlotPaintManager, PlotInteractionManager, Visual,
     TextVisual)
 from kwiklib.dataio.tools import get_array
 from kwiklib.dataio.selection import get_spikes_in_clusters, select, get_indices
-from klustaviewa.views.common import HighlightManager, KlustaViewaBindings, KlustaView
+from klustaviewa.views.common import (HighlightManager, KlustaViewaBindings,
+    KlustaView, set_attribute_ranges)
+from klustaviewa.views.trackedmask import TrackedMask
 from kwiklib.utils.colors import COLORMAP_TEXTURE, SHIFTLEN
 from kwiklib.utils import logger as log
 from klustaviewa import SETTINGS
@@ -79,6 +80,70 @@ FRAGMENT_SHADER_AVERAGE = """
 """
 
 
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+def find_enclosed_waveforms(waveforms, Tx, Ty, box_size, spike_boxes,
+                            channels, box):
+    """Return the spikes with at least one point in a box.
+
+    Arguments:
+      * waveforms: a Nspikes x Nsamples x Nchannels array.
+      * Tx, Ty: Nchannels x Nboxes arrays with the box centers.
+      * box_size: the (width, height) of the boxes.
+      * spike_boxes: the box index of every spike.
+      * channels: the channels to test.
+      * box: the (xmin, ymin, xmax, ymax) box.
+
+    """
+    nspikes, nsamples, _ = waveforms.shape
+    xmin, ymin, xmax, ymax = box
+    a, b = box_size[0] / 2., box_size[1] / 2.
+    wx = np.linspace(-1., 1., nsamples)
+    samples = np.arange(nsamples)
+    found = np.zeros(nspikes, dtype=np.bool_)
+    for channel in channels:
+        # Only test the spikes which have not been found yet.
+        spikes = np.nonzero(~found)[0]
+        if len(spikes) == 0:
+            break
+        u = Tx[channel, spike_boxes[spikes]]
+        v = Ty[channel, spike_boxes[spikes]]
+        # Range of samples in the box along x, for every spike.
+        lo = np.searchsorted(wx, (xmin - u) / a, 'left')
+        hi = np.searchsorted(wx, (xmax - u) / a, 'right')
+        keep = lo < hi
+        spikes, lo, hi, v = spikes[keep], lo[keep], hi[keep], v[keep]
+        if len(spikes) == 0:
+            continue
+        wy = waveforms[spikes, :, channel]
+        inside = ((samples >= lo[:, np.newaxis]) &
+                  (samples < hi[:, np.newaxis]) &
+                  (wy >= ((ymin - v) / b)[:, np.newaxis]) &
+                  (wy <= ((ymax - v) / b)[:, np.newaxis]))
+        found[spikes[inside.any(axis=1)]] = True
+    return np.nonzero(found)[0]
+
+def get_waveform_positions(waveforms):
+    """Return the Nx2 float32 vertex positions of waveforms given as a
+    Nspikes x Nsamples x Nchannels array, ordered by channel, spike and
+    sample."""
+    nspikes, nsamples, nchannels = waveforms.shape
+    data = np.empty((nchannels, nspikes, nsamples, 2), dtype=np.float32)
+    data[..., 0] = np.linspace(-1., 1., nsamples)
+    data[..., 1] = waveforms.transpose((2, 0, 1))
+    return data.reshape((-1, 2))
+
+def get_vertex_attribute(values, nchannels, nspikes, nsamples):
+    """Expand per-channel or per-spike values, broadcastable to a
+    Nchannels x Nspikes x Nsamples array, to one float32 value per vertex.
+    float32 is the type of the vertex buffers, so that the array is not
+    converted again before the upload."""
+    out = np.empty((nchannels, nspikes, nsamples), dtype=np.float32)
+    out[...] = values
+    return out.ravel()
+
+
 # -----------------------------------------------------------------------------
 # Data manager
 # -----------------------------------------------------------------------------
@@ -398,9 +463,17 @@ class WaveformDataManager(Manager):
                  geometrical_positions=None,
                  keep_order=None,
                  autozoom=None,
+                 # mean and std waveforms and mean masks computed from all
+                 # spikes, in the order of the sorted selected clusters
+                 waveforms_avg=None,
+                 waveforms_std=None,
+                 masks_avg=None,
                  ):
                  
         self.autozoom = autozoom
+        self.waveforms_avg = waveforms_avg
+        self.waveforms_std = waveforms_std
+        self.masks_avg_all = masks_avg
         if clusters_selected is None:
             clusters_selected = []
         if waveforms is None:
@@ -456,19 +529,39 @@ class WaveformDataManager(Manager):
         # self.cluster_colors = cluster_colors
         self.masks = masks
         
-        # Prepare GPU data.
-        self.data = self.prepare_waveform_data()
-        self.masks_full = np.repeat(self.masks_array.T.ravel(), self.nsamples)
-        self.clusters_full = np.tile(np.repeat(self.clusters_rel_ordered2, self.nsamples), self.nchannels)
-        self.clusters_full_depth = np.tile(np.repeat(self.clusters_rel_ordered, self.nsamples), self.nchannels)
-        self.channels_full = np.repeat(np.arange(self.nchannels, dtype=np.int32), self.nspikes * self.nsamples)
+        # Prepare GPU data: the per-spike and per-channel values are
+        # expanded to the vertices only once, in float32.
+        self.data = get_waveform_positions(self.waveforms_array)
+        shape = (self.nchannels, self.nspikes, self.nsamples)
+        self.masks_full = get_vertex_attribute(
+            self.masks_array.T[:, :, np.newaxis], *shape)
+        self.clusters_full = get_vertex_attribute(
+            self.clusters_rel_ordered2[:, np.newaxis], *shape)
+        self.clusters_full_depth = get_vertex_attribute(
+            self.clusters_rel_ordered[:, np.newaxis], *shape)
+        self.channels_full = get_vertex_attribute(
+            np.arange(self.nchannels)[:, np.newaxis, np.newaxis], *shape)
+        self.cmap_index_full = get_vertex_attribute(
+            self.cluster_colors_array[self.clusters_rel_ordered2]
+                [:, np.newaxis], *shape)
         
         # Compute average waveforms.
         self.data_avg = self.prepare_average_waveform_data()
-        self.masks_full_avg = np.repeat(self.masks_avg.T.ravel(), self.nsamples_avg)
-        self.clusters_full_avg = np.tile(np.repeat(self.clusters_rel_ordered_avg2, self.nsamples_avg), self.nchannels_avg)
-        self.clusters_full_depth_avg = np.tile(np.repeat(self.clusters_rel_ordered_avg, self.nsamples_avg), self.nchannels_avg)
-        self.channels_full_avg = np.repeat(np.arange(self.nchannels_avg, dtype=np.int32), self.nspikes_avg * self.nsamples_avg)
+        shape = (self.nchannels_avg, self.nspikes_avg, self.nsamples_avg)
+        self.masks_full_avg = get_vertex_attribute(
+            self.masks_avg.T[:, :, np.newaxis], *shape)
+        self.clusters_full_avg = get_vertex_attribute(
+            self.clusters_rel_ordered_avg2[:, np.newaxis], *shape)
+        self.clusters_full_depth_avg = get_vertex_attribute(
+            self.clusters_rel_ordered_avg[:, np.newaxis], *shape)
+        self.channels_full_avg = get_vertex_attribute(
+            np.arange(self.nchannels_avg)[:, np.newaxis, np.newaxis], *shape)
+        self.cmap_index_full_avg = get_vertex_attribute(
+            self.cluster_colors_array[self.clusters_rel_ordered_avg2]
+                [:, np.newaxis], *shape)
+        
+        log.debug("Waveform vertex buffers: {0:.1f} MB.".format(
+            sum(self.get_buffer_sizes().values()) / 1024. ** 2))
         
         # position waveforms
         self.position_manager.set_info(self.nchannels, self.nclusters, 
@@ -480,36 +573,40 @@ class WaveformDataManager(Manager):
     
     # Internal methods
     # ----------------
-    def prepare_waveform_data(self):
-        """Define waveform data."""
-        X = np.tile(np.linspace(-1., 1., self.nsamples),
-                                (self.nchannels * self.nspikes, 1))
-        
-        # new: use strides to avoid unnecessary memory copy
-        strides = self.waveforms_array.strides
-        strides = (strides[2], strides[0], strides[1])
-
-        shape = self.waveforms_array.shape
-        shape = (shape[2], shape[0], shape[1])
-        Y = as_strided(self.waveforms_array, strides=strides, shape=shape)
-        
-        # create a Nx2 array with all coordinates
-        data = np.empty((X.size, 2), dtype=np.float32)
-        data[:,0] = X.ravel()
-        data[:,1] = Y.ravel()
-        return data
+    def get_buffer_sizes(self):
+        """Return the size in bytes of every vertex buffer of the waveforms
+        and of the average waveforms."""
+        names = ['data', 'masks_full', 'clusters_full', 'clusters_full_depth',
+                 'channels_full', 'cmap_index_full']
+        sizes = {}
+        for name in names:
+            for suffix in ('', '_avg'):
+                arr = getattr(self, name + suffix, None)
+                if arr is not None:
+                    sizes[name + suffix] = arr.nbytes
+        # One highlight value per vertex.
+        sizes['highlight'] = self.npoints * 4
+        return sizes
     
     def prepare_average_waveform_data(self):
         waveforms_avg = np.zeros((self.nclusters, self.nsamples, self.nchannels))
         waveforms_std = np.zeros((self.nclusters, self.nsamples, self.nchannels))
-        self.masks_avg = np.zeros((self.nclusters, self.nchannels))
-        for i, cluster in enumerate(self.clusters_unique):
-            spike_indices = get_spikes_in_clusters(cluster, self.clusters)
-            w = select(self.waveforms, spike_indices)
-            m = select(self.masks, spike_indices)
-            waveforms_avg[i,...] = w.mean(axis=0)
-            waveforms_std[i,...] = w.std(axis=0).mean()
-            self.masks_avg[i,...] = m.mean(axis=0)
+        if (self.waveforms_avg is not None and 
+                len(self.waveforms_avg) == self.nclusters):
+            # Use the statistics computed from all spikes.
+            waveforms_avg[...] = self.waveforms_avg
+            waveforms_std[...] = self.waveforms_std.reshape(
+                (self.nclusters, -1)).mean(axis=1).reshape((-1, 1, 1))
+            self.masks_avg = np.array(self.masks_avg_all)
+        else:
+            self.masks_avg = np.zeros((self.nclusters, self.nchannels))
+            for i, cluster in enumerate(self.clusters_unique):
+                spike_indices = get_spikes_in_clusters(cluster, self.clusters)
+                w = select(self.waveforms, spike_indices)
+                m = select(self.masks, spike_indices)
+                waveforms_avg[i,...] = w.mean(axis=0)
+                waveforms_std[i,...] = w.std(axis=0).mean()
+                self.masks_avg[i,...] = m.mean(axis=0)
         
         # create X coordinates
         X = np.tile(np.linspace(-1., 1., self.nsamples),
@@ -575,7 +672,7 @@ class WaveformVisual(Visual):
     def initialize(self, nclusters=None, nchannels=None, 
         nsamples=None, npoints=None, #nspikes=None,
         position0=None, mask=None, cluster=None, cluster_depth=None,
-        cluster_colors=None, channel=None, highlight=None,
+        cmap_index=None, channel=None, highlight=None,
         average=None):
 
         self.size, self.bounds = WaveformVisual.get_size_bounds(nsamples, npoints)
@@ -619,7 +716,6 @@ class WaveformVisual(Visual):
         if average:
             FRAGMENT_SHADER = FRAGMENT_SHADER_AVERAGE
             
-        cmap_index = cluster_colors[cluster]
         self.add_texture('cmap', ncomponents=ncomponents, ndim=2, data=COLORMAP_TEXTURE)
         self.add_attribute('cmap_index', ndim=1, vartype='int', data=cmap_index)
         self.add_varying('cmap_vindex', vartype='int', ndim=1)
@@ -693,7 +789,7 @@ class WaveformPaintManager(PlotPaintManager):
             cluster_depth=self.data_manager.clusters_full_depth,
             nsamples=self.data_manager.nsamples,
             position0=self.data_manager.data,
-            cluster_colors=self.data_manager.cluster_colors_array,
+            cmap_index=self.data_manager.cmap_index_full,
             mask=self.data_manager.masks_full,
             cluster=self.data_manager.clusters_full,
             channel=self.data_manager.channels_full,
@@ -708,7 +804,7 @@ class WaveformPaintManager(PlotPaintManager):
             cluster_depth=self.data_manager.clusters_full_depth_avg,
             nsamples=self.data_manager.nsamples_avg,
             position0=self.data_manager.data_avg,
-            cluster_colors=self.data_manager.cluster_colors_array,
+            cmap_index=self.data_manager.cmap_index_full_avg,
             mask=self.data_manager.masks_full_avg,
             cluster=self.data_manager.clusters_full_avg,
             channel=self.data_manager.channels_full_avg,
@@ -732,9 +828,6 @@ class WaveformPaintManager(PlotPaintManager):
     def update(self):
         size, bounds = WaveformVisual.get_size_bounds(
             self.data_manager.nsamples, self.data_manager.npoints)
-        cluster = self.data_manager.clusters_full
-        cluster_colors = self.data_manager.cluster_colors_array
-        cmap_index = cluster_colors[cluster]
         
         box_size = self.get_uniform_value('box_size')
         box_size_margin = self.get_uniform_value('box_size_margin')
@@ -748,7 +841,7 @@ class WaveformPaintManager(PlotPaintManager):
             mask=self.data_manager.masks_full,
             cluster=self.data_manager.clusters_full,
             cluster_depth=self.data_manager.clusters_full_depth,
-            cmap_index=cmap_index,
+            cmap_index=self.data_manager.cmap_index_full,
             channel=self.data_manager.channels_full,
             highlight=self.highlight_manager.highlight_mask,
             # auto update uniforms
@@ -759,9 +852,6 @@ class WaveformPaintManager(PlotPaintManager):
             
         # average waveforms
         size, bounds = WaveformVisual.get_size_bounds(self.data_manager.nsamples_avg, self.data_manager.npoints_avg)
-        cluster = self.data_manager.clusters_full_avg
-        cluster_colors = self.data_manager.cluster_colors_array
-        cmap_index = cluster_colors[cluster]
         
         self.set_data(visual='waveforms_avg', 
             size=size,
@@ -771,7 +861,7 @@ class WaveformPaintManager(PlotPaintManager):
             mask=self.data_manager.masks_full_avg,
             cluster=self.data_manager.clusters_full_avg,
             cluster_depth=self.data_manager.clusters_full_depth_avg,
-            cmap_index=cluster_colors[self.data_manager.clusters_full_avg],
+            cmap_index=self.data_manager.cmap_index_full_avg,
             channel=self.data_manager.channels_full_avg,
             highlight=np.zeros(size, dtype=np.int32),
             # auto update uniforms
@@ -807,7 +897,8 @@ class WaveformHighlightManager(HighlightManager):
         self.waveforms_array = self.data_manager.waveforms_array
         self.waveform_indices = self.data_manager.waveform_indices
         self.highlighted_spikes = []
-        self.highlight_mask = np.zeros(self.npoints, dtype=np.int32)
+        self.highlight_tracker = TrackedMask(self.npoints)
+        self.highlight_mask = self.highlight_tracker.mask
         self.highlighting = False
 
     def find_enclosed_spikes(self, enclosing_box):
@@ -815,22 +906,7 @@ class WaveformHighlightManager(HighlightManager):
         if self.nspikes == 0:
             return np.array([])
         
-        # first call
-        if not self.highlighting:
-            # create
-            box_positions, box_size = self.position_manager.get_transformation()
-            # Tx, Ty: Nchannels x Nclusters
-            Tx, Ty = box_positions
-            # to: Nspikes x Nsamples x Nchannels
-            Px = np.tile(Tx[:,self.clusters_rel_ordered2].reshape((self.nchannels, self.nspikes, 1)), (1, 1, self.nsamples))
-            self.Px = Px.transpose([1, 2, 0])
-            Py = np.tile(Ty[:,self.clusters_rel_ordered2].reshape((self.nchannels, self.nspikes, 1)), (1, 1, self.nsamples))
-            self.Py = Py.transpose([1, 2, 0])
-            
-            self.Wx = np.tile(np.linspace(-1., 1., self.nsamples).reshape((1, -1, 1)), (self.nspikes, 1, self.nchannels))
-            self.Wy = self.waveforms_array
-            
-            self.highlighting = True
+        self.highlighting = True
         
         x0, y0, x1, y1 = enclosing_box
         
@@ -843,9 +919,8 @@ class WaveformHighlightManager(HighlightManager):
 
         # transformation
         box_positions, box_size = self.position_manager.get_transformation()
+        # Tx, Ty: Nchannels x Nclusters
         Tx, Ty = box_positions
-        w, h = box_size
-        a, b = w / 2, h / 2
         
         # find the enclosed channels and clusters
         channels, clusters = self.position_manager.get_enclosed_channels((x0, y0, x1, y1))
@@ -855,15 +930,11 @@ class WaveformHighlightManager(HighlightManager):
         if channels.size == 0:
             return np.array([])
         
-        u, v = self.Px[:,:,channels], self.Py[:,:,channels]
-        Wx, Wy = self.Wx[:,:,channels], self.Wy[:,:,channels]
-        
-        ind =  ((Wx >= (xmin-u)/a) & (Wx <= (xmax-u)/a) & \
-                (Wy >= (ymin-v)/b) & (Wy <= (ymax-v)/b))
-        
-        spkindices = np.nonzero(ind.max(axis=1).max(axis=1))[0]
-
-        return spkindices
+        # test the enclosed channels one at a time, without Nspikes x
+        # Nsamples x Nchannels temporary arrays
+        return find_enclosed_waveforms(self.waveforms_array, Tx, Ty,
+            box_size, self.clusters_rel_ordered2, channels,
+            (xmin, ymin, xmax, ymax))
 
     def find_indices_from_spikes(self, spikes):
         if spikes is None or len(spikes)==0:
@@ -885,20 +956,15 @@ class WaveformHighlightManager(HighlightManager):
         a special color."""
         
         if len(spikes) == 0:
-            # do update only if there were previously selected spikes
-            do_update = len(self.highlighted_spikes) > 0
-            self.highlight_mask[:] = 0
+            self.highlight_tracker.clear()
         else:
-            do_update = True
-            self.highlight_mask[:] = 0
-            if len(spikes) > 0:
-                ind = self.find_indices_from_spikes(spikes)
-                self.highlight_mask[ind] = 1
+            self.highlight_tracker.set(self.find_indices_from_spikes(spikes))
         
-        if do_update:
-            self.paint_manager.set_data(
-                highlight=self.highlight_mask,
-                visual='waveforms')
+        # only upload the ranges of points which have changed
+        ranges = self.highlight_tracker.pop_dirty_ranges()
+        if ranges:
+            set_attribute_ranges(self.paint_manager, 'waveforms', 'highlight',
+                self.highlight_mask, ranges)
         
         self.highlighted_spikes = spikes
 
@@ -1184,12 +1250,23 @@ class WaveformView(KlustaView):
     def set_data(self, *args, **kwargs):
         if self.first:
             self.restore_geometry()
+        
+        # Keep the zoom and the highlighted spikes when the same clusters
+        # are shown with more waveforms.
+        keep_view = kwargs.pop('keep_view', False) and not self.first
+        if keep_view:
+            kwargs['autozoom'] = None
+            spikes_highlighted = self.data_manager.waveform_indices_array[
+                np.array(self.highlight_manager.highlighted_spikes,
+                         dtype=np.int64)]
             
         self.data_manager.set_data(*args, **kwargs)
         
         # update?
         if self.initialized:
             self.paint_manager.update()
+            if keep_view and len(spikes_highlighted) > 0:
+                self.highlight_manager.highlight_spikes(spikes_highlighted)
             self.updateGL()
             
         self.first = False
@@ -49,6 +49,9 @@ if __name__ == '__main__':
             'gui_scripts': [
                 'klustaviewa = klustaviewa.scripts.runklustaviewa:main',
                 ],
+            'console_scripts': [
+                'klustaviewa-repack = klustaviewa.scripts.runrepack:main',
+                ],
         },
 
         # app=['klustaviewa/scripts/runklustaviewa.pyw',